@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks the stages of the stash and restore pipelines with synthetic klepto output.
+
+Each stage runs in a fresh process so that its peak RSS can be measured. The local
+filesystem storage backend stands in for S3.
+
+Usage:
+    bench.py [options]
+
+Stages:
+    rewrite    Rewriting klepto output lines (`dumper._process_stdout_line`).
+    extract    Running (a stand-in for) klepto and consuming its output.
+    compress   Compressing the dump.
+    upload     Storing the compressed dump.
+    download   Streaming and decompressing the stored dump.
+    parse      Parsing the dump into COPY batches (a null database sink).
+    stash      The whole stash pipeline.
+    restore    The whole restore pipeline. Requires `--target`.
+
+Options:
+    -s <stages>          Comma-separated stages to run [default: rewrite,extract,compress,upload,download,parse,stash]
+    --size <mb>          Approximate size of the (uncompressed) dump in MB [default: 64]
+    --tables <n>         Number of tables [default: 10]
+    --columns <n>        Number of columns per table [default: 8]
+    --row-width <bytes>  Approximate width of each row [default: 200]
+    --nulls <ratio>      Ratio of NULL values [default: 0.1]
+    --target <uri>       PostgreSQL URI for the `restore` stage. The database must be
+                         empty.
+    --json <path>        Write the results as JSON to this path.
+    --compare <path>     Compare the results with a previous JSON results file.
+
+"""
+
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from typing import Callable, Dict, List, Optional
+
+from docopt import docopt
+
+# Set up the PYTHONPATH to be able to import from `voleur`.
+package = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, os.path.abspath(package))
+
+from voleur import dumper
+from voleur import pipeline
+from voleur import storage
+from voleur import utils
+from voleur import writer
+
+
+# Stand-in for the klepto binary, which outputs the synthetic dump.
+_KLEPTO_STAND_IN = '#!/bin/sh\nexec cat "{path}"\n'
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+class Fixture:
+    """The synthetic dumps shared by all stages."""
+
+    def __init__(self, workdir: str):
+        self.workdir = workdir
+
+        # Raw (klepto) output.
+        self.raw_path = os.path.join(workdir, 'klepto.out')
+
+        # Processed, compressed dump, as stored by `stash`.
+        self.dump_path = os.path.join(workdir, 'dump.sql.gz')
+
+        # Stand-in klepto binary and config.
+        self.klepto_path = os.path.join(workdir, 'klepto')
+        self.klepto_config = os.path.join(workdir, 'klepto.toml')
+
+        self.raw_bytes = 0
+        self.dump_bytes = 0
+        self.lines = 0
+
+    def generate(self, size: int, tables: int, columns: int, width: int, nulls: float):
+        """Generates klepto-style output of roughly `size` bytes."""
+        rand = random.Random(0)
+        text = _random_text(rand, 1024 * 1024)
+        value_width = max(1, width // columns - 4)
+        names = ', '.join(f'"col_{i}"' for i in range(columns))
+        rows_per_table = max(1, size // width // tables)
+
+        with open(self.raw_path, 'wb') as f:
+            for table in range(tables):
+                ddl = ', '.join(f'col_{i} text' for i in range(columns))
+                f.write(f'CREATE TABLE table_{table} ({ddl});\n'.encode('utf-8'))
+                self.lines += 1
+            for table in range(tables):
+                prefix = f'INSERT INTO "table_{table}" ({names}) VALUES ('.encode('utf-8')
+                for _ in range(rows_per_table):
+                    values = []
+                    for i in range(columns):
+                        if rand.random() < nulls:
+                            values.append(b"'NULL'")
+                        elif i == 0:
+                            values.append(b"'2020-03-20 20:00:00 +0000 UTC'")
+                        else:
+                            offset = rand.randrange(len(text) - value_width)
+                            value = text[offset : offset + value_width]
+                            values.append(b"'" + value + b"'")
+                    f.write(prefix + b', '.join(values) + b')\n')
+                    self.lines += 1
+
+        with open(self.raw_path, 'rb') as f, open(self.dump_path, 'wb') as out:
+            compressor = zlib.compressobj(
+                pipeline.COMPRESSION_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS
+            )
+            for line in f:
+                out.write(compressor.compress(dumper._process_stdout_line(line)))
+            out.write(compressor.flush())
+
+        with open(self.klepto_path, 'w') as f:
+            f.write(_KLEPTO_STAND_IN.format(path=self.raw_path))
+        os.chmod(self.klepto_path, 0o755)
+        open(self.klepto_config, 'w').close()
+
+        self.raw_bytes = os.path.getsize(self.raw_path)
+        self.dump_bytes = os.path.getsize(self.dump_path)
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Stages. Each returns the number of bytes it processed.
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+def bench_rewrite(fixture: Fixture, target: Optional[str]) -> int:
+    with open(fixture.raw_path, 'rb') as f:
+        for line in f:
+            dumper._process_stdout_line(line)
+    return fixture.raw_bytes
+
+
+def bench_extract(fixture: Fixture, target: Optional[str]) -> int:
+    async def run():
+        async for _ in dumper.extract_dump('postgres://bench', fixture.klepto_config):
+            pass
+
+    dumper._build_klepto_path = lambda: fixture.klepto_path
+    pipeline.run(run())
+    return fixture.raw_bytes
+
+
+def bench_compress(fixture: Fixture, target: Optional[str]) -> int:
+    async def run():
+        source, sink = pipeline.Channel(), pipeline.Channel()
+        await pipeline.run_stages(
+            pipeline.feed(_read_chunks(fixture.raw_path), source),
+            pipeline.compress(source, sink),
+            _consume(sink),
+        )
+
+    pipeline.run(run())
+    return fixture.raw_bytes
+
+
+def bench_upload(fixture: Fixture, target: Optional[str]) -> int:
+    path = os.path.join(fixture.workdir, 'upload', 'dump.sql.gz')
+    pipeline.run(storage.store_chunks('file', path, _read_chunks(fixture.dump_path)))
+    return fixture.dump_bytes
+
+
+def bench_download(fixture: Fixture, target: Optional[str]) -> int:
+    async def run():
+        source, sink = pipeline.Channel(), pipeline.Channel()
+        await pipeline.run_stages(
+            pipeline.feed(storage.iter_storage_url(f'file://{fixture.dump_path}'), source),
+            pipeline.decompress(source, sink),
+            _consume(sink),
+        )
+
+    pipeline.run(run())
+    return fixture.dump_bytes
+
+
+def bench_parse(fixture: Fixture, target: Optional[str]) -> int:
+    async def run():
+        source = pipeline.Channel()
+        await pipeline.run_stages(
+            pipeline.feed(storage.iter_storage_url(f'file://{fixture.dump_path}'), source),
+            _consume(writer.iter_batches(_decompressed(source))),
+        )
+
+    pipeline.run(run())
+    return fixture.raw_bytes
+
+
+def bench_stash(fixture: Fixture, target: Optional[str]) -> int:
+    dumper._build_klepto_path = lambda: fixture.klepto_path
+    path = os.path.join(fixture.workdir, 'stash', utils.generate_dump_filename())
+    pipeline.run(
+        pipeline.stash(
+            'postgres://bench', path, klepto_config=fixture.klepto_config, backend='file'
+        )
+    )
+    return fixture.raw_bytes
+
+
+def bench_restore(fixture: Fixture, target: Optional[str]) -> int:
+    if not target:
+        raise ValueError('the restore stage requires --target')
+    storage_url = f'file://{fixture.dump_path}'
+    errors = pipeline.run(pipeline.restore(storage_url, [target]))
+    if errors[target]:
+        raise errors[target]
+    return fixture.raw_bytes
+
+
+STAGES: Dict[str, Callable[[Fixture, Optional[str]], int]] = {
+    'rewrite': bench_rewrite,
+    'extract': bench_extract,
+    'compress': bench_compress,
+    'upload': bench_upload,
+    'download': bench_download,
+    'parse': bench_parse,
+    'stash': bench_stash,
+    'restore': bench_restore,
+}
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Runner
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+def run_stage(name: str, fixture: Fixture, target: Optional[str]) -> dict:
+    """Runs a stage in a fresh process and returns its measurements."""
+    ctx = multiprocessing.get_context('spawn')
+    parent_conn, child_conn = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_stage_process, args=(name, fixture, target, child_conn))
+    proc.start()
+    child_conn.close()
+    result = parent_conn.recv()
+    proc.join()
+
+    if 'error' in result:
+        return {'stage': name, 'error': result['error']}
+
+    seconds = result['seconds']
+    return {
+        'stage': name,
+        'seconds': round(seconds, 3),
+        'bytes': result['bytes'],
+        'mb_per_s': round(result['bytes'] / 1024 / 1024 / seconds, 2),
+        'lines_per_s': round(fixture.lines / seconds),
+        'peak_rss_mb': round(result['peak_rss'] / 1024 / 1024, 1),
+    }
+
+
+def _stage_process(name: str, fixture: Fixture, target: Optional[str], conn):
+    try:
+        start = time.perf_counter()
+        processed = STAGES[name](fixture, target)
+        seconds = time.perf_counter() - start
+        conn.send({'seconds': seconds, 'bytes': processed, 'peak_rss': _peak_rss()})
+    except Exception as e:
+        conn.send({'error': f'{type(e).__name__}: {e}'})
+    finally:
+        conn.close()
+
+
+def _peak_rss() -> int:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak if platform.system() == 'Darwin' else peak * 1024
+
+
+async def _read_chunks(path: str):
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+            yield chunk
+            await asyncio.sleep(0)
+
+
+async def _decompressed(chunks):
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    async for chunk in chunks:
+        yield decompressor.decompress(chunk)
+    yield decompressor.flush()
+
+
+async def _consume(items):
+    async for _ in items:
+        pass
+
+
+def _random_text(rand: random.Random, width: int) -> bytes:
+    alphabet = b'abcdefghijklmnopqrstuvwxyz ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+    return bytes(rand.choice(alphabet) for _ in range(width))
+
+
+def _git_revision() -> Optional[str]:
+    try:
+        return (
+            subprocess.check_output(
+                ['git', 'rev-parse', '--short', 'HEAD'],
+                cwd=package,
+                stderr=subprocess.DEVNULL,
+            )
+            .decode('utf-8')
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results: List[dict], baseline: Optional[Dict[str, dict]] = None):
+    header = f'{"stage":<10} {"seconds":>8} {"MB/s":>9} {"lines/s":>11} {"RSS MB":>8}'
+    if baseline:
+        header += f' {"vs base":>8}'
+    print(header)
+
+    for result in results:
+        if 'error' in result:
+            print(f'{result["stage"]:<10} {result["error"]}')
+            continue
+        line = (
+            f'{result["stage"]:<10} {result["seconds"]:>8.2f} '
+            f'{result["mb_per_s"]:>9.2f} {result["lines_per_s"]:>11} '
+            f'{result["peak_rss_mb"]:>8.1f}'
+        )
+        base = (baseline or {}).get(result['stage'])
+        if base and 'mb_per_s' in base:
+            change = (result['mb_per_s'] / base['mb_per_s'] - 1) * 100
+            line += f' {change:>+7.1f}%'
+        print(line)
+
+
+def main(arguments: dict):
+    stages = arguments['-s'].split(',')
+    unknown = [name for name in stages if name not in STAGES]
+    if unknown:
+        sys.exit(f'Unknown stages: {", ".join(unknown)}')
+
+    params = {
+        'size': int(float(arguments['--size']) * 1024 * 1024),
+        'tables': int(arguments['--tables']),
+        'columns': int(arguments['--columns']),
+        'width': int(arguments['--row-width']),
+        'nulls': float(arguments['--nulls']),
+    }
+
+    with tempfile.TemporaryDirectory(prefix='voleur-bench-') as workdir:
+        fixture = Fixture(workdir)
+        fixture.generate(**params)
+        print(
+            f'Dump: {utils.format_size(fixture.raw_bytes)} '
+            f'({utils.format_size(fixture.dump_bytes)} compressed), '
+            f'{fixture.lines} lines\n'
+        )
+        results = [run_stage(name, fixture, arguments['--target']) for name in stages]
+
+    baseline = None
+    if arguments['--compare']:
+        with open(arguments['--compare']) as f:
+            baseline = {r['stage']: r for r in json.load(f)['results']}
+    print_results(results, baseline)
+
+    if arguments['--json']:
+        report = {
+            'revision': _git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'params': params,
+            'dump': {
+                'bytes': fixture.raw_bytes,
+                'compressed_bytes': fixture.dump_bytes,
+                'lines': fixture.lines,
+            },
+            'results': results,
+        }
+        with open(arguments['--json'], 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main(docopt(__doc__))
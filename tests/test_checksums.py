@@ -0,0 +1,66 @@
+import asyncio
+
+import pytest
+
+from voleur import checksums
+
+
+def get_checksum(data: bytes, chunk_size: int):
+    digest = checksums.Digest(chunk_size)
+    digest.update(data)
+    return digest.result()
+
+
+async def iter_chunks(data: bytes, size: int):
+    for i in range(0, len(data), size):
+        yield data[i : i + size]
+
+
+def verify(chunks, checksum):
+    """Returns the chunks passed on by `verify`, and its error if any."""
+    received = []
+
+    async def run():
+        async for chunk in checksums.verify(chunks, checksum):
+            received.append(chunk)
+
+    try:
+        asyncio.new_event_loop().run_until_complete(run())
+    except checksums.ChecksumError as e:
+        return received, e
+    return received, None
+
+
+@pytest.mark.parametrize('size', [1, 3, 10, 11, 100])
+def test_verify_passes_stream_through(size):
+    data = bytes(range(95))
+
+    received, error = verify(iter_chunks(data, size), get_checksum(data, 10))
+
+    assert error is None
+    assert b''.join(received) == data
+
+
+def test_verify_without_checksum():
+    received, error = verify(iter_chunks(b'abc', 1), None)
+
+    assert (received, error) == ([b'a', b'b', b'c'], None)
+
+
+def test_verify_holds_back_corrupt_chunk():
+    data = bytes(range(95))
+    corrupt = data[:25] + b'x' + data[26:]
+
+    received, error = verify(iter_chunks(corrupt, 3), get_checksum(data, 10))
+
+    assert 'chunk 2 (at byte 20)' in str(error)
+    assert b''.join(received) == data[:20]
+
+
+def test_verify_rejects_truncated_stream():
+    data = bytes(range(95))
+
+    received, error = verify(iter_chunks(data[:90], 7), get_checksum(data, 10))
+
+    assert 'Expected 95 bytes, got 90' in str(error)
+    assert b''.join(received) == data[:90]
@@ -0,0 +1,160 @@
+import gzip
+import os
+
+import pytest
+
+from voleur import checksums, cli, cmd, localstore, models, repo, storage
+
+
+BUCKET = 'stash'
+
+
+class FakeS3(storage.LocalFS):
+    """Stands in for S3 with files under the working directory, failing the reads of
+    the stash metadata while `fail` is set."""
+
+    def __init__(self):
+        self.fail = False
+
+    def read_if_modified(self, path, etag=None):
+        if self.fail:
+            raise storage.StorageError('Service unavailable')
+        return super().read_if_modified(path, etag)
+
+
+class StopWatching(Exception):
+    pass
+
+
+@pytest.fixture
+def s3(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(repo, 'CACHE_DIR', str(tmp_path / 'cache' / 'voleur'))
+    backend = FakeS3()
+    monkeypatch.setitem(storage._backends, 's3', backend)
+    os.makedirs(BUCKET)
+    return backend
+
+
+def add_dump(stash: models.Stash, dump_id: str, data: bytes, tag: str = 'latest'):
+    compressed = gzip.compress(data)
+    path = f'{BUCKET}/{dump_id}.dump.gz'
+    with open(path, 'wb') as f:
+        f.write(compressed)
+    digest = checksums.Digest()
+    digest.update(compressed)
+    stash.dumps.append(
+        models.Dump(
+            dump_id=dump_id,
+            timestamp=1.0,
+            storage_url=f's3://{path}',
+            checksum=digest.result(),
+            tables=[models.TableStats(table='public.t', size=len(data), rows=1)],
+        )
+    )
+    stash.tags[tag] = dump_id
+
+
+def make_env(tmp_path, *tags: str, **args) -> cli.Env:
+    arguments = {'<tag>': list(tags), '-b': BUCKET, '--dump-dir': str(tmp_path / 'dumps')}
+    arguments.update(args)
+    return cli.Env(arguments)
+
+
+def get_local_dumps(tmp_path, stash: models.Stash) -> set:
+    """Returns the ids of the dumps of the stash verified in the local store."""
+    directory = str(tmp_path / 'dumps')
+    return {
+        dump.dump_id
+        for dump in stash.dumps
+        if localstore.find(directory, dump.dump_id, dump.checksum)
+    }
+
+
+def test_prefetch(s3, tmp_path):
+    stash = models.Stash(bucket=BUCKET)
+    add_dump(stash, 'a', b'SELECT 1;\n', tag='old')
+    add_dump(stash, 'b', b'SELECT 2;\n')
+    repo.StashRepo.save(stash)
+
+    cmd.prefetch(make_env(tmp_path, 'old', 'latest'))
+
+    assert get_local_dumps(tmp_path, stash) == {'a', 'b'}
+    path = localstore.get_path(str(tmp_path / 'dumps'), 'b')
+    with open(path, 'rb') as f:
+        assert f.read() == b'SELECT 2;\n'
+
+
+def test_prefetch_fails_for_missing_and_corrupt_dumps(s3, tmp_path):
+    stash = models.Stash(bucket=BUCKET)
+    add_dump(stash, 'a', b'SELECT 1;\n')
+    add_dump(stash, 'b', b'SELECT 2;\n', tag='other')
+    with open(f'{BUCKET}/b.dump.gz', 'ab') as f:
+        f.write(b'garbage')
+    repo.StashRepo.save(stash)
+
+    with pytest.raises(SystemExit):
+        cmd.prefetch(make_env(tmp_path, 'latest', 'other', 'missing'))
+
+    # The good dump is still prefetched, and no partial dump is left behind.
+    assert get_local_dumps(tmp_path, stash) == {'a'}
+    assert sorted(os.listdir(tmp_path / 'dumps')) == ['a.dump', 'a.verified']
+
+
+def test_prefetch_watch_keeps_going_past_errors(s3, tmp_path, monkeypatch, capsys):
+    stash = models.Stash(bucket=BUCKET)
+    add_dump(stash, 'a', b'SELECT 1;\n')
+    repo.StashRepo.save(stash)
+    polls: list = []
+
+    def sleep(seconds):
+        polls.append(get_local_dumps(tmp_path, stash))
+        if len(polls) == 1:
+            # S3 fails the next poll.
+            s3.fail = True
+        elif len(polls) == 2:
+            # The tag moves, to a dump whose download fails.
+            s3.fail = False
+            add_dump(stash, 'b', b'SELECT 2;\n')
+            os.remove(f'{BUCKET}/b.dump.gz')
+            repo.StashRepo.save(stash)
+        elif len(polls) == 3:
+            # The tag moves again.
+            add_dump(stash, 'c', b'SELECT 3;\n')
+            repo.StashRepo.save(stash)
+        else:
+            raise StopWatching()
+
+    monkeypatch.setattr(cmd.time, 'sleep', sleep)
+    env = make_env(tmp_path, 'latest', **{'--watch': True, '--max-size': '10'})
+
+    with pytest.raises(StopWatching):
+        cmd.prefetch(env)
+
+    # The old dump is evicted to make room for the new one, even though its download
+    # then fails.
+    assert polls == [{'a'}, {'a'}, set(), {'c'}]
+    output = capsys.readouterr().out
+    assert 'Cannot load the stash: Service unavailable' in output
+    assert 'Prefetch of dump b failed' in output
+    assert 'Evicted local dump: a' in output
+
+
+def test_prefetch_dump_skips_verified_dump(s3, tmp_path):
+    stash = models.Stash(bucket=BUCKET)
+    add_dump(stash, 'a', b'SELECT 1;\n')
+    repo.StashRepo.save(stash)
+    env = make_env(tmp_path, 'latest')
+    dump_dir = str(tmp_path / 'dumps')
+    os.makedirs(dump_dir)
+    limits = {'--max-rate': None, '--max-size': None}
+    dump = stash.dumps[0]
+
+    assert cmd._prefetch_dump(env, dump, dump_dir, ['a'], limits)
+    os.remove(f'{BUCKET}/a.dump.gz')
+    assert cmd._prefetch_dump(env, dump, dump_dir, ['a'], limits)
+
+    # A dump which wasn't verified, e.g truncated since, is downloaded again.
+    with open(localstore.get_path(dump_dir, 'a'), 'ab') as f:
+        f.write(b'--')
+    assert not cmd._prefetch_dump(env, dump, dump_dir, ['a'], limits)
@@ -0,0 +1,196 @@
+import asyncio
+import decimal
+from unittest import mock
+
+import pytest
+
+from voleur import dumper
+
+
+STRUCTURE = b'CREATE TABLE "a" (id text);\nCREATE TABLE "b" (id text);\n'
+POST_DATA = b'ALTER TABLE "b" ADD FOREIGN KEY (id) REFERENCES "a" (id);\n'
+
+
+async def iter_output(*chunks: bytes, delay: float = 0):
+    for chunk in chunks:
+        await asyncio.sleep(delay)
+        yield chunk
+
+
+def insert(table: str, value: int) -> bytes:
+    return b'INSERT INTO "%s" ("id") VALUES (\'%d\')\n' % (table.encode(), value)
+
+
+def merge(outputs, groups):
+    async def run():
+        return b''.join([chunk async for chunk in dumper._merge_shards(outputs, groups)])
+
+    return asyncio.new_event_loop().run_until_complete(run())
+
+
+def test_merge_shards_keeps_structure_once():
+    primary = iter_output(STRUCTURE, insert('a', 1), POST_DATA)
+    secondary = iter_output(STRUCTURE, insert('b', 2), POST_DATA)
+
+    dump = merge([primary, secondary], [['a'], ['b']])
+
+    assert dump.count(b'CREATE TABLE "a"') == 1
+    assert dump.count(POST_DATA) == 1
+    assert dump.startswith(STRUCTURE)
+
+
+def test_merge_shards_holds_back_post_data_until_all_shards_are_done():
+    primary = iter_output(STRUCTURE, insert('a', 1) + POST_DATA)
+    secondary = iter_output(
+        STRUCTURE, *(insert('b', i) for i in range(5)), POST_DATA, delay=0.01
+    )
+
+    dump = merge([primary, secondary], [['a'], ['b']])
+
+    assert dump.endswith(POST_DATA)
+    assert dump.count(b'INSERT INTO "b"') == 5
+
+
+def test_merge_shards_keeps_rows_of_unknown_tables_once():
+    # Table `c` wasn't partitioned, e.g created after the sizes were read, so neither
+    # shard's config ignores its data.
+    primary = iter_output(STRUCTURE, insert('a', 1) + insert('c', 3))
+    secondary = iter_output(STRUCTURE, insert('my table', 2) + insert('c', 3))
+
+    dump = merge([primary, secondary], [['a'], ['b', 'my table']])
+
+    assert dump.count(b'INSERT INTO "c"') == 1
+    assert dump.count(b'INSERT INTO "my table"') == 1
+    assert dump.count(b'INSERT INTO "a"') == 1
+
+
+def test_merge_shards_splits_chunks_into_lines():
+    data = STRUCTURE + insert('a', 1) + insert('a', 2) + POST_DATA
+    primary = iter_output(*(data[i : i + 7] for i in range(0, len(data), 7)))
+    secondary = iter_output(STRUCTURE + insert('b', 3))
+
+    dump = merge([primary, secondary], [['a'], ['b']])
+
+    assert sorted(dump.splitlines(keepends=True)) == sorted(
+        STRUCTURE.splitlines(keepends=True) + [insert('a', 1), insert('a', 2)]
+        + [insert('b', 3), POST_DATA]
+    )
+    assert dump.endswith(POST_DATA)
+
+
+def test_merge_shards_raises_shard_error():
+    async def failing():
+        yield STRUCTURE
+        raise dumper.DumperError('boom')
+
+    primary = iter_output(STRUCTURE, insert('a', 1), delay=0.01)
+
+    with pytest.raises(dumper.DumperError):
+        merge([primary, failing()], [['a'], ['b']])
+
+
+PG_PRE_DATA = b"""--
+-- PostgreSQL database dump
+--
+
+CREATE TABLE "a" (id text);
+CREATE TABLE "b" (id text);
+
+--
+-- PostgreSQL database dump complete
+--
+
+"""
+
+PG_POST_DATA = b"""--
+-- PostgreSQL database dump
+--
+
+CREATE INDEX "a_id" ON "a" (id);
+ALTER TABLE "b" ADD FOREIGN KEY (id) REFERENCES "a" (id);
+
+--
+-- PostgreSQL database dump complete
+--
+
+"""
+
+
+def test_merge_shards_holds_back_post_data_of_primary_without_rows():
+    # The first shard only has empty tables, so its structure runs into its post-data.
+    primary = iter_output(PG_PRE_DATA + PG_POST_DATA)
+    secondary = iter_output(
+        PG_PRE_DATA, *(insert('b', i) for i in range(5)), PG_POST_DATA, delay=0.01
+    )
+
+    dump = merge([primary, secondary], [['a'], ['b']])
+
+    assert dump.count(b'CREATE INDEX') == 1
+    assert dump.startswith(PG_PRE_DATA)
+    assert dump.endswith(PG_POST_DATA[PG_POST_DATA.index(b'-- PostgreSQL') :])
+    assert dump.count(b'INSERT INTO "b"') == 5
+    assert dump.index(b'INSERT INTO "b"') < dump.index(b'CREATE INDEX')
+
+
+def test_merge_shards_holds_back_post_data_after_rows():
+    primary = iter_output(PG_PRE_DATA, insert('a', 1), PG_POST_DATA)
+    secondary = iter_output(PG_PRE_DATA, insert('b', 2), PG_POST_DATA, delay=0.01)
+
+    dump = merge([primary, secondary], [['a'], ['b']])
+
+    assert dump.count(b'CREATE INDEX') == 1
+    assert dump.index(b'INSERT INTO "b"') < dump.index(b'CREATE INDEX')
+
+
+class FakeConnection:
+    def __init__(self, rows):
+        self.rows = rows
+        self.executed: list = []
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql):
+        self.executed.append(sql)
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+def test_get_table_sizes_covers_every_schema():
+    conn = FakeConnection([('users', decimal.Decimal(8192)), ('events', 0)])
+
+    with mock.patch('psycopg2.connect', lambda _: conn):
+        sizes = dumper._get_table_sizes('postgresql://source')
+
+    assert sizes == {'users': 8192, 'events': 0}
+    assert all(type(size) is int for size in sizes.values())
+    assert "nspname = 'public'" not in conn.executed[0]
+    assert 'GROUP BY c.relname' in conn.executed[0]
+
+
+def test_partition_tables():
+    groups = dumper.partition_tables({'a': 100, 'b': 60, 'c': 50, 'd': 10, 'e': 0}, 2)
+
+    assert groups == [['a', 'd', 'e'], ['b', 'c']]
+    assert dumper.partition_tables({'a': 1}, 3) == [['a']]
+
+
+def test_make_shard_config():
+    config = '[Anonymise]\n\n[[Tables]]\n  Name = "a"\n  IgnoreData = false\n'
+
+    shard_config = dumper.make_shard_config(config, {'a', 'b'})
+
+    assert shard_config == (
+        '[Anonymise]\n\n[[Tables]]\n  IgnoreData = true\n  Name = "a"\n'
+        '\n[[Tables]]\n  Name = "b"\n  IgnoreData = true\n'
+    )
@@ -0,0 +1,126 @@
+import os
+
+from voleur import localstore, models
+
+
+def make_dump(tmp_path, content=b'dump') -> str:
+    path = localstore.get_path(str(tmp_path), 'a')
+    with open(path, 'wb') as f:
+        f.write(content)
+    return path
+
+
+CHECKSUM = models.Checksum(size=10, sha256='0' * 64, chunk_size=4)
+
+
+def test_find_requires_verified_dump(tmp_path):
+    path = make_dump(tmp_path)
+
+    assert localstore.find(str(tmp_path), 'a', CHECKSUM) is None
+    localstore.mark_verified(str(tmp_path), 'a', CHECKSUM)
+    assert localstore.find(str(tmp_path), 'a', CHECKSUM) == path
+
+
+def test_find_skips_dump_changed_since_verified(tmp_path):
+    make_dump(tmp_path)
+    localstore.mark_verified(str(tmp_path), 'a', CHECKSUM)
+    make_dump(tmp_path, b'du')
+
+    assert localstore.find(str(tmp_path), 'a', CHECKSUM) is None
+
+
+def test_find_skips_dump_verified_against_another_checksum(tmp_path):
+    make_dump(tmp_path)
+    localstore.mark_verified(str(tmp_path), 'a', CHECKSUM)
+    other = models.Checksum(size=10, sha256='1' * 64, chunk_size=4)
+
+    assert localstore.find(str(tmp_path), 'a', other) is None
+    assert localstore.find(str(tmp_path), 'a') is None
+
+
+def test_find_dump_without_checksum(tmp_path):
+    path = make_dump(tmp_path)
+    localstore.mark_verified(str(tmp_path), 'a')
+
+    assert localstore.find(str(tmp_path), 'a') == path
+
+
+def test_find_skips_unreadable_marker(tmp_path):
+    make_dump(tmp_path)
+    (tmp_path / ('a' + localstore.VERIFIED_SUFFIX)).write_text('{"size": ')
+
+    assert localstore.find(str(tmp_path), 'a') is None
+
+
+def add_dump(tmp_path, dump_id: str, size: int, used_at: float) -> str:
+    path = localstore.get_path(str(tmp_path), dump_id)
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+    os.utime(path, (used_at, used_at))
+    return path
+
+
+def test_get_dumps_least_recently_used_first(tmp_path):
+    add_dump(tmp_path, 'b', 2, used_at=200)
+    add_dump(tmp_path, 'a', 1, used_at=300)
+    add_dump(tmp_path, 'c', 3, used_at=100)
+    (tmp_path / 'c.dump.partial').write_bytes(b'x')
+
+    assert localstore.get_dumps(str(tmp_path)) == [
+        ('c', 3, 100),
+        ('b', 2, 200),
+        ('a', 1, 300),
+    ]
+
+
+def test_touch_marks_dump_as_used(tmp_path):
+    path = add_dump(tmp_path, 'a', 1, used_at=100)
+    add_dump(tmp_path, 'b', 1, used_at=200)
+
+    localstore.touch(path)
+    localstore.touch(str(tmp_path / 'missing.dump'))
+
+    assert [dump_id for dump_id, _, _ in localstore.get_dumps(str(tmp_path))] == [
+        'b',
+        'a',
+    ]
+
+
+def test_evict_least_recently_used(tmp_path):
+    add_dump(tmp_path, 'a', 10, used_at=100)
+    add_dump(tmp_path, 'b', 10, used_at=200)
+    add_dump(tmp_path, 'c', 10, used_at=300)
+    localstore.mark_verified(str(tmp_path), 'a')
+
+    assert localstore.evict(str(tmp_path), max_size=25) == ['a']
+    assert sorted(os.listdir(tmp_path)) == ['b.dump', 'c.dump']
+    assert localstore.evict(str(tmp_path), max_size=20) == []
+
+
+def test_evict_makes_room_for_reserve(tmp_path):
+    add_dump(tmp_path, 'a', 10, used_at=100)
+    add_dump(tmp_path, 'b', 10, used_at=200)
+    add_dump(tmp_path, 'c', 10, used_at=300)
+
+    assert localstore.evict(str(tmp_path), max_size=30, reserve=15) == ['a', 'b']
+
+
+def test_evict_keeps_given_dumps(tmp_path):
+    add_dump(tmp_path, 'a', 10, used_at=100)
+    add_dump(tmp_path, 'b', 10, used_at=200)
+    add_dump(tmp_path, 'c', 10, used_at=300)
+
+    assert localstore.evict(str(tmp_path), max_size=15, keep=['a']) == ['b', 'c']
+    # Still over the limit, rather than evicting a dump to keep.
+    assert localstore.evict(str(tmp_path), max_size=5, keep=['a']) == []
+    assert os.listdir(tmp_path) == ['a.dump']
+
+
+def test_clean_removes_partial_downloads(tmp_path):
+    add_dump(tmp_path, 'a', 1, used_at=100)
+    localstore.mark_verified(str(tmp_path), 'a')
+    (tmp_path / 'b.dump.x1y2z3').write_bytes(b'partial')
+
+    localstore.clean(str(tmp_path))
+
+    assert sorted(os.listdir(tmp_path)) == ['a.dump', 'a.verified']
@@ -0,0 +1,202 @@
+import asyncio
+from concurrent import futures
+from unittest import mock
+
+import pytest
+
+from voleur import mapped, writer
+
+
+DUMP = b"""SET client_encoding = 'UTF8';
+CREATE TABLE public.a (x text);
+INSERT INTO public.a (x) VALUES ('1');
+INSERT INTO public.a (x) VALUES ('2');
+INSERT INTO public.a (x) VALUES ('3');
+SET search_path = public;
+CREATE INDEX a_x ON public.a (x);
+"""
+
+
+class FakeConnection:
+    """Records the statements executed over a connection."""
+
+    def __init__(self, target: str, connections: dict):
+        self.autocommit = False
+        self.executed: list = []
+        connections.setdefault(target, []).append(self)
+
+    def cursor(self):
+        return self
+
+    def execute(self, statement):
+        self.executed.append(statement.strip())
+
+    def copy_expert(self, statement, f, size):
+        self.executed.append(statement.strip())
+        f.read()
+
+
+@pytest.fixture
+def connections(monkeypatch):
+    """Runs the worker functions in this process, over fake connections."""
+    connections: dict = {}
+    monkeypatch.setattr(mapped, '_worker_buf', DUMP)
+    monkeypatch.setattr(mapped, '_worker_conns', {})
+    monkeypatch.setattr(mapped, '_worker_sessions', {})
+    with mock.patch(
+        'psycopg2.connect', side_effect=lambda target: FakeConnection(target, connections)
+    ):
+        yield connections
+
+
+def get_text(buf: bytes, piece: mapped.Piece) -> bytes:
+    return buf[piece.start : piece.end]
+
+
+def test_index_dump():
+    pieces = mapped.index_dump(DUMP)
+
+    assert [(p.table, p.session) for p in pieces] == [
+        (None, True),
+        (None, False),
+        ('public.a', False),
+        (None, True),
+        (None, False),
+    ]
+    assert get_text(DUMP, pieces[2]).count(b'INSERT') == 3
+    assert pieces[0].start == 0
+    assert pieces[-1].end == len(DUMP.rstrip())
+    assert all(a.end == b.start for a, b in zip(pieces, pieces[1:]))
+
+
+def test_index_dump_splits_tables_by_piece_size():
+    insert = b"INSERT INTO public.a (x) VALUES ('1');\n"
+    piece_size = len(insert) * 2
+
+    pieces = mapped.index_dump(insert * 6, piece_size=piece_size)
+
+    # A piece is cut at the first statement boundary past the size.
+    assert len(pieces) == 3
+    assert all(p.size >= piece_size for p in pieces[:-1])
+    assert sum(p.size for p in pieces) == len((insert * 6).rstrip())
+    assert {p.table for p in pieces} == {'public.a'}
+
+
+def test_index_dump_keeps_unterminated_tail():
+    pieces = mapped.index_dump(b'CREATE TABLE a (x text);\nSELECT 1')
+
+    assert len(pieces) == 1
+    assert pieces[0].end == len(b'CREATE TABLE a (x text);\nSELECT 1')
+
+
+def test_index_dump_table_names_in_other_encodings():
+    (piece,) = mapped.index_dump(b"INSERT INTO public.caf\xe9 (x) VALUES ('1');\n")
+
+    assert piece.table == 'public.caf�'
+
+
+def test_index_file(tmp_path):
+    path = tmp_path / 'a.dump'
+    path.write_bytes(DUMP)
+    (tmp_path / 'empty.dump').write_bytes(b'')
+
+    assert mapped.index_file(str(path)) == mapped.index_dump(DUMP)
+    assert mapped.index_file(str(tmp_path / 'empty.dump')) == []
+
+
+def test_iter_phases():
+    a1, a2 = mapped.Piece(0, 1, 'a'), mapped.Piece(1, 2, 'a')
+    b = mapped.Piece(2, 3, 'b')
+    create, index = mapped.Piece(3, 4), mapped.Piece(5, 6)
+    session = mapped.Piece(4, 5, session=True)
+
+    phases = list(mapped._iter_phases([create, a1, a2, b, session, index, b]))
+
+    assert phases == [[create], [a1, a2, b], [session], [index], [b]]
+    assert list(mapped._iter_phases([])) == []
+
+
+def test_get_connection_replays_session(connections):
+    pieces = mapped.index_dump(DUMP)
+    first = ((pieces[0].start, pieces[0].end),)
+    both = first + ((pieces[3].start, pieces[3].end),)
+
+    conn = mapped._get_connection('db', first)
+    assert conn.autocommit
+    assert conn.executed == [b"SET client_encoding = 'UTF8';"]
+
+    assert mapped._get_connection('db', first) is conn
+    assert mapped._get_connection('db', both) is conn
+    # Each session piece is run once, in order.
+    assert conn.executed == [
+        b"SET client_encoding = 'UTF8';",
+        b'SET search_path = public;',
+    ]
+
+    other = mapped._get_connection('other', both)
+    assert other.executed == conn.executed
+
+
+def test_write_piece(connections):
+    pieces = mapped.index_dump(DUMP)
+    session = ((pieces[0].start, pieces[0].end),)
+
+    rows = mapped._write_piece('db', pieces[2].start, pieces[2].end, session)
+
+    assert rows == 3
+    (conn,) = connections['db']
+    assert conn.executed[0] == b"SET client_encoding = 'UTF8';"
+    assert conn.executed[1].startswith(b'COPY public.a')
+
+
+def test_write_piece_skips_session_piece_run_before(connections):
+    pieces = mapped.index_dump(DUMP)
+    session = ((pieces[0].start, pieces[0].end),)
+
+    assert mapped._write_piece('db', pieces[0].start, pieces[0].end, session) == 0
+    assert connections['db'][0].executed == [b"SET client_encoding = 'UTF8';"]
+
+
+def restore_file(path, targets):
+    return asyncio.new_event_loop().run_until_complete(
+        mapped.restore_file(str(path), targets, workers=2)
+    )
+
+
+@pytest.fixture
+def threads(monkeypatch, connections):
+    """Runs the workers in threads of this process."""
+    monkeypatch.setattr(mapped.futures, 'ProcessPoolExecutor', futures.ThreadPoolExecutor)
+    return connections
+
+
+def test_restore_file(tmp_path, threads):
+    path = tmp_path / 'a.dump'
+    path.write_bytes(DUMP)
+
+    errors = restore_file(path, ['db'])
+
+    assert errors == {'db': None}
+    executed = [s for conn in threads['db'] for s in conn.executed]
+    assert executed[-1] == b'CREATE INDEX a_x ON public.a (x);'
+
+
+def test_restore_file_isolates_any_error_per_target(tmp_path, threads, monkeypatch):
+    path = tmp_path / 'a.dump'
+    path.write_bytes(DUMP)
+    write_piece = mapped._write_piece
+
+    def fail_bad(target, *args):
+        if target == 'bad':
+            raise UnicodeDecodeError('utf-8', b'\xe9', 0, 1, 'invalid byte')
+        return write_piece(target, *args)
+
+    monkeypatch.setattr(mapped, '_write_piece', fail_bad)
+
+    errors = restore_file(path, ['good', 'bad'])
+
+    assert errors['good'] is None
+    assert isinstance(errors['bad'], writer.WriterError)
+    assert 'invalid byte' in str(errors['bad'])
+    executed = [s for conn in threads['good'] for s in conn.executed]
+    assert executed[-1] == b'CREATE INDEX a_x ON public.a (x);'
@@ -0,0 +1,88 @@
+import json
+
+from voleur import metrics as metrics_
+
+
+def make_metrics() -> metrics_.Metrics:
+    metrics = metrics_.Metrics('restore')
+    parse = metrics.stage('parse')
+    parse.start()
+    parse.bytes_in, parse.bytes_out, parse.lines = 100, 80, 4
+    parse.add_rows('public."Users"', 2)
+    parse.add_rows('public."Users"', 1)
+    parse.add_rows('public.a\\b', 5)
+    parse.blocked_input_seconds = 0.25
+    metrics.queue('parse->write', 4).set_depth(3)
+    metrics.finish()
+    return metrics
+
+
+def test_stage_rows_are_summed():
+    metrics = make_metrics()
+
+    assert metrics.stage('parse').rows == {'public."Users"': 3, 'public.a\\b': 5}
+
+
+def test_queue_records_max_depth():
+    queue = metrics_.QueueMetrics(name='q', maxsize=4)
+    queue.set_depth(3)
+    queue.set_depth(1)
+
+    assert (queue.depth, queue.max_depth) == (1, 3)
+
+
+def test_to_dict():
+    result = make_metrics().to_dict()
+
+    assert result['command'] == 'restore'
+    assert result['queues'] == [{'name': 'parse->write', 'maxsize': 4, 'max_depth': 3}]
+    (stage,) = result['stages']
+    assert stage['name'] == 'parse'
+    assert (stage['bytes_in'], stage['bytes_out'], stage['lines']) == (100, 80, 4)
+    assert stage['rows'] == {'public."Users"': 3, 'public.a\\b': 5}
+    assert stage['blocked_input_seconds'] == 0.25
+
+
+def test_to_prometheus():
+    lines = make_metrics().to_prometheus().splitlines()
+
+    assert '# TYPE voleur_stage_bytes_in_total counter' in lines
+    assert 'voleur_stage_bytes_in_total{command="restore",stage="parse"} 100' in lines
+    assert 'voleur_queue_max_depth{command="restore",queue="parse->write"} 3' in lines
+    assert (
+        'voleur_stage_blocked_seconds_total'
+        '{command="restore",stage="parse",side="input"} 0.25'
+    ) in lines
+
+
+def test_to_prometheus_escapes_labels():
+    lines = make_metrics().to_prometheus().splitlines()
+
+    assert (
+        'voleur_stage_rows_total{command="restore",stage="parse",'
+        'table="public.\\"Users\\""} 3'
+    ) in lines
+    assert (
+        'voleur_stage_rows_total{command="restore",stage="parse",'
+        'table="public.a\\\\b"} 5'
+    ) in lines
+
+
+def test_escape_label():
+    assert metrics_._escape_label('a"b\\c\nd') == 'a\\"b\\\\c\\nd'
+
+
+def test_write_picks_format_from_extension(tmp_path):
+    metrics = make_metrics()
+
+    metrics.write(str(tmp_path / 'metrics.json'))
+    metrics.write(str(tmp_path / 'metrics.prom'))
+
+    assert json.loads((tmp_path / 'metrics.json').read_text()) == metrics.to_dict()
+    assert (tmp_path / 'metrics.prom').read_text() == metrics.to_prometheus()
+
+
+def test_summary():
+    summary = make_metrics().summary()
+
+    assert summary == 'parse 80.0 B 4 lines 8 rows | queues 3/4'
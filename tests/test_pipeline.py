@@ -0,0 +1,194 @@
+import asyncio
+import gzip
+import os
+
+import pytest
+
+from voleur import checksums, pipeline
+
+
+DUMP = b"INSERT INTO public.a (x) VALUES ('1');\n" * 1000
+
+
+def checksum_of(data: bytes):
+    digest = checksums.Digest(chunk_size=1024)
+    digest.update(data)
+    return digest.result()
+
+
+def write_stashed(tmp_path, data: bytes = DUMP) -> str:
+    """Writes a compressed dump as it's stashed, returning its storage URL."""
+    path = tmp_path / 'stash' / 'a.dump.gz'
+    path.parent.mkdir()
+    path.write_bytes(gzip.compress(data))
+    return f'file://{path}'
+
+
+def run(main):
+    return asyncio.new_event_loop().run_until_complete(main)
+
+
+async def produce(channel: pipeline.Channel, items):
+    for item in items:
+        await channel.put(item)
+    await channel.close()
+
+
+async def collect(channel: pipeline.Channel):
+    return [item async for item in channel]
+
+
+def test_channel_yields_items_until_closed():
+    async def main():
+        channel = pipeline.Channel(maxsize=1)
+        return await pipeline.run_stages(produce(channel, [b'a', b'b']), collect(channel))
+
+    assert run(main()) == [None, [b'a', b'b']]
+
+
+def test_run_stages_cancels_the_rest_when_a_stage_fails():
+    cancelled = []
+
+    async def fail():
+        raise ValueError('boom')
+
+    async def wait():
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    with pytest.raises(ValueError, match='boom'):
+        run(pipeline.run_stages(wait(), fail()))
+    assert cancelled == [True]
+
+
+def test_run_stages_raises_the_first_error_in_stage_order():
+    async def fail(message):
+        raise ValueError(message)
+
+    with pytest.raises(ValueError, match='first'):
+        run(pipeline.run_stages(fail('first'), fail('second')))
+
+
+def test_compress_writes_gzip():
+    async def main():
+        source, compressed = pipeline.Channel(), pipeline.Channel()
+        _, _, chunks = await pipeline.run_stages(
+            produce(source, [DUMP[:100], DUMP[100:]]),
+            pipeline.compress(source, compressed),
+            collect(compressed),
+        )
+        return b''.join(chunks)
+
+    assert gzip.decompress(run(main())) == DUMP
+
+
+def test_decompress_reads_gzip():
+    compressed = gzip.compress(DUMP)
+
+    async def main():
+        source, decompressed = pipeline.Channel(), pipeline.Channel()
+        *_, chunks = await pipeline.run_stages(
+            produce(source, [compressed[:10], compressed[10:]]),
+            pipeline.decompress(source, decompressed),
+            collect(decompressed),
+        )
+        return b''.join(chunks)
+
+    assert run(main()) == DUMP
+
+
+def test_throttle(monkeypatch):
+    clock = [0.0]
+    sleeps: list = []
+
+    async def sleep(seconds):
+        sleeps.append(seconds)
+        clock[0] += seconds
+
+    monkeypatch.setattr(pipeline.time, 'monotonic', lambda: clock[0])
+    monkeypatch.setattr(pipeline.asyncio, 'sleep', sleep)
+
+    async def source():
+        for size in (10, 10, 30):
+            yield b'x' * size
+
+    async def run():
+        return [chunk async for chunk in pipeline.throttle(source(), max_rate=10)]
+
+    chunks = asyncio.new_event_loop().run_until_complete(run())
+
+    assert [len(chunk) for chunk in chunks] == [10, 10, 30]
+    # Ahead of the rate by the time each chunk takes at 10 bytes per second.
+    assert sleeps == [1.0, 1.0, 3.0]
+
+
+def test_throttle_does_not_sleep_behind_the_rate(monkeypatch):
+    clock = [0.0]
+    sleeps: list = []
+
+    async def sleep(seconds):
+        sleeps.append(seconds)
+
+    async def source():
+        for _ in range(3):
+            # Slower than the rate.
+            clock[0] += 2
+            yield b'x' * 10
+
+    monkeypatch.setattr(pipeline.time, 'monotonic', lambda: clock[0])
+    monkeypatch.setattr(pipeline.asyncio, 'sleep', sleep)
+
+    async def run():
+        return [chunk async for chunk in pipeline.throttle(source(), max_rate=10)]
+
+    asyncio.new_event_loop().run_until_complete(run())
+
+    assert sleeps == []
+
+
+def test_download(tmp_path):
+    storage_url = write_stashed(tmp_path)
+    path = str(tmp_path / 'a.dump')
+
+    size = pipeline.run(
+        pipeline.download(
+            storage_url,
+            path,
+            checksum=checksum_of(gzip.compress(DUMP)),
+            max_rate=10 * 1024 * 1024,
+        )
+    )
+
+    assert size == len(DUMP)
+    with open(path, 'rb') as f:
+        assert f.read() == DUMP
+    assert sorted(os.listdir(tmp_path)) == ['a.dump', 'stash']
+
+
+def test_download_corrupt_dump_leaves_no_file(tmp_path):
+    storage_url = write_stashed(tmp_path)
+    path = str(tmp_path / 'a.dump')
+    checksum = checksum_of(gzip.compress(DUMP + b'--\n'))
+
+    with pytest.raises(checksums.ChecksumError):
+        pipeline.run(pipeline.download(storage_url, path, checksum=checksum))
+
+    assert os.listdir(tmp_path) == ['stash']
+
+
+def test_download_replaces_file_once_complete(tmp_path):
+    storage_url = write_stashed(tmp_path)
+    path = tmp_path / 'a.dump'
+    path.write_bytes(b'old')
+    checksum = checksum_of(b'corrupt')
+
+    with pytest.raises(checksums.ChecksumError):
+        pipeline.run(pipeline.download(storage_url, str(path), checksum=checksum))
+    assert path.read_bytes() == b'old'
+
+    pipeline.run(pipeline.download(storage_url, str(path)))
+    assert path.read_bytes() == DUMP
+    assert sorted(os.listdir(tmp_path)) == ['a.dump', 'stash']
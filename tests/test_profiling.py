@@ -0,0 +1,29 @@
+import pstats
+import tracemalloc
+
+from voleur import cli, profiling
+
+
+def work():
+    return [bytes(1024) for _ in range(100)]
+
+
+def test_profile_writes_cpu_and_memory_profiles(tmp_path, capsys):
+    cpu_path = str(tmp_path / 'run.prof')
+    mem_path = str(tmp_path / 'run.snapshot')
+
+    with profiling.profile(cli.Env({}), cpu_path=cpu_path, mem_path=mem_path):
+        work()
+
+    stats = pstats.Stats(cpu_path)
+    assert any(func[2] == 'work' for func in stats.stats)  # type: ignore
+    assert tracemalloc.Snapshot.load(mem_path).traces
+    output = capsys.readouterr().out
+    assert cpu_path in output and mem_path in output
+
+
+def test_profile_without_paths_is_a_no_op(capsys):
+    with profiling.profile(cli.Env({})):
+        work()
+
+    assert capsys.readouterr().out == ''
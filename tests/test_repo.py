@@ -0,0 +1,148 @@
+import json
+import os
+
+import pytest
+
+from voleur import models, repo, storage
+
+
+BUCKET = 'stash'
+
+
+class FakeS3(storage.LocalFS):
+    """Stands in for S3 with files under the working directory, recording the ETags
+    passed to `read_if_modified`."""
+
+    def __init__(self):
+        self.etags: list = []
+
+    def read_if_modified(self, path, etag=None):
+        self.etags.append(etag)
+        return super().read_if_modified(path, etag)
+
+
+@pytest.fixture
+def s3(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(repo, 'CACHE_DIR', str(tmp_path / 'cache' / 'voleur'))
+    backend = FakeS3()
+    monkeypatch.setitem(storage._backends, 's3', backend)
+    return backend
+
+
+def make_stash(*dump_ids: str) -> models.Stash:
+    dumps = [
+        models.Dump(dump_id=i, timestamp=1.0, storage_url=f's3://{BUCKET}/{i}')
+        for i in dump_ids
+    ]
+    return models.Stash(bucket=BUCKET, dumps=dumps, tags={'latest': dump_ids[-1]})
+
+
+def get_cache_path() -> str:
+    return repo._get_cache_path(BUCKET)
+
+
+def test_load_missing_stash(s3):
+    stash = repo.StashRepo.load(BUCKET)
+
+    assert stash == models.Stash(bucket=BUCKET)
+    assert not os.path.exists(get_cache_path())
+
+
+def test_load_caches_metadata(s3):
+    repo.StashRepo.save(make_stash('a'))
+
+    stash = repo.StashRepo.load(BUCKET)
+
+    assert stash == make_stash('a')
+    with open(get_cache_path()) as f:
+        cached = json.load(f)
+    assert cached['stash'] == repo.marshal_stash(make_stash('a'))
+    assert cached['etag']
+
+
+def test_load_revalidates_cache_by_etag(s3):
+    repo.StashRepo.save(make_stash('a'))
+    repo.StashRepo.load(BUCKET)
+
+    stash = repo.StashRepo.load(BUCKET)
+
+    assert stash == make_stash('a')
+    assert s3.etags[0] is None
+    assert s3.etags[1] is not None
+
+
+def test_load_reads_modified_metadata(s3):
+    repo.StashRepo.save(make_stash('a'))
+    repo.StashRepo.load(BUCKET)
+    # Changed behind the cache's back, e.g by another host.
+    content = json.dumps(repo.marshal_stash(make_stash('a', 'b')))
+    storage.store('s3', f'{BUCKET}/_metadata.json', content)
+
+    assert repo.StashRepo.load(BUCKET) == make_stash('a', 'b')
+
+
+def test_load_within_max_age_skips_s3(s3):
+    repo.StashRepo.save(make_stash('a'))
+    repo.StashRepo.load(BUCKET)
+    os.remove(f'{BUCKET}/_metadata.json')
+
+    assert repo.StashRepo.load(BUCKET, max_age=60) == make_stash('a')
+    assert len(s3.etags) == 1
+
+
+def test_load_past_max_age_checks_s3(s3, monkeypatch):
+    repo.StashRepo.save(make_stash('a'))
+    repo.StashRepo.load(BUCKET)
+    monkeypatch.setattr(repo.time, 'time', lambda: 2 ** 40)
+
+    assert repo.StashRepo.load(BUCKET, max_age=60) == make_stash('a')
+    assert len(s3.etags) == 2
+
+
+@pytest.mark.parametrize(
+    'corrupt',
+    [
+        lambda cached: '{"etag": ',
+        lambda cached: json.dumps(dict(cached, stash={'bucket': 'other'})),
+        lambda cached: json.dumps({k: v for k, v in cached.items() if k != 'sha256'}),
+    ],
+)
+def test_corrupt_cache_is_a_miss(s3, corrupt):
+    repo.StashRepo.save(make_stash('a'))
+    repo.StashRepo.load(BUCKET)
+    with open(get_cache_path()) as f:
+        cached = json.load(f)
+    with open(get_cache_path(), 'w') as f:
+        f.write(corrupt(cached))
+
+    assert repo.StashRepo.load(BUCKET, max_age=60) == make_stash('a')
+    assert s3.etags[-1] is None
+
+
+def test_save_invalidates_cache(s3):
+    repo.StashRepo.save(make_stash('a'))
+    repo.StashRepo.load(BUCKET)
+
+    repo.StashRepo.save(make_stash('a', 'b'))
+
+    assert not os.path.exists(get_cache_path())
+    assert repo.StashRepo.load(BUCKET, max_age=60) == make_stash('a', 'b')
+
+
+def test_marshalling_round_trip():
+    dump = models.Dump(
+        dump_id='a',
+        timestamp=1.0,
+        storage_url='s3://stash/a',
+        checksum=models.Checksum(
+            size=10, sha256='0' * 64, chunk_size=4, chunk_sha256=['1']
+        ),
+        rows=3,
+        tables=[models.TableStats(table='public.t', size=10, rows=3, compressed_size=5)],
+        sample='1%',
+    )
+
+    data = json.loads(json.dumps(repo.marshal_dump(dump)))
+
+    assert repo.unmarshal_dump(data) == dump
@@ -0,0 +1,136 @@
+import fcntl
+import os
+
+import pytest
+
+from voleur import models, spool, storage
+
+
+SOURCE_KEY = spool.get_source_key('postgresql://source/db', 'klepto.toml')
+
+
+@pytest.fixture
+def aborted(monkeypatch):
+    """Records the uploads aborted through the storage."""
+    calls: list = []
+    monkeypatch.setattr(storage, 'abort_upload', lambda *args: calls.append(args))
+    return calls
+
+
+def make_spool(directory, name='dump.gz', complete=True, upload_id='upload-1'):
+    sp = spool.create(str(directory), f'bucket/{name}', SOURCE_KEY)
+    with open(sp.dump_path, 'wb') as f:
+        f.write(b'dump')
+    sp.set_upload_id(upload_id)
+    if complete:
+        checksum = models.Checksum(size=4, sha256='0' * 64, chunk_size=4)
+        sp.mark_complete(checksum, [models.TableStats(table='public.t', rows=1)])
+    sp.unlock()
+    return sp
+
+
+def test_source_key():
+    assert len(SOURCE_KEY) == 16
+    assert SOURCE_KEY == spool.get_source_key('postgresql://source/db', 'klepto.toml')
+    assert SOURCE_KEY != spool.get_source_key('postgresql://source/db')
+    assert SOURCE_KEY != spool.get_source_key(
+        'postgresql://source/db', 'klepto.toml', sample='1%'
+    )
+
+
+def test_checkpoint_round_trip(tmp_path, aborted):
+    sp = make_spool(tmp_path)
+
+    found = spool.find(str(tmp_path), 'bucket', SOURCE_KEY)
+
+    assert found == sp
+    assert found.upload_id == 'upload-1'
+    assert found.checksum.size == 4
+    assert found.tables == [models.TableStats(table='public.t', rows=1)]
+    found.unlock()
+
+
+def test_find_skips_other_sources(tmp_path, aborted):
+    make_spool(tmp_path)
+
+    assert spool.find(str(tmp_path), 'other', SOURCE_KEY) is None
+    assert spool.find(str(tmp_path), 'bucket', 'other') is None
+    assert aborted == []
+
+
+def test_find_locks_the_spool(tmp_path, aborted):
+    make_spool(tmp_path)
+
+    found = spool.find(str(tmp_path), 'bucket', SOURCE_KEY)
+
+    assert found is not None
+    assert spool.find(str(tmp_path), 'bucket', SOURCE_KEY) is None
+    found.unlock()
+    assert spool.find(str(tmp_path), 'bucket', SOURCE_KEY) == found
+
+
+def test_find_skips_spools_locked_by_another_process(tmp_path, aborted):
+    sp = make_spool(tmp_path, complete=False)
+    # A lock taken through another open file, as another process would.
+    fd = os.open(sp.lock_path, os.O_RDWR)
+    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    try:
+        assert spool.find(str(tmp_path), 'bucket', SOURCE_KEY) is None
+    finally:
+        os.close(fd)
+
+    # Neither removed nor aborted while in use.
+    assert os.path.exists(sp.checkpoint_path)
+    assert aborted == []
+
+
+def test_new_spool_is_locked(tmp_path):
+    sp = spool.create(str(tmp_path), 'bucket/dump.gz', SOURCE_KEY)
+
+    assert not sp.lock()
+    sp.unlock()
+    assert sp.lock()
+    sp.unlock()
+
+
+def test_find_removes_incomplete_spools(tmp_path, aborted):
+    sp = make_spool(tmp_path, complete=False)
+
+    assert spool.find(str(tmp_path), 'bucket', SOURCE_KEY) is None
+    assert aborted == [('s3', 'bucket/dump.gz', 'upload-1')]
+    assert os.listdir(tmp_path) == []
+    assert sp.lock_path not in spool._locks
+
+
+def test_find_removes_incomplete_spools_without_upload(tmp_path, aborted):
+    make_spool(tmp_path, complete=False, upload_id=None)
+
+    assert spool.find(str(tmp_path), 'bucket', SOURCE_KEY, backend='file') is None
+    assert aborted == []
+    assert os.listdir(tmp_path) == []
+
+
+def test_find_keeps_looking_past_incomplete_spools(tmp_path, aborted):
+    make_spool(tmp_path, name='a.gz', complete=False)
+    sp = make_spool(tmp_path, name='b.gz')
+
+    found = spool.find(str(tmp_path), 'bucket', SOURCE_KEY)
+
+    assert found == sp
+    assert aborted == [('s3', 'bucket/a.gz', 'upload-1')]
+    found.remove()
+    assert os.listdir(tmp_path) == []
+
+
+def test_find_skips_complete_spools_without_dump(tmp_path, aborted):
+    sp = make_spool(tmp_path)
+    os.remove(sp.dump_path)
+
+    assert spool.find(str(tmp_path), 'bucket', SOURCE_KEY) is None
+
+
+def test_find_skips_unreadable_checkpoints(tmp_path, aborted):
+    with open(tmp_path / ('dump.gz' + spool.CHECKPOINT_SUFFIX), 'w') as f:
+        f.write('{"directory": ')
+
+    assert spool.find(str(tmp_path), 'bucket', SOURCE_KEY) is None
@@ -0,0 +1,202 @@
+import mmap
+import random
+
+import pytest
+
+from voleur import sql
+
+
+STATEMENTS = [
+    b'SET client_encoding = \'UTF8\';',
+    b'\nCREATE TABLE "odd;name" (id integer, body text);',
+    b"\nINSERT INTO users (id, name) VALUES ('1', 'O''Brien; Jr.');",
+    b"\nINSERT INTO users (id, name) VALUES ('2', '''quoted''');",
+    b'\n-- a comment; with a semicolon\nSELECT 1;',
+    b'\n/* a block; comment */ SELECT 2;',
+    b'\nCREATE FUNCTION f() RETURNS int AS $$ SELECT 1; $$ LANGUAGE sql;',
+    b'\nCREATE FUNCTION g() RETURNS int AS $body$ SELECT \'$$;\'; $body$ LANGUAGE sql;',
+    b'\nSELECT 3 - 1 / 1;',
+]
+
+SCRIPT = b''.join(STATEMENTS)
+
+
+def split(chunks):
+    splitter = sql.StatementSplitter()
+    statements = []
+    for chunk in chunks:
+        statements.extend(splitter.feed(chunk))
+    rest = splitter.close()
+    if rest:
+        statements.append(rest)
+    return statements
+
+
+def test_scanner_finds_statement_ends():
+    ends = list(sql.Scanner().scan(SCRIPT, 0))
+
+    assert ends == [
+        sum(len(s) for s in STATEMENTS[: i + 1]) for i in range(len(STATEMENTS))
+    ]
+
+
+def test_scanner_scans_mmap():
+    with mmap.mmap(-1, len(SCRIPT)) as buf:
+        buf.write(SCRIPT)
+
+        ends = list(sql.Scanner().scan(buf, 0))
+
+    assert len(ends) == len(STATEMENTS)
+    assert ends[-1] == len(SCRIPT)
+
+
+def test_scanner_stops_at_end():
+    end = len(STATEMENTS[0]) + len(STATEMENTS[1])
+    scanner = sql.Scanner()
+
+    ends = list(scanner.scan(SCRIPT, 0, end))
+
+    assert ends == [len(STATEMENTS[0]), end]
+    assert scanner.pos == end
+
+
+def test_splitter_splits_statements():
+    assert split([SCRIPT]) == STATEMENTS
+
+
+@pytest.mark.parametrize('boundary', range(1, len(SCRIPT)))
+def test_splitter_handles_any_chunk_boundary(boundary):
+    assert split([SCRIPT[:boundary], SCRIPT[boundary:]]) == STATEMENTS
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_splitter_handles_random_chunks(seed):
+    rand = random.Random(seed)
+    chunks = []
+    pos = 0
+    while pos < len(SCRIPT):
+        size = rand.randint(1, 8)
+        chunks.append(SCRIPT[pos : pos + size])
+        pos += size
+
+    assert split(chunks) == STATEMENTS
+
+
+def test_splitter_handles_byte_chunks():
+    assert split([SCRIPT[i : i + 1] for i in range(len(SCRIPT))]) == STATEMENTS
+
+
+def test_splitter_returns_unterminated_statement_on_close():
+    assert split([b'SELECT 1; SELECT 2']) == [b'SELECT 1;', b'SELECT 2']
+
+
+def test_splitter_keeps_unterminated_quote_open():
+    splitter = sql.StatementSplitter()
+
+    assert splitter.feed(b"INSERT INTO t (a) VALUES ('a;") == []
+    assert splitter.feed(b"b');") == [b"INSERT INTO t (a) VALUES ('a;b');"]
+
+
+def test_parse_insert():
+    insert = sql.parse_insert(b"INSERT INTO public.users (id, name) VALUES ('1', 'Bob');")
+
+    assert insert == sql.Insert(b'public.users', b'id, name', [b'1', b'Bob'])
+
+
+def test_parse_insert_unescapes_doubled_quotes():
+    insert = sql.parse_insert(b"INSERT INTO t (a, b) VALUES ('O''Brien', '''');")
+
+    assert insert.values == [b"O'Brien", b"'"]
+
+
+def test_parse_insert_tells_null_from_null_string():
+    insert = sql.parse_insert(b"INSERT INTO t (a, b, c) VALUES (NULL, 'NULL', null);")
+
+    assert insert.values == [None, b'NULL', None]
+
+
+def test_parse_insert_keeps_numeric_values():
+    insert = sql.parse_insert(b'INSERT INTO t (a, b, c, d) VALUES (1, -2.5, .5, 1e-3);')
+
+    assert insert.values == [b'1', b'-2.5', b'.5', b'1e-3']
+
+
+def test_parse_insert_keeps_quoted_names():
+    insert = sql.parse_insert(b'INSERT INTO "public"."t" ("a", "b") VALUES (1, 2);')
+
+    assert insert.table == b'"public"."t"'
+    assert insert.columns == b'"a", "b"'
+
+
+def test_parse_insert_keeps_semicolons_and_parens_in_strings():
+    insert = sql.parse_insert(b"INSERT INTO t (a) VALUES ('); DROP TABLE t; --');")
+
+    assert insert.values == [b'); DROP TABLE t; --']
+
+
+@pytest.mark.parametrize(
+    'statement',
+    [
+        b"INSERT INTO t (a) VALUES ('1'::integer);",
+        b"INSERT INTO t (a) VALUES (E'a\\nb');",
+        b"INSERT INTO t (a) VALUES ('1'), ('2');",
+        b"INSERT INTO t (a) VALUES ('1') ON CONFLICT DO NOTHING;",
+        b"INSERT INTO t (a) VALUES ('1') RETURNING a;",
+        b"INSERT INTO t (a) VALUES (now());",
+        b"INSERT INTO t (a) VALUES (DEFAULT);",
+        b"INSERT INTO t (a) VALUES (true);",
+        b"INSERT INTO t (a) VALUES (NULLIF('a', 'b'));",
+        b"INSERT INTO t (a) VALUES (1.2.3);",
+        b"INSERT INTO t (a) VALUES ('unterminated);",
+        b"INSERT INTO t VALUES ('1');",
+        b'CREATE TABLE t (a text);',
+    ],
+)
+def test_parse_insert_falls_back(statement):
+    assert sql.parse_insert(statement) is None
+
+
+def test_get_insert_table():
+    statement = b"SELECT 1;\nINSERT INTO public.t (a) VALUES ('1');"
+
+    assert sql.get_insert_table(statement, 9) == b'public.t'
+    assert sql.get_insert_table(statement) is None
+
+
+def test_to_copy_row():
+    assert sql.to_copy_row([b'1', None, b'NULL', b'']) == b'1\t\\N\tNULL\t\n'
+
+
+def test_to_copy_row_escapes_special_characters():
+    row = sql.to_copy_row([b'a\\b', b'c\td', b'e\nf', b'g\rh', b'\\N'])
+
+    assert row == b'a\\\\b\tc\\td\te\\nf\tg\\rh\t\\\\N\n'
+
+
+@pytest.mark.parametrize(
+    'statement',
+    [
+        b"SET client_encoding = 'UTF8';",
+        b'set statement_timeout = 0;',
+        b'SET SESSION search_path TO public;',
+        b'RESET ALL;',
+        b"SELECT pg_catalog.set_config('search_path', '', false);",
+        b"\n-- a comment\n/* another */ SET search_path = public;",
+    ],
+)
+def test_is_session_statement(statement):
+    assert sql.is_session_statement(statement)
+
+
+@pytest.mark.parametrize(
+    'statement',
+    [
+        b'SET LOCAL statement_timeout = 0;',
+        b'SELECT 1;',
+        b'CREATE TABLE settings (a text);',
+        b"INSERT INTO settings (a) VALUES ('SET a = 1');",
+        b'-- SET a = 1\nSELECT 1;',
+    ],
+)
+def test_is_not_session_statement(statement):
+    assert not sql.is_session_statement(statement)
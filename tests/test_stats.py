@@ -0,0 +1,117 @@
+import asyncio
+import zlib
+
+from voleur import metrics, models, pipeline, stats
+
+
+def insert(table: str, i: int) -> bytes:
+    return f"INSERT INTO {table} (\"id\") VALUES ('{i}');\n".encode()
+
+
+def test_collects_size_and_rows_per_table():
+    stage = metrics.StageMetrics(name='rewrite')
+    collector = stats.TableStatsCollector(stage)
+    lines = [b'CREATE TABLE public.a (id text);\n', insert('public.a', 1)]
+
+    collector.add_lines(lines)
+    collector.add_lines([insert('public.a', 2), insert('public."B"', 3)])
+
+    assert collector.get_tables() == [
+        models.TableStats(table='public.a', size=len(insert('public.a', 1)) * 2, rows=2),
+        models.TableStats(table='public."B"', size=len(insert('public."B"', 3)), rows=1),
+    ]
+    assert stage.rows == {'public.a': 2, 'public."B"': 1}
+
+
+def test_splits_compressed_size_by_share_of_chunks():
+    collector = stats.TableStatsCollector()
+    a, b = insert('public.a', 1), insert('public.b', 1)
+
+    collector.add_lines([a, a, a, b])
+    collector.add_compressed(40)
+    collector.add_lines([b])
+    collector.add_compressed(10)
+
+    sizes = {t.table: t.compressed_size for t in collector.get_tables()}
+    assert sizes == {'public.a': 30, 'public.b': 10 + 10}
+
+
+def test_buffered_compressed_output_covers_earlier_chunks():
+    collector = stats.TableStatsCollector()
+    a, b = insert('public.a', 1), insert('public.b', 1)
+
+    collector.add_lines([a])
+    collector.add_compressed(0)
+    collector.add_lines([b])
+    collector.add_compressed(20)
+
+    sizes = {t.table: t.compressed_size for t in collector.get_tables()}
+    assert sizes == {'public.a': 10, 'public.b': 10}
+
+
+def test_compressed_tail_is_split_by_table_size():
+    collector = stats.TableStatsCollector()
+    a, b = insert('public.a', 1), insert('public.b', 1)
+
+    collector.add_lines([a, a, a, b])
+    collector.add_compressed_tail(40)
+
+    sizes = {t.table: t.compressed_size for t in collector.get_tables()}
+    assert sizes == {'public.a': 30, 'public.b': 10}
+
+
+def test_other_lines_take_a_share_of_compressed_size():
+    collector = stats.TableStatsCollector()
+    a = insert('public.a', 1)
+
+    collector.add_lines([b'-' * (len(a) - 1) + b'\n', a])
+    collector.add_compressed(20)
+
+    assert collector.get_tables()[0].compressed_size == 10
+
+
+def test_compressed_sizes_add_up_to_the_compressed_dump():
+    # Tables of different sizes, streamed through the compression in chunks of lines
+    # as the rewrite stage would.
+    lines = [insert('public.a', i) for i in range(5000)]
+    lines += [insert('public.b', i) for i in range(20000)]
+    lines += [insert('public.c', i) for i in range(100)]
+    chunks = [lines[i : i + 300] for i in range(0, len(lines), 300)]
+    collector = stats.TableStatsCollector()
+
+    async def source():
+        for chunk in chunks:
+            collector.add_lines(chunk)
+            yield b''.join(chunk)
+
+    async def run():
+        channel = pipeline.Channel()
+        compress = pipeline.compress(source(), channel, tables=collector)
+        task = asyncio.ensure_future(compress)
+        compressed = b''.join([data async for data in channel])
+        await task
+        return compressed
+
+    compressed = asyncio.new_event_loop().run_until_complete(run())
+
+    tables = {t.table: t for t in collector.get_tables()}
+    assert {table: t.rows for table, t in tables.items()} == {
+        'public.a': 5000,
+        'public.b': 20000,
+        'public.c': 100,
+    }
+    assert sum(t.size for t in tables.values()) == len(b''.join(lines))
+    total = sum(t.compressed_size for t in tables.values())
+    # Shares are rounded down, by at most a byte per table and output.
+    assert len(compressed) - len(chunks) * 3 <= total <= len(compressed)
+    assert tables['public.c'].compressed_size < tables['public.a'].compressed_size
+    assert tables['public.a'].compressed_size < tables['public.b'].compressed_size
+    assert zlib.decompress(compressed, 16 + zlib.MAX_WBITS) == b''.join(lines)
+
+
+def test_table_names_in_other_encodings():
+    collector = stats.TableStatsCollector()
+
+    collector.add_lines([b"INSERT INTO public.caf\xe9 (id) VALUES ('1');\n"])
+
+    assert collector.get_tables()[0].table == 'public.caf\ufffd'
@@ -0,0 +1,298 @@
+import asyncio
+import hashlib
+
+import pytest
+from botocore import exceptions as botocore_exc
+
+from voleur import storage
+
+
+PATH = 'bucket/dump.gz'
+
+PART_SIZE = 4
+
+
+def client_error(code: str, operation: str = 'Operation') -> botocore_exc.ClientError:
+    return botocore_exc.ClientError({'Error': {'Code': code}}, operation)
+
+
+class FakeClient:
+    """Stands in for the boto3 S3 client, holding multipart uploads in memory."""
+
+    def __init__(self):
+        self.uploads: dict = {}
+        self.objects: dict = {}
+        self.aborted: list = []
+        self.uploaded_parts: list = []
+        self.fail_part = None
+        self.ranges: list = []
+        self.drop_after = None
+        self.get_error = None
+        self._count = 0
+
+    def create_multipart_upload(self, Bucket, Key):
+        self._count += 1
+        upload_id = f'upload-{self._count}'
+        self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        if PartNumber == self.fail_part:
+            raise ConnectionError('Connection reset')
+        self.uploaded_parts.append(PartNumber)
+        etag = hashlib.md5(Body).hexdigest()
+        self.uploads[UploadId][PartNumber] = {
+            'PartNumber': PartNumber,
+            'ETag': etag,
+            'Size': len(Body),
+            'Body': Body,
+        }
+        return {'ETag': etag}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        self.objects[f'{Bucket}/{Key}'] = b''.join(
+            parts[part['PartNumber']]['Body'] for part in MultipartUpload['Parts']
+        )
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        if UploadId not in self.uploads:
+            raise client_error('NoSuchUpload')
+        del self.uploads[UploadId]
+        self.aborted.append(UploadId)
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        if self.get_error:
+            raise self.get_error
+        data = self.objects[f'{Bucket}/{Key}']
+        self.ranges.append(Range)
+        start = int(Range[len('bytes=') : -1]) if Range else 0
+        body = ChunkedBody(data[start:], self.drop_after)
+        return {'Body': body, 'ContentLength': len(data), 'ETag': 'etag'}
+
+    def get_paginator(self, operation):
+        assert operation == 'list_parts'
+        return self
+
+    def paginate(self, Bucket, Key, UploadId):
+        if UploadId not in self.uploads:
+            raise client_error('NoSuchUpload', 'ListParts')
+        parts = list(self.uploads[UploadId].values())
+        # Two pages, as S3 lists at most 1000 parts per page.
+        yield {'Parts': parts[:1]}
+        yield {'Parts': parts[1:]}
+
+
+class ChunkedBody:
+    """A response body read a byte at a time, whose connection drops after the given
+    number of bytes."""
+
+    def __init__(self, data: bytes, drop_after=None):
+        self._data = data
+        self._drop_after = drop_after
+
+    def read(self, size):
+        if self._drop_after is not None and self._drop_after <= 0:
+            raise ConnectionError('Connection reset')
+        if self._drop_after is not None:
+            self._drop_after -= 1
+        chunk, self._data = self._data[:1], self._data[1:]
+        return chunk
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    backend = storage.S3.__new__(storage.S3)
+    backend._client = FakeClient()
+    backend._PART_SIZE = PART_SIZE
+    backend._RESUME_DELAY = 0
+    monkeypatch.setitem(storage._backends, 's3', backend)
+    return backend
+
+
+async def iter_chunks(data: bytes, size: int = 3):
+    for i in range(0, len(data), size):
+        yield data[i : i + size]
+
+
+def store_chunks(data: bytes, **kwargs):
+    return asyncio.new_event_loop().run_until_complete(
+        storage.store_chunks('s3', PATH, iter_chunks(data), **kwargs)
+    )
+
+
+def test_store_chunks_uploads_parts(s3):
+    url = store_chunks(b'abcdefghij')
+
+    assert url == f's3://{PATH}'
+    assert s3._client.objects[PATH] == b'abcdefghij'
+    assert s3._client.uploaded_parts == [1, 2, 3]
+
+
+def test_store_chunks_uploads_empty_content(s3):
+    store_chunks(b'')
+
+    assert s3._client.objects[PATH] == b''
+
+
+def test_store_chunks_keeps_resumable_upload_on_error(s3):
+    s3._client.fail_part = 2
+    upload_ids: list = []
+
+    with pytest.raises(ConnectionError):
+        store_chunks(b'abcdefghij', on_upload=upload_ids.append)
+
+    assert upload_ids == ['upload-1']
+    assert 'upload-1' in s3._client.uploads
+    assert not s3._client.aborted
+
+
+def test_store_chunks_aborts_upload_on_error_if_not_resumable(s3):
+    s3._client.fail_part = 2
+
+    with pytest.raises(ConnectionError):
+        store_chunks(b'abcdefghij')
+
+    assert s3._client.aborted == ['upload-1']
+
+
+def test_store_chunks_aborts_resumable_upload_on_cancel(s3):
+    async def chunks():
+        yield b'abcdefghij'
+        raise asyncio.CancelledError()
+
+    async def run():
+        await storage.store_chunks('s3', PATH, chunks(), on_upload=lambda _: None)
+
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.new_event_loop().run_until_complete(run())
+
+    assert s3._client.aborted == ['upload-1']
+
+
+def test_store_chunks_resumes_upload(s3):
+    client = s3._client
+    client.create_multipart_upload(Bucket='bucket', Key='dump.gz')
+    client.upload_part('bucket', 'dump.gz', 'upload-1', PartNumber=1, Body=b'abcd')
+    client.upload_part('bucket', 'dump.gz', 'upload-1', PartNumber=2, Body=b'efgh')
+    client.uploaded_parts = []
+    upload_ids: list = []
+
+    store_chunks(b'abcdefghij', upload_id='upload-1', on_upload=upload_ids.append)
+
+    # The parts uploaded before are skipped, and no new upload is started.
+    assert client.uploaded_parts == [3]
+    assert upload_ids == []
+    assert client.objects[PATH] == b'abcdefghij'
+
+
+def test_store_chunks_reuploads_parts_of_another_size(s3):
+    client = s3._client
+    client.create_multipart_upload(Bucket='bucket', Key='dump.gz')
+    client.upload_part('bucket', 'dump.gz', 'upload-1', PartNumber=1, Body=b'abcd')
+    client.upload_part('bucket', 'dump.gz', 'upload-1', PartNumber=2, Body=b'ef')
+    client.uploaded_parts = []
+
+    store_chunks(b'abcdefghij', upload_id='upload-1')
+
+    assert client.uploaded_parts == [2, 3]
+    assert client.objects[PATH] == b'abcdefghij'
+
+
+def test_store_chunks_starts_over_if_upload_is_gone(s3):
+    upload_ids: list = []
+
+    store_chunks(b'abcdefghij', upload_id='expired', on_upload=upload_ids.append)
+
+    assert upload_ids == ['upload-1']
+    assert s3._client.uploaded_parts == [1, 2, 3]
+    assert s3._client.objects[PATH] == b'abcdefghij'
+
+
+def test_list_parts(s3):
+    store_chunks(b'abcdefghij')
+    s3._client.create_multipart_upload(Bucket='bucket', Key='dump.gz')
+    s3._client.upload_part('bucket', 'dump.gz', 'upload-2', PartNumber=1, Body=b'ab')
+    s3._client.upload_part('bucket', 'dump.gz', 'upload-2', PartNumber=2, Body=b'cd')
+
+    parts = s3._list_parts('bucket', 'dump.gz', 'upload-2')
+
+    assert sorted(parts) == [1, 2]
+    assert parts[2]['Size'] == 2
+    # Completed, so no longer listed.
+    assert s3._list_parts('bucket', 'dump.gz', 'upload-1') is None
+
+
+def test_abort_upload_ignores_missing_upload(s3):
+    s3._client.create_multipart_upload(Bucket='bucket', Key='dump.gz')
+
+    storage.abort_upload('s3', PATH, 'upload-1')
+    storage.abort_upload('s3', PATH, 'upload-1')
+
+    assert s3._client.aborted == ['upload-1']
+
+
+@pytest.mark.parametrize('code', ['403', 'SlowDown', '500'])
+def test_read_errors_are_storage_errors(s3, code):
+    s3._client.get_error = client_error(code, 'GetObject')
+
+    with pytest.raises(storage.StorageError) as exc_info:
+        storage.read_if_modified('s3', PATH, 'etag')
+
+    assert not isinstance(exc_info.value, storage.NotFoundError)
+    assert code in str(exc_info.value)
+
+
+def test_read_missing_object(s3):
+    s3._client.get_error = client_error('NoSuchKey', 'GetObject')
+
+    with pytest.raises(storage.NotFoundError):
+        storage.read_if_modified('s3', PATH)
+
+
+def read_chunks() -> list:
+    async def run():
+        return [chunk async for chunk in storage.iter_storage_url(f's3://{PATH}')]
+
+    return asyncio.new_event_loop().run_until_complete(run())
+
+
+def test_iter_chunks_resumes_download(s3):
+    s3._client.objects[PATH] = b'abcdef'
+    s3._client.drop_after = 2
+
+    assert b''.join(read_chunks()) == b'abcdef'
+    assert s3._client.ranges == [None, 'bytes=2-', 'bytes=4-']
+
+
+def test_iter_chunks_errors_are_storage_errors(s3):
+    s3._client.get_error = client_error('AccessDenied', 'GetObject')
+
+    with pytest.raises(storage.StorageError, match='AccessDenied'):
+        read_chunks()
+
+
+def test_iter_chunks_gives_up_resuming(s3):
+    s3._client.objects[PATH] = b'abcdef'
+    s3._client.drop_after = 0
+
+    with pytest.raises(storage.StorageError, match='Connection lost at byte') as exc_info:
+        read_chunks()
+
+    assert isinstance(exc_info.value.__cause__, ConnectionError)
+    assert len(s3._client.ranges) == s3._MAX_RESUMES + 1
+
+
+def test_local_fs_store_chunks(tmp_path):
+    path = str(tmp_path / 'dir' / 'dump.gz')
+
+    async def run():
+        await storage.store_chunks('file', path, iter_chunks(b'abcdefghij'))
+        return [chunk async for chunk in storage.get_backend('file').iter_chunks(path)]
+
+    chunks = asyncio.new_event_loop().run_until_complete(run())
+
+    assert b''.join(chunks) == b'abcdefghij'
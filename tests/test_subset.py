@@ -0,0 +1,281 @@
+import asyncio
+from typing import Dict, List, Optional
+
+import pytest
+
+from voleur import sql, subset
+
+
+# A catalog of tables with every kind of foreign key: a self-referencing one (a tree of
+# comments), a cycle (users and teams referencing each other) and a composite one.
+STRUCTURE = b"""SET client_encoding = 'UTF8';
+CREATE TABLE public.teams (
+    id integer NOT NULL,
+    owner_id integer
+);
+CREATE TABLE public.users (
+    id integer NOT NULL,
+    team_id integer,
+    CONSTRAINT users_team_fk FOREIGN KEY (team_id) REFERENCES public.teams(id)
+);
+CREATE TABLE public.comments (
+    id integer NOT NULL,
+    user_id integer NOT NULL,
+    parent_id integer
+);
+CREATE TABLE public."Shelves" (
+    room integer NOT NULL,
+    shelf integer NOT NULL
+);
+CREATE TABLE public.books (
+    id integer NOT NULL,
+    room integer,
+    shelf integer
+);
+"""
+
+POST_DATA = b"""ALTER TABLE ONLY public.teams
+    ADD CONSTRAINT teams_owner_fk FOREIGN KEY (owner_id) REFERENCES public.users(id);
+ALTER TABLE ONLY public.comments
+    ADD CONSTRAINT comments_user_fk FOREIGN KEY (user_id) REFERENCES public.users(id);
+ALTER TABLE ONLY public.comments
+    ADD CONSTRAINT comments_parent_fk FOREIGN KEY (parent_id)
+    REFERENCES public.comments(id);
+ALTER TABLE ONLY public.books
+    ADD CONSTRAINT books_shelf_fk FOREIGN KEY (room, shelf)
+    REFERENCES public."Shelves"(room, shelf);
+"""
+
+FOREIGN_KEYS = subset.parse_foreign_keys(STRUCTURE + POST_DATA)
+
+
+def insert(table: str, **values: Optional[int]) -> bytes:
+    columns = ', '.join(f'"{column}"' for column in values)
+    literals = ', '.join(
+        'NULL' if value is None else f"'{value}'" for value in values.values()
+    )
+    return f'INSERT INTO public.{table} ({columns}) VALUES ({literals});\n'.encode()
+
+
+def make_dump(size: int = 200) -> bytes:
+    rows = []
+    for i in range(size // 10):
+        rows.append(insert('teams', id=i, owner_id=(i * 7 + 1) % size))
+    for i in range(size):
+        rows.append(insert('users', id=i, team_id=i % (size // 10)))
+    # Comments reference both earlier and later comments, in chains.
+    for i in range(size):
+        parent = None if i % 20 == 0 else (i + 37) % size
+        rows.append(insert('comments', id=i, user_id=i * 3 % size, parent_id=parent))
+    for room in range(5):
+        for shelf in range(10):
+            rows.append(insert('"Shelves"', room=room, shelf=shelf))
+    for i in range(size):
+        shelf = None if i % 9 == 0 else i % 10
+        rows.append(insert('books', id=i, room=i % 5, shelf=shelf))
+    return STRUCTURE + b''.join(rows) + POST_DATA
+
+
+def run_subset(dump: bytes, *specs: str) -> bytes:
+    async def chunks():
+        # Chunks of whole lines, of varying sizes.
+        lines = dump.splitlines(keepends=True)
+        for i in range(0, len(lines), 7):
+            yield b''.join(lines[i : i + 7])
+
+    async def run():
+        sample = subset.parse_sample(list(specs))
+        return b''.join([chunk async for chunk in subset.subset_dump(chunks(), sample)])
+
+    return asyncio.new_event_loop().run_until_complete(run())
+
+
+def get_rows(dump: bytes) -> Dict[str, List[Dict[str, Optional[bytes]]]]:
+    rows: Dict[str, List[Dict[str, Optional[bytes]]]] = {}
+    for line in dump.splitlines():
+        insert = sql.parse_insert(line)
+        if insert:
+            table = subset._get_table_name(insert.table)
+            columns = subset._get_names(insert.columns)
+            rows.setdefault(table, []).append(dict(zip(columns, insert.values)))
+    return rows
+
+
+def assert_closed(dump: bytes):
+    """Asserts that every row referenced by a row of the dump is in the dump."""
+    rows = get_rows(dump)
+    for key in FOREIGN_KEYS:
+        referenced = {
+            tuple(row[column] for column in key.referenced_columns)
+            for row in rows.get(key.referenced_table, [])
+        }
+        for row in rows.get(key.table, []):
+            value = tuple(row[column] for column in key.columns)
+            if None not in value:
+                assert value in referenced, (key, value)
+
+
+def test_parse_foreign_keys():
+    assert set(FOREIGN_KEYS) == {
+        subset.ForeignKey('public.users', ('team_id',), 'public.teams', ('id',)),
+        subset.ForeignKey('public.teams', ('owner_id',), 'public.users', ('id',)),
+        subset.ForeignKey('public.comments', ('user_id',), 'public.users', ('id',)),
+        subset.ForeignKey('public.comments', ('parent_id',), 'public.comments', ('id',)),
+        subset.ForeignKey(
+            'public.books', ('room', 'shelf'), 'public."Shelves"', ('room', 'shelf')
+        ),
+    }
+
+
+def test_parse_sample():
+    sample = subset.parse_sample(['1%', 'users=10', 'Comments=50%,"Shelves"=100%'])
+
+    assert sample.spec == '1%,users=10,Comments=50%,"Shelves"=100%'
+    assert sample.default == subset.TableSample(fraction=0.01)
+    assert sample.get('public.users') == subset.TableSample(limit=10)
+    assert sample.get('public.comments') == subset.TableSample(fraction=0.5)
+    assert sample.get('public."Shelves"').whole
+    assert sample.get('public.shelves') == sample.default
+    assert sample.get('public.books') == sample.default
+
+
+def test_parse_sample_of_a_schema():
+    sample = subset.parse_sample(['users=10', 'Audit.Users=50%'])
+
+    assert sample.get('audit.users') == subset.TableSample(fraction=0.5)
+    assert sample.get('public.users') == subset.TableSample(limit=10)
+    assert sample.get('other.users') == subset.TableSample(limit=10)
+
+
+def test_get_table_name():
+    assert subset._get_table_name(b'public.users') == 'public.users'
+    assert subset._get_table_name(b'"public"."Users"') == 'public."Users"'
+    assert subset._get_table_name(b'Audit.Users') == 'audit.users'
+    assert subset._get_table_name(b'users') == 'public.users'
+    assert subset._get_table_name(b'users', schema=None) == 'users'
+    assert subset._get_table_name(b'public."a.b"') == 'public."a.b"'
+
+
+@pytest.mark.parametrize('spec', ['x%', '101%', '-1%', '1.5', 'users=', 'abc'])
+def test_parse_sample_rejects_invalid_specs(spec):
+    with pytest.raises(ValueError, match='Invalid sample'):
+        subset.parse_sample([spec])
+
+
+def test_subset_without_sample_keeps_everything():
+    dump = make_dump()
+
+    assert run_subset(dump) == dump
+
+
+def test_subset_keeps_structure():
+    result = run_subset(make_dump(), '10%')
+
+    assert result.startswith(STRUCTURE)
+    assert result.endswith(POST_DATA)
+
+
+@pytest.mark.parametrize('spec', ['0%', '5%', '20%', '50%'])
+def test_subset_is_closed(spec):
+    result = run_subset(make_dump(), spec)
+
+    assert_closed(result)
+    assert len(result) < len(make_dump())
+
+
+def test_subset_follows_self_references():
+    # Only comments are sampled, and every chain of parents ends at a root comment.
+    result = run_subset(make_dump(), '0%', 'comments=5%')
+    comments = {row['id']: row for row in get_rows(result)['public.comments']}
+
+    assert comments
+    for comment in comments.values():
+        while comment['parent_id'] is not None:
+            comment = comments[comment['parent_id']]
+    assert_closed(result)
+
+
+def test_subset_follows_long_self_reference_chains():
+    # Each comment references the one before it, the first sampled one pulling in all
+    # of them.
+    rows = [insert('comments', id=0, user_id=None, parent_id=None)]
+    rows += [
+        insert('comments', id=i, user_id=None, parent_id=i - 1) for i in range(1, 300)
+    ]
+    dump = STRUCTURE + b''.join(reversed(rows)) + POST_DATA
+
+    result = run_subset(dump, 'comments=1')
+
+    assert len(get_rows(result)['public.comments']) == 300
+
+
+def test_subset_follows_cycles():
+    result = run_subset(make_dump(), '0%', 'teams=1')
+    rows = get_rows(result)
+
+    # The team, its owner, the owner's team, and so on until the cycle closes.
+    assert 1 < len(rows['public.teams']) < 20
+    assert len(rows['public.users']) == len(rows['public.teams'])
+    assert_closed(result)
+
+
+def test_subset_limits_rows():
+    result = run_subset(make_dump(), '0%', 'books=10')
+    rows = get_rows(result)
+
+    ids = [row['id'] for row in rows['public.books']]
+    assert ids == [str(i).encode() for i in range(10)]
+    assert 'public.users' not in rows
+    assert_closed(result)
+
+
+def test_subset_limit_is_exceeded_by_referenced_rows():
+    result = run_subset(make_dump(), '0%', 'comments=3', 'users=2')
+    rows = get_rows(result)
+
+    assert len(rows['public.comments']) >= 3
+    assert len(rows['public.users']) > 2
+    assert_closed(result)
+
+
+def test_subset_follows_composite_keys():
+    result = run_subset(make_dump(), '0%', 'books=30%')
+    rows = get_rows(result)
+    shelves = {(row['room'], row['shelf']) for row in rows['public."Shelves"']}
+
+    # Books without a shelf reference nothing.
+    assert shelves == {
+        (row['room'], row['shelf'])
+        for row in rows['public.books']
+        if row['shelf'] is not None
+    }
+    assert_closed(result)
+
+
+def test_subset_is_stable():
+    dump = make_dump()
+
+    assert run_subset(dump, '10%') == run_subset(dump, '10%')
+
+
+def test_subset_tells_same_named_tables_apart():
+    structure = b"""CREATE TABLE public.users (id integer NOT NULL);
+CREATE TABLE audit.users (id integer NOT NULL);
+CREATE TABLE public.comments (
+    id integer NOT NULL,
+    user_id integer,
+    CONSTRAINT comments_user_fk FOREIGN KEY (user_id) REFERENCES public.users(id)
+);
+"""
+    lines = [f"INSERT INTO public.users (id) VALUES ('{i}');\n" for i in range(10)]
+    lines += [f"INSERT INTO audit.users (id) VALUES ('{i}');\n" for i in range(10)]
+    lines.append("INSERT INTO public.comments (id, user_id) VALUES ('0', '3');\n")
+    dump = structure + ''.join(lines).encode()
+
+    result = run_subset(dump, 'public.users=0%', 'audit.users=2')
+    rows = get_rows(result)
+
+    # The comment only pulls in the user of its own schema.
+    assert [row['id'] for row in rows['public.users']] == [b'3']
+    assert [row['id'] for row in rows['audit.users']] == [b'0', b'1']
+    assert len(rows['public.comments']) == 1
@@ -0,0 +1,132 @@
+import pytest
+
+from voleur import templates
+
+
+BUCKET = 'voleur-stash'
+
+TARGET = 'postgresql://voleur@db.local:5432/my%20db?sslmode=disable'
+
+
+class FakeServer:
+    """Records the SQL run by `templates` and answers from a list of databases."""
+
+    def __init__(self, monkeypatch, databases=()):
+        self.databases = list(databases)
+        self.executed: list = []
+        monkeypatch.setattr(templates, '_execute', self.execute)
+
+    def execute(self, uri: str, sql: str):
+        self.executed.append((uri, sql))
+        if sql.startswith('SELECT datname'):
+            return [(name,) for name in self.databases]
+        if sql.startswith('SELECT 1'):
+            return [(1,)] if any(f"'{name}'" in sql for name in self.databases) else []
+        return []
+
+
+def test_template_names_are_namespaced_by_bucket():
+    name = templates.get_template_name(BUCKET, 'abc')
+    other = templates.get_template_name(BUCKET + '2', 'abc')
+
+    assert name.startswith(templates.TEMPLATE_PREFIX)
+    assert name.endswith('_abc')
+    assert name != other
+    assert len(name) - len('abc') == len(other) - len('abc') == len('voleur_tpl_') + 9
+
+
+def test_template_names_fit_database_names():
+    name = templates.get_template_name('b' * 63, '9f86d081884c7d659a2feaa0c55ad015')
+
+    assert len(name + templates._STAGING_SUFFIX) <= 63
+
+
+def test_server_and_template_uris():
+    assert templates.get_server_uri(TARGET) == (
+        'postgresql://voleur@db.local:5432/postgres?sslmode=disable'
+    )
+    assert templates.get_template_uri(TARGET, BUCKET, 'abc') == (
+        'postgresql://voleur@db.local:5432/'
+        f'{templates.get_template_name(BUCKET, "abc")}_staging?sslmode=disable'
+    )
+    assert templates._get_database(TARGET) == 'my db'
+
+
+@pytest.mark.parametrize(
+    'value, expected',
+    [
+        ('voleur_tpl_', 'voleur\\_tpl\\_'),
+        ('100%', '100\\%'),
+        ('a\\b', 'a\\\\b'),
+        ('plain', 'plain'),
+    ],
+)
+def test_escape_like(value, expected):
+    assert templates._escape_like(value) == expected
+
+
+def test_quoting():
+    assert templates._quote_ident('my "db"') == '"my ""db"""'
+    assert templates._quote_literal("it's") == "'it''s'"
+
+
+def test_template_is_renamed_when_complete(monkeypatch):
+    server = FakeServer(monkeypatch)
+    name = templates.get_template_name(BUCKET, 'abc')
+
+    templates.begin_template('server', BUCKET, 'abc')
+    templates.commit_template('server', BUCKET, 'abc')
+
+    assert [sql for _, sql in server.executed] == [
+        f'DROP DATABASE IF EXISTS "{name}_staging"',
+        f'CREATE DATABASE "{name}_staging"',
+        f'ALTER DATABASE "{name}_staging" RENAME TO "{name}"',
+        f'ALTER DATABASE "{name}" IS_TEMPLATE true',
+    ]
+
+
+def test_staging_template_is_dropped_on_abort(monkeypatch):
+    server = FakeServer(monkeypatch)
+    name = templates.get_template_name(BUCKET, 'abc')
+
+    templates.abort_template('server', BUCKET, 'abc')
+
+    assert server.executed == [('server', f'DROP DATABASE IF EXISTS "{name}_staging"')]
+
+
+def test_template_exists(monkeypatch):
+    FakeServer(monkeypatch, [templates.get_template_name(BUCKET, 'abc')])
+
+    assert templates.template_exists('server', BUCKET, 'abc')
+    assert not templates.template_exists('server', BUCKET, 'def')
+    assert not templates.template_exists('server', BUCKET + '2', 'abc')
+
+
+def test_clone_template(monkeypatch):
+    server = FakeServer(monkeypatch)
+    name = templates.get_template_name(BUCKET, 'abc')
+
+    templates.clone_template(TARGET, BUCKET, 'abc')
+
+    assert server.executed == [
+        (templates.get_server_uri(TARGET), f'CREATE DATABASE "my db" TEMPLATE "{name}"')
+    ]
+
+
+def test_evict_templates(monkeypatch):
+    names = [templates.get_template_name(BUCKET, dump_id) for dump_id in 'abc']
+    server = FakeServer(monkeypatch, names)
+
+    evicted = templates.evict_templates('server', BUCKET, keep=['b'])
+
+    prefix = templates._get_stash_prefix(BUCKET)
+    select = server.executed[0][1]
+    assert f"LIKE '{templates._escape_like(prefix)}%'" in select
+    assert 'datistemplate' in select
+    assert evicted == ['a', 'c']
+    assert [sql for _, sql in server.executed[1:]] == [
+        f'ALTER DATABASE "{names[0]}" IS_TEMPLATE false',
+        f'DROP DATABASE "{names[0]}"',
+        f'ALTER DATABASE "{names[2]}" IS_TEMPLATE false',
+        f'DROP DATABASE "{names[2]}"',
+    ]
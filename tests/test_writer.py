@@ -0,0 +1,287 @@
+import asyncio
+import time
+from unittest import mock
+
+import pytest
+
+from voleur import models, pipeline, writer
+
+
+# Nothing listens on port 1, so connecting fails straight away.
+UNREACHABLE = 'postgresql://voleur@127.0.0.1:1/voleur'
+
+STATEMENT = b"INSERT INTO public.t (a, b) VALUES ('1', 'abc');\n"
+
+
+async def produce(channel: pipeline.Channel, count: int):
+    for _ in range(count):
+        await channel.put(STATEMENT * 100)
+    await channel.close()
+
+
+def test_write_dump_many_consumes_dump_when_all_targets_fail():
+    async def run():
+        channel = pipeline.Channel(maxsize=2)
+        return await asyncio.wait_for(
+            pipeline.run_stages(
+                produce(channel, 1000),
+                writer.write_dump_many([UNREACHABLE, UNREACHABLE + '2'], channel),
+            ),
+            timeout=30,
+        )
+
+    _, errors = asyncio.new_event_loop().run_until_complete(run())
+
+    assert len(errors) == 2
+    assert all(isinstance(error, writer.WriterError) for error in errors.values())
+
+
+def test_write_dump_many_with_workers_consumes_dump_when_all_targets_fail():
+    async def run():
+        channel = pipeline.Channel(maxsize=2)
+        return await asyncio.wait_for(
+            pipeline.run_stages(
+                produce(channel, 1000),
+                writer.write_dump_many([UNREACHABLE], channel, workers=4),
+            ),
+            timeout=30,
+        )
+
+    _, errors = asyncio.new_event_loop().run_until_complete(run())
+
+    assert isinstance(errors[UNREACHABLE], writer.WriterError)
+
+
+class FakeConnection:
+    """Records the statements executed over a connection."""
+
+    def __init__(self, connections: list):
+        self.autocommit = False
+        self.executed: list = []
+        connections.append(self)
+
+    def cursor(self):
+        return self
+
+    def execute(self, statement):
+        self.executed.append(statement)
+
+    def copy_expert(self, statement, f, size):
+        self.executed.append(statement)
+        f.read()
+
+    def cancel(self):
+        pass
+
+    def close(self):
+        pass
+
+
+DUMP = b"""SET client_encoding = 'UTF8';
+SELECT pg_catalog.set_config('search_path', '', false);
+CREATE TABLE public.a (x text);
+CREATE TABLE public.b (x text);
+INSERT INTO public.a (x) VALUES ('1');
+INSERT INTO public.b (x) VALUES ('2');
+ALTER TABLE public.a ADD PRIMARY KEY (x);
+"""
+
+
+def test_write_dump_many_runs_session_statements_on_every_worker():
+    connections: list = []
+    progress: list = []
+
+    async def run():
+        channel = pipeline.Channel()
+        await channel.put(DUMP)
+        await channel.close()
+        return await writer.write_dump_many(
+            ['postgresql://t'], channel, on_progress=progress.append, workers=2
+        )
+
+    with mock.patch('psycopg2.connect', lambda _: FakeConnection(connections)):
+        errors = asyncio.new_event_loop().run_until_complete(run())
+
+    assert errors == {'postgresql://t': None}
+    assert len(connections) == 2
+    for conn in connections:
+        assert conn.executed[0].startswith(b"SET client_encoding = 'UTF8';\nSELECT")
+    executed = [s for conn in connections for s in conn.executed[1:]]
+    assert sorted(s.strip().split(b' (')[0] for s in executed) == [
+        b'ALTER TABLE public.a ADD PRIMARY KEY',
+        b'COPY public.a',
+        b'COPY public.b',
+        b'CREATE TABLE public.a',
+    ]
+    assert progress[-1].bytes_written == len(DUMP.strip())
+
+
+def test_iter_batches_separates_session_statements():
+    async def run():
+        async def chunks():
+            yield DUMP
+
+        return [batch async for batch in writer.iter_batches(chunks())]
+
+    batches = asyncio.new_event_loop().run_until_complete(run())
+
+    assert [(batch.session, batch.table) for batch in batches] == [
+        (True, None),
+        (False, None),
+        (False, 'public.a'),
+        (False, 'public.b'),
+        (False, None),
+    ]
+
+
+def test_batches_keep_the_dump_encoding():
+    # `é` in LATIN1, which isn't valid UTF-8.
+    statements = [
+        b"SET client_encoding = 'LATIN1';",
+        b"\nCOMMENT ON TABLE public.caf\xe9 IS 'caf\xe9';",
+        b"\nINSERT INTO public.caf\xe9 (x) VALUES ('caf\xe9');",
+    ]
+
+    batches = list(writer.batch_statements(statements))
+
+    assert [batch.sql for batch in batches] == [
+        statements[0],
+        statements[1],
+        b'COPY public.caf\xe9 (x) FROM STDIN',
+    ]
+    assert batches[2].data == b'caf\xe9\n'
+    assert batches[2].table == 'public.caf\ufffd'
+
+
+def test_batches_fall_back_to_statements_for_bare_keywords():
+    statements = [
+        b"\nINSERT INTO public.t (a, b) VALUES ('1', 2);",
+        b"\nINSERT INTO public.t (a, b) VALUES ('2', DEFAULT);",
+        b"\nINSERT INTO public.t (a, b) VALUES ('3', NULL);",
+    ]
+
+    batches = list(writer.batch_statements(statements))
+
+    assert [(batch.table, batch.rows) for batch in batches] == [
+        ('public.t', 1),
+        (None, 0),
+        ('public.t', 1),
+    ]
+    assert batches[1].sql == statements[1]
+
+
+def make_tables(**sizes: int):
+    return [models.TableStats(table=table, size=size) for table, size in sizes.items()]
+
+
+def test_schedule_assigns_largest_tables_first():
+    schedule = writer._Schedule(2, make_tables(d=10, b=60, a=100, c=50))
+
+    assert [schedule.get_worker(table) for table in 'abcd'] == [0, 1, 1, 0]
+    assert schedule.total_bytes == 220
+    assert [schedule.get_remaining(worker) for worker in (0, 1)] == [110, 110]
+
+
+def test_schedule_assigns_unknown_tables_to_least_busy_worker():
+    schedule = writer._Schedule(2, make_tables(a=100, b=60))
+    schedule.add_written('a', 90)
+
+    assert schedule.get_remaining(0) == 10
+    assert schedule.get_worker('x') == 0
+    # Assigned once and for all.
+    schedule.add_written('b', 60)
+    assert schedule.get_worker('x') == 0
+
+
+def test_schedule_without_statistics():
+    schedule = writer._Schedule(3)
+
+    assert schedule.total_bytes is None
+    assert schedule.get_rows('a') is None
+    assert [schedule.get_worker(table) for table in 'abc'] == [0, 0, 0]
+
+
+def test_eta_is_set_by_the_slowest_worker():
+    w = writer._Writer('postgresql://t', workers=2, tables=make_tables(a=1000, b=600))
+    now = time.monotonic()
+    for worker, written in zip(w._workers, (500, 100)):
+        worker.started_at = now - 10
+        worker.bytes_written = written
+    w._schedule.add_written('a', 500)
+    w._schedule.add_written('b', 100)
+
+    # Worker 0 writes 50 B/s with 500 B left, worker 1 10 B/s with 500 B left.
+    assert w._get_eta() == pytest.approx(50, rel=0.05)
+
+
+def test_eta_assumes_average_rate_for_idle_workers():
+    w = writer._Writer('postgresql://t', workers=2, tables=make_tables(a=1000, b=600))
+    w._workers[0].started_at = time.monotonic() - 10
+    w._workers[0].bytes_written = 500
+    w._schedule.add_written('a', 500)
+
+    assert w._get_eta() == pytest.approx(12, rel=0.05)
+
+
+def test_eta_is_unknown_without_statistics():
+    w = writer._Writer('postgresql://t', workers=2)
+    w._workers[0].started_at = time.monotonic() - 10
+    w._workers[0].bytes_written = 500
+
+    assert w._get_eta() is None
+
+
+BARRIER_DUMP = b"""CREATE TABLE public.a (x text);
+CREATE TABLE public.b (x text);
+INSERT INTO public.a (x) VALUES ('1');
+INSERT INTO public.b (x) VALUES ('2');
+INSERT INTO public.a (x) VALUES ('3');
+ALTER TABLE public.a ADD PRIMARY KEY (x);
+INSERT INTO public.b (x) VALUES ('4');
+INSERT INTO public.a (x) VALUES ('5');
+"""
+
+
+def test_barriers_wait_for_the_batches_before_them():
+    connections: list = []
+    executed: list = []
+
+    class OrderedConnection(FakeConnection):
+        def execute(self, statement):
+            executed.append((connections.index(self), statement.strip().split(b' (')[0]))
+
+        def copy_expert(self, statement, f, size):
+            executed.append((connections.index(self), f.read().strip()))
+
+    async def run():
+        async def chunks():
+            # One statement at a time, so that each makes a batch.
+            for line in BARRIER_DUMP.splitlines(keepends=True):
+                yield line
+
+        return await writer.write_dump_many(
+            ['postgresql://t'],
+            chunks(),
+            workers=2,
+            tables=make_tables(**{'public.a': 100, 'public.b': 50}),
+        )
+
+    with mock.patch('psycopg2.connect', lambda _: OrderedConnection(connections)):
+        errors = asyncio.new_event_loop().run_until_complete(run())
+
+    assert errors == {'postgresql://t': None}
+    order = [statement for _, statement in executed]
+    barrier = order.index(b'ALTER TABLE public.a ADD PRIMARY KEY')
+    # Both `CREATE TABLE` are in the first batch.
+    assert set(order[:barrier]) == {
+        b'CREATE TABLE public.a',
+        b'1',
+        b'2',
+        b'3',
+    }
+    assert set(order[barrier + 1 :]) == {b'4', b'5'}
+    # Barriers run on the first worker, rows on the worker their table is assigned to.
+    workers = {statement: worker for worker, statement in executed}
+    assert workers[b'CREATE TABLE public.a'] == workers[order[barrier]] == 0
+    assert workers[b'1'] == workers[b'3'] == workers[b'5'] == 0
+    assert workers[b'2'] == workers[b'4'] == 1
@@ -0,0 +1,143 @@
+import asyncio
+import hashlib
+from typing import AsyncIterable, AsyncIterator, List, Optional
+
+from voleur import models
+
+
+# Size of the chunks a dump file is checksummed in. Matches the S3 upload part size, so
+# that a corrupt chunk maps to a part.
+CHUNK_SIZE = 16 * 1024 * 1024
+
+
+class ChecksumError(Exception):
+    """Raised when the contents of a dump file don't match its checksum."""
+
+
+class Digest:
+    """Computes the checksum of a stream incrementally, as it flows through: the SHA-256
+    of the whole stream and of each fixed-size chunk of it.
+
+    """
+
+    def __init__(self, chunk_size: int = CHUNK_SIZE):
+        self.size = 0
+        self.chunk_size = chunk_size
+        self.chunk_sha256: List[str] = []
+        self._hash = hashlib.sha256()
+        self._chunk_hash = hashlib.sha256()
+        self._chunk_remaining = chunk_size
+
+    def update(self, data: bytes):
+        self._hash.update(data)
+        self.size += len(data)
+
+        view = memoryview(data)
+        while len(view) >= self._chunk_remaining:
+            self._chunk_hash.update(view[: self._chunk_remaining])
+            view = view[self._chunk_remaining :]
+            self._end_chunk()
+        self._chunk_hash.update(view)
+        self._chunk_remaining -= len(view)
+
+    def result(self) -> models.Checksum:
+        """Returns the checksum of the stream so far, including its last partial chunk.
+
+        Returns:
+            models.Checksum
+
+        """
+        chunk_sha256 = list(self.chunk_sha256)
+        if self._chunk_remaining != self.chunk_size:
+            chunk_sha256.append(self._chunk_hash.hexdigest())
+        return models.Checksum(
+            size=self.size,
+            sha256=self._hash.hexdigest(),
+            chunk_size=self.chunk_size,
+            chunk_sha256=chunk_sha256,
+        )
+
+    def _end_chunk(self):
+        self.chunk_sha256.append(self._chunk_hash.hexdigest())
+        self._chunk_hash = hashlib.sha256()
+        self._chunk_remaining = self.chunk_size
+
+
+async def verify(
+    chunks: AsyncIterable[bytes], checksum: Optional[models.Checksum]
+) -> AsyncIterator[bytes]:
+    """Passes a stream of chunks through, verifying it against a checksum as it flows.
+    Each checksummed chunk is verified as soon as it's complete, and the whole stream
+    at the end. A no-op without a checksum.
+
+    Data is only passed on once the checksummed chunk it's in is verified, so corrupt
+    data never reaches the consumer. This holds back up to one checksummed chunk
+    (`CHUNK_SIZE`) of the stream at a time.
+
+    Args:
+        chunks: Async iterable of the content chunks.
+        checksum: The expected checksum, if known.
+
+    Raises:
+        ChecksumError
+
+    Yields:
+        bytes
+
+    """
+    if not checksum:
+        async for chunk in chunks:
+            yield chunk
+        return
+
+    loop = asyncio.get_event_loop()
+    digest = Digest(checksum.chunk_size)
+    verified = 0
+    # Chunks received but not verified yet, and the offset of the first.
+    pending: List[bytes] = []
+    offset = 0
+    async for chunk in chunks:
+        # Hashing releases the GIL, so it runs in a worker thread.
+        await loop.run_in_executor(None, digest.update, chunk)
+        pending.append(chunk)
+        if len(digest.chunk_sha256) == verified:
+            continue
+        for index in range(verified, len(digest.chunk_sha256)):
+            _verify_chunk(checksum, index, digest.chunk_sha256[index])
+        verified = len(digest.chunk_sha256)
+
+        ready = verified * checksum.chunk_size - offset
+        for ready_chunk in _split_pending(pending, ready):
+            yield ready_chunk
+        offset += ready
+
+    result = digest.result()
+    if result.size != checksum.size:
+        raise ChecksumError(f'Expected {checksum.size} bytes, got {result.size}')
+    for index in range(verified, len(result.chunk_sha256)):
+        _verify_chunk(checksum, index, result.chunk_sha256[index])
+    if result.sha256 != checksum.sha256:
+        raise ChecksumError(f'SHA-256 mismatch: expected {checksum.sha256}')
+    for chunk in pending:
+        yield chunk
+
+
+def _split_pending(pending: List[bytes], size: int) -> List[bytes]:
+    """Removes the first `size` bytes from a list of chunks and returns them as chunks,
+    splitting the last one if it's only partly taken."""
+    taken = []
+    while size > 0:
+        chunk = pending.pop(0)
+        if len(chunk) > size:
+            chunk, rest = chunk[:size], chunk[size:]
+            pending.insert(0, rest)
+        taken.append(chunk)
+        size -= len(chunk)
+    return taken
+
+
+def _verify_chunk(checksum: models.Checksum, index: int, sha256: str):
+    expected = checksum.chunk_sha256[index : index + 1]
+    if [sha256] != expected:
+        offset = index * checksum.chunk_size
+        raise ChecksumError(f'SHA-256 mismatch in chunk {index} (at byte {offset})')
@@ -15,14 +15,20 @@ class Env:
     def get_arg(self, name: str, default: str = None):
         return self._arguments.get(name, default)
 
+    def echo(self, msg: str):
+        print(self._msg(msg))
+
     def info(self, msg: str):
         print(self._msg(msg, color=self.BLUE))
 
     def ok(self, msg: str):
         print(self._msg(msg, color=self.GREEN))
 
-    def die(self, msg: str):
+    def error(self, msg: str):
         print(self._msg(msg, color=self.RED))
+
+    def die(self, msg: str):
+        self.error(msg)
         sys.exit(1)
 
     def _msg(self, msg: str, color: Optional[str] = None):
@@ -1,18 +1,47 @@
+import asyncio
 import functools
-from typing import Callable, Any, List
+import os
+import time
+import zlib
+from typing import Callable, Any, Dict, List, Optional, Tuple
 
+from voleur import checksums
 from voleur import cli
-from voleur import storage
 from voleur import repo
 from voleur import utils
 from voleur import models
 from voleur import dumper
+from voleur import localstore
+from voleur import mapped
+from voleur import metrics
+from voleur import pipeline
+from voleur import plan
+from voleur import spool as spool_
+from voleur import storage
+from voleur import subset
 from voleur import writer
+from voleur import templates
+
+
+# Number of bytes written to a target between progress reports.
+PROGRESS_STEP = 256 * 1024 * 1024
+
+# Max age in seconds of the cached stash metadata used by the read-only commands.
+METADATA_MAX_AGE = 60
 
 
 def stash(env: cli.Env):
     """Runs the `stash` CLI command,.
 
+    With `--spool`, the dump is also written to local disk while it's uploaded. A failed
+    upload is resumed from there, either right away or by stashing the same source
+    again, without extracting the dump again.
+
+    With `--shards`, the tables are extracted by that many klepto processes in parallel.
+
+    With `--sample`, only a sample of the rows, and the rows they reference, are kept,
+    making a subset dump.
+
     Args:
         env: CLI environment.
 
@@ -21,54 +50,658 @@ def stash(env: cli.Env):
     bucket = env.get_arg('-b')
     tags = env.get_arg('-t')
     klepto_config = env.get_arg('-c')
+    spool_dir = env.get_arg('--spool')
+    shards = env.get_arg('--shards') or '1'
+    if not shards.isdigit() or int(shards) < 1:
+        return env.die(f'❌ Invalid number of shards: {shards}')
+    sample = None
+    if env.get_arg('--sample'):
+        try:
+            sample = subset.parse_sample(env.get_arg('--sample'))
+        except ValueError as e:
+            return env.die(f'❌ {e}')
+    run_metrics = metrics.Metrics('stash')
 
-    env.info('💭 Extracting dump...')
+    path = f'{bucket}/{utils.generate_dump_filename()}'
+    spool = None
+    if spool_dir:
+        spec = sample.spec if sample else None
+        source_key = spool_.get_source_key(source, klepto_config, sample=spec)
+        spool = spool_.find(spool_dir, bucket, source_key)
+        if spool:
+            env.info(f'🔁 Resuming upload of spooled dump: {spool.dump_path}')
+        else:
+            spool = spool_.create(spool_dir, path, source_key, sample=spec)
 
     try:
-        with dumper.extract_dump(source, klepto_config=klepto_config) as stream:
-            path = f'{bucket}/{utils.generate_dump_filename()}'
-            storage_url = storage.store_stream('s3', path, stream)
+        if spool and spool.complete:
+            stashed = pipeline.run(pipeline.upload_spool(spool))
+        else:
+            env.info('💭 Extracting dump...')
+            stashed = pipeline.run(
+                pipeline.stash(
+                    source,
+                    path,
+                    klepto_config=klepto_config,
+                    metrics=run_metrics,
+                    spool=spool,
+                    shards=int(shards),
+                    sample=sample,
+                ),
+                report=run_metrics,
+            )
     except dumper.DumperError as e:
+        if spool:
+            spool.remove()
         env.die(f'❌ Dumper error: {e}')
+    except checksums.ChecksumError as e:
+        if spool:
+            spool.remove()
+        env.die(f'❌ Spooled dump is corrupt: {e}')
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        if not spool or not spool.complete:
+            raise
+        env.die(f'❌ Upload failed: {e}. Stash again to resume the upload.')
+    finally:
+        _report_metrics(env, run_metrics)
 
-    env.info(f'💩 Dump extracted: {storage_url}')
+    env.info(f'💩 Dump extracted: {stashed.storage_url}')
 
     stash = repo.StashRepo.load(bucket)
-    update_fn = functools.partial(_add_dump, storage_url, tags=tags)
+    update_fn = functools.partial(_add_dump, stashed, tags=tags)
     dump = _safely_update_stash(update_fn, stash)
+    if spool:
+        spool.remove()
 
     env.ok(f'✅ Dump stashed: id: {dump.dump_id}, tags: {stash.get_tags(dump.dump_id)}')
 
 
+def stash_many(env: cli.Env):
+    """Runs the `stash-many` CLI command.
+
+    Stashes the sources of a plan in a single process, at most the plan's `concurrency`
+    at a time and highest priority first. The stashes share the S3 connection pool,
+    and their dumps are added to the stash metadata in a single update at the end. A
+    source failing does not stop the rest.
+
+    Args:
+        env: CLI environment.
+
+    """
+    bucket = env.get_arg('-b')
+    spool_dir = env.get_arg('--spool')
+    try:
+        stash_plan = plan.load(env.get_arg('<plan>'))
+    except plan.PlanError as e:
+        return env.die(f'❌ {e}')
+
+    count, concurrency = len(stash_plan.entries), stash_plan.concurrency
+    env.info(f'💭 Stashing {count} source(s), {concurrency} at a time...')
+    results = pipeline.run(_stash_plan(env, stash_plan, bucket, spool_dir))
+
+    stashed = []
+    failed = 0
+    for entry, result in zip(stash_plan.entries, results):
+        if isinstance(result, Exception):
+            env.error(f'❌ {entry.name}: Stash failed: {result}')
+            failed += 1
+        else:
+            stashed.append((entry, *result))
+
+    if stashed:
+        stash = repo.StashRepo.load(bucket)
+        update_fn = functools.partial(
+            _add_dumps, [(result, entry.tags) for entry, result, _ in stashed]
+        )
+        dumps = _safely_update_stash(update_fn, stash)
+        for (entry, _, spool), dump in zip(stashed, dumps):
+            if spool:
+                spool.remove()
+            tags = stash.get_tags(dump.dump_id)
+            env.ok(f'✅ {entry.name}: Dump stashed: id: {dump.dump_id}, tags: {tags}')
+
+    if failed:
+        env.die(f'❌ Stash failed for {failed} source(s)')
+
+
 def restore(env: cli.Env):
     """Runs the `restore` CLI command,.
 
+    The dump is downloaded once and written to all the targets in parallel. A failure
+    restoring to one target does not abort the rest.
+
+    With `--template`, the dump is restored once per server into a template database
+    and the targets are created as copies of it.
+
     Args:
         env: CLI environment.
 
     """
     dump_id_or_tag = env.get_arg('<dump>')
-    target = env.get_arg('<target>')
+    targets = env.get_arg('<target>')
     bucket = env.get_arg('-b')
+    workers = env.get_arg('-j') or '1'
+    if not workers.isdigit() or int(workers) < 1:
+        return env.die(f'❌ Invalid number of workers: {workers}')
 
     stash = repo.StashRepo.load(bucket)
     dump = stash.get_dump(dump_id_or_tag)
     if not dump:
         return env.die(f'❌ Dump not found: {dump_id_or_tag}')
 
-    env.info(f'🥤 Restoring dump...')
+    env.info(f'🥤 Restoring dump to {len(targets)} target(s)...')
+
+    run_metrics = metrics.Metrics('restore')
+    errors: Dict[str, Optional[Exception]]
+    try:
+        if env.get_arg('--template'):
+            errors = _restore_from_templates(env, stash, dump, targets, run_metrics)
+        else:
+            errors = _restore_from_storage(env, dump, targets, run_metrics)
+    except checksums.ChecksumError as e:
+        env.die(f'❌ Dump is corrupt: {e}')
+    finally:
+        _report_metrics(env, run_metrics)
+
+    for target, error in errors.items():
+        if error:
+            env.error(f'❌ Restore failed: {utils.redact_uri(target)}: {error}')
+        else:
+            env.ok(f'✅ Dump restored: id: {dump.dump_id}, {utils.redact_uri(target)}')
+
+    failed = [target for target, error in errors.items() if error]
+    if failed:
+        env.die(f'❌ Dump restore failed for {len(failed)} target(s)')
+
+
+async def _stash_plan(
+    env: cli.Env, stash_plan: plan.Plan, bucket: str, spool_dir: Optional[str] = None
+) -> List[Any]:
+    """Stashes the sources of a plan concurrently, up to its concurrency. The stashes
+    are started in plan order, so the highest priority ones go first.
+
+    Returns:
+        List[Any]: The `(Stashed, Optional[Spool])` of each entry, or the exception it
+            failed with.
+
+    """
+    slots = asyncio.Semaphore(stash_plan.concurrency)
+
+    async def run_entry(entry: plan.PlanEntry) -> Any:
+        async with slots:
+            try:
+                return await _stash_entry(env, entry, bucket, spool_dir)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                return e
+
+    return await asyncio.gather(*(run_entry(entry) for entry in stash_plan.entries))
+
+
+async def _stash_entry(
+    env: cli.Env, entry: plan.PlanEntry, bucket: str, spool_dir: Optional[str] = None
+) -> Tuple[pipeline.Stashed, Optional[spool_.Spool]]:
+    """Stashes the source of a plan entry, resuming it from a spooled dump if there's
+    one, like the `stash` command.
+
+    Raises:
+        dumper.DumperError
+        checksums.ChecksumError
+        storage.StorageError
+
+    Returns:
+        Tuple[pipeline.Stashed, Optional[spool_.Spool]]: The stashed dump and its spool,
+            to remove once the dump is added to the stash.
+
+    """
+    path = f'{bucket}/{utils.generate_dump_filename()}'
+    sample = subset.parse_sample(entry.sample) if entry.sample else None
+    spec = sample.spec if sample else None
+    spool = None
+    if spool_dir:
+        source_key = spool_.get_source_key(entry.source, entry.config, sample=spec)
+        spool = spool_.find(spool_dir, bucket, source_key)
+        if spool:
+            env.info(f'🔁 {entry.name}: Resuming upload of spooled dump')
+        else:
+            spool = spool_.create(spool_dir, path, source_key, sample=spec)
+
+    run_metrics = metrics.Metrics('stash')
+    try:
+        if spool and spool.complete:
+            stashed = await pipeline.upload_spool(spool)
+        else:
+            env.info(f'💭 {entry.name}: Extracting dump...')
+            stashed = await pipeline.stash(
+                entry.source,
+                path,
+                klepto_config=entry.config,
+                metrics=run_metrics,
+                spool=spool,
+                shards=entry.shards,
+                sample=sample,
+            )
+    except (dumper.DumperError, checksums.ChecksumError):
+        if spool:
+            spool.remove()
+        raise
+    finally:
+        run_metrics.finish()
+
+    if run_metrics.get_bottleneck():
+        env.info(f'📊 {entry.name}: {run_metrics.summary()}')
+    env.info(f'💩 {entry.name}: Dump extracted: {stashed.storage_url}')
+    return stashed, spool
+
+
+def prefetch(env: cli.Env):
+    """Runs the `prefetch` CLI command.
+
+    Downloads the dumps of the given tags into the local dump store, uncompressed, so
+    that restoring them starts straight from local disk. With `--watch`, it keeps
+    polling the stash metadata, which is a conditional request answered without a body
+    while nothing changes, and downloads a tag's dump whenever the tag moves.
+
+    The least recently used dumps are evicted to keep the store under `--max-size`,
+    except the current dumps of the watched tags. Downloads are throttled to
+    `--max-rate`, if given.
+
+    Args:
+        env: CLI environment.
+
+    """
+    tags = env.get_arg('<tag>')
+    bucket = env.get_arg('-b')
+    dump_dir = env.get_arg('--dump-dir') or localstore.DEFAULT_DIR
+    interval = env.get_arg('--interval') or '60'
+    if not interval.isdigit() or int(interval) < 1:
+        return env.die(f'❌ Invalid interval: {interval}')
+
+    limits = {}
+    for name in ('--max-rate', '--max-size'):
+        value = env.get_arg(name)
+        try:
+            limits[name] = utils.parse_size(value) if value else None
+        except ValueError:
+            return env.die(f'❌ Invalid {name[2:]}: {value}')
+
+    os.makedirs(dump_dir, exist_ok=True)
+    localstore.clean(dump_dir)
+
+    while True:
+        try:
+            stash = repo.StashRepo.load(bucket)
+        except (storage.StorageError, OSError) as e:
+            failed = len(tags)
+            env.error(f'❌ Cannot load the stash: {e}')
+        else:
+            failed = 0
+            dumps = [stash.get_dump(tag) for tag in tags]
+            keep = [dump.dump_id for dump in dumps if dump]
+            for tag, dump in zip(tags, dumps):
+                if not dump:
+                    env.error(f'❌ Dump not found: {tag}')
+                    failed += 1
+                elif not _prefetch_dump(env, dump, dump_dir, keep, limits):
+                    failed += 1
+
+        if not env.get_arg('--watch'):
+            break
+        time.sleep(int(interval))
+
+    if failed:
+        env.die(f'❌ Prefetch failed for {failed} tag(s)')
+
+
+def _prefetch_dump(
+    env: cli.Env,
+    dump: models.Dump,
+    dump_dir: str,
+    keep: List[str],
+    limits: Dict[str, Optional[int]],
+) -> bool:
+    """Downloads a dump into the local dump store, unless it's already there, making
+    room for it within the store's max size.
+
+    Returns:
+        bool: Whether the dump is in the store.
+
+    """
+    path = localstore.get_path(dump_dir, dump.dump_id)
+    if localstore.find(dump_dir, dump.dump_id, dump.checksum):
+        return True
+
+    max_size = limits['--max-size']
+    if max_size is not None:
+        # The statistics give the size of the rows, which is most of an uncompressed
+        # dump. Dumps stashed before they were recorded reserve nothing.
+        reserve = sum(table.size for table in dump.tables)
+        if reserve > max_size:
+            size = utils.format_size(reserve)
+            env.error(f'❌ Dump {dump.dump_id} is too big for the store: {size}')
+            return False
+        for dump_id in localstore.evict(dump_dir, max_size, keep=keep, reserve=reserve):
+            env.info(f'🧹 Evicted local dump: {dump_id}')
+
+    env.info(f'📥 Prefetching dump {dump.dump_id}...')
+    run_metrics = metrics.Metrics('prefetch')
+    try:
+        size = pipeline.run(
+            pipeline.download(
+                dump.storage_url,
+                path,
+                checksum=dump.checksum,
+                max_rate=limits['--max-rate'],
+                metrics=run_metrics,
+            ),
+            report=run_metrics,
+        )
+    except (checksums.ChecksumError, zlib.error) as e:
+        env.error(f'❌ Dump {dump.dump_id} is corrupt: {e}')
+        return False
+    except (storage.StorageError, OSError) as e:
+        env.error(f'❌ Prefetch of dump {dump.dump_id} failed: {e}')
+        return False
+    finally:
+        _report_metrics(env, run_metrics)
+
+    localstore.mark_verified(dump_dir, dump.dump_id, dump.checksum)
+    if max_size is not None:
+        localstore.evict(dump_dir, max_size, keep=keep)
+    env.ok(f'✅ Dump prefetched: id: {dump.dump_id}, {utils.format_size(size)}: {path}')
+    return True
+
+
+def list_dumps(env: cli.Env):
+    """Runs the `list` CLI command: prints the dumps in the stash, newest first, with
+    their tags.
+
+    Served from the local metadata cache if it's recent enough, unless `--refresh` is
+    given.
+
+    Args:
+        env: CLI environment.
+
+    """
+    stash = _load_stash_for_reading(env)
 
-    with storage.stream_storage_url(dump.storage_url) as stream:
-        writer.write_dump(target, stream)
+    for dump in sorted(stash.dumps, key=lambda d: d.timestamp, reverse=True):
+        tags = ','.join(stash.get_tags(dump.dump_id)) or '-'
+        env.echo(f'{dump.dump_id}\t{dump.timestamp}\t{tags}\t{dump.storage_url}')
 
-    env.ok(f'✅ Dump restored: id: {dump.dump_id}')
 
+def show(env: cli.Env):
+    """Runs the `show` CLI command: prints the details of a dump.
 
-def _add_dump(storage_url: str, stash: models.Stash, tags: List[str] = None):
+    Served from the local metadata cache if it's recent enough, unless `--refresh` is
+    given.
+
+    Args:
+        env: CLI environment.
+
+    """
+    dump_id_or_tag = env.get_arg('<dump>')
+
+    stash = _load_stash_for_reading(env)
+    dump = stash.get_dump(dump_id_or_tag)
+    if not dump:
+        return env.die(f'❌ Dump not found: {dump_id_or_tag}')
+
+    for line in _describe_dump(stash, dump):
+        env.echo(line)
+
+
+def _load_stash_for_reading(env: cli.Env) -> models.Stash:
+    """Loads the stash for a read-only command, allowing a cached copy."""
+    max_age = None if env.get_arg('--refresh') else METADATA_MAX_AGE
+    return repo.StashRepo.load(env.get_arg('-b'), max_age=max_age)
+
+
+def _describe_dump(stash: models.Stash, dump: models.Dump) -> List[str]:
+    """Returns the lines describing a dump for the `show` command.
+
+    Args:
+        stash: The stash the dump belongs to.
+        dump: The dump to describe.
+
+    Returns:
+        List[str]
+
+    """
+    size = utils.format_size(dump.size) if dump.size is not None else '-'
+    rows = dump.rows if dump.rows is not None else '-'
+    sha256 = dump.checksum.sha256 if dump.checksum else '-'
+    lines = [
+        f'id:          {dump.dump_id}',
+        f'timestamp:   {dump.timestamp}',
+        f'tags:        {", ".join(stash.get_tags(dump.dump_id)) or "-"}',
+        f'storage url: {dump.storage_url}',
+        f'size:        {size}',
+        f'rows:        {rows}',
+        f'sha256:      {sha256}',
+        f'sample:      {dump.sample or "-"}',
+    ]
+    if dump.tables:
+        lines.append('tables:')
+        for table in sorted(dump.tables, key=lambda t: t.size, reverse=True):
+            compressed = utils.format_size(table.compressed_size)
+            lines.append(
+                f'  {table.table}: {utils.format_size(table.size)} '
+                f'({compressed} compressed), {table.rows} rows'
+            )
+    return lines
+
+
+def _restore_from_storage(
+    env: cli.Env,
+    dump: models.Dump,
+    targets: List[str],
+    run_metrics: Optional[metrics.Metrics] = None,
+) -> Dict[str, Optional[Exception]]:
+    """Runs the restore pipeline, streaming the dump from storage and writing it to
+    all the targets, each over `-j` connections.
+
+    If the dump is in the local dump store, it's restored from there instead, with `-j`
+    worker processes.
+
+    Args:
+        env: CLI environment.
+        dump: The dump to restore.
+        targets: Target database URIs.
+        run_metrics (optional): Metrics to record the run into.
+
+    Returns:
+        Dict[str, Optional[Exception]]: Mapping of target -> error, `None` on success.
+
+    """
+    on_progress = _make_progress_reporter(env)
+    workers = int(env.get_arg('-j') or 1)
+
+    dump_dir = env.get_arg('--dump-dir') or localstore.DEFAULT_DIR
+    local_path = localstore.find(dump_dir, dump.dump_id, dump.checksum)
+    if local_path:
+        env.info(f'📂 Restoring from local dump: {local_path}')
+        localstore.touch(local_path)
+        main = mapped.restore_file(
+            local_path,
+            targets,
+            on_progress=on_progress,
+            metrics=run_metrics,
+            workers=workers,
+        )
+    else:
+        main = pipeline.restore(
+            dump.storage_url,
+            targets,
+            on_progress=on_progress,
+            metrics=run_metrics,
+            checksum=dump.checksum,
+            workers=workers,
+            tables=dump.tables,
+        )
+    errors = pipeline.run(main, report=run_metrics)
+    return dict(errors)
+
+
+def _restore_from_templates(
+    env: cli.Env,
+    stash: models.Stash,
+    dump: models.Dump,
+    targets: List[str],
+    run_metrics: Optional[metrics.Metrics] = None,
+) -> Dict[str, Optional[Exception]]:
+    """Creates the targets as copies of the dump's template database, restoring the
+    dump into a template first on any server which doesn't have one. Templates of the
+    stash's dumps no longer referenced by a tag are evicted afterwards.
+
+    Args:
+        env: CLI environment.
+        stash: The stash the dump belongs to.
+        dump: The dump to restore.
+        targets: Target database URIs. The databases must not exist.
+        run_metrics (optional): Metrics to record the template restore into.
+
+    Returns:
+        Dict[str, Optional[Exception]]: Mapping of target -> error, `None` on success.
+
+    """
+    errors: Dict[str, Optional[Exception]] = {}
+    servers: Dict[str, List[str]] = {}
+    for target in targets:
+        servers.setdefault(templates.get_server_uri(target), []).append(target)
+
+    # Restore the dump into a staging template on every server missing one. All
+    # templates are written from a single download.
+    staging: Dict[str, str] = {}
+    for server, server_targets in servers.items():
+        try:
+            if templates.template_exists(server, stash.bucket, dump.dump_id):
+                continue
+            templates.begin_template(server, stash.bucket, dump.dump_id)
+        except templates.TemplateError as e:
+            errors.update((target, e) for target in server_targets)
+            continue
+        staging[templates.get_template_uri(server, stash.bucket, dump.dump_id)] = server
+
+    if staging:
+        env.info(f'🥤 Building template on {len(staging)} server(s)...')
+        results = _restore_from_storage(env, dump, list(staging), run_metrics)
+        for template_uri, error in results.items():
+            server = staging[template_uri]
+            try:
+                if error:
+                    templates.abort_template(server, stash.bucket, dump.dump_id)
+                else:
+                    templates.commit_template(server, stash.bucket, dump.dump_id)
+            except templates.TemplateError as e:
+                error = error or e
+            if error:
+                errors.update((target, error) for target in servers[server])
+
+    keep = set(stash.tags.values()) | {dump.dump_id}
+    for server, server_targets in servers.items():
+        if any(errors.get(target) for target in server_targets):
+            continue
+        for target in server_targets:
+            try:
+                templates.clone_template(target, stash.bucket, dump.dump_id)
+                errors[target] = None
+            except templates.TemplateError as e:
+                errors[target] = e
+        try:
+            evicted = templates.evict_templates(server, stash.bucket, keep=keep)
+        except templates.TemplateError as e:
+            env.error(f'❌ Template eviction failed: {utils.redact_uri(server)}: {e}')
+            continue
+        if evicted:
+            env.info(f'🧹 Evicted templates: {", ".join(evicted)}')
+
+    return errors
+
+
+def _report_metrics(env: cli.Env, run_metrics: metrics.Metrics):
+    """Reports the bottleneck stage of a pipeline run and writes its metrics to the
+    `--metrics` path, if given.
+
+    Args:
+        env: CLI environment.
+        run_metrics: The metrics of the run.
+
+    """
+    run_metrics.finish()
+
+    bottleneck = run_metrics.get_bottleneck()
+    if bottleneck:
+        env.info(
+            f'📊 {run_metrics.summary()}\n'
+            f'📊 Bottleneck: {bottleneck.name} '
+            f'(busy {bottleneck.busy_seconds:.1f}s of {run_metrics.elapsed_seconds:.1f}s)'
+        )
+
+    path = env.get_arg('--metrics')
+    if path:
+        run_metrics.write(path)
+
+
+def _make_progress_reporter(
+    env: cli.Env, step: int = PROGRESS_STEP
+) -> Callable[[writer.Progress], None]:
+    """Returns a progress callback which reports every table written to a target, and
+    the time remaining every `step` bytes written, if known from the dump's statistics.
+
+    Args:
+        env: CLI environment.
+        step: Number of bytes between reports.
+
+    Returns:
+        Callable[[writer.Progress], None]
+
+    """
+    last: Dict[str, tuple] = {}
+
+    def on_progress(progress: writer.Progress):
+        target = utils.redact_uri(progress.target)
+        table, table_rows, reported = last.get(progress.target, (None, 0, 0))
+
+        if progress.completed_table:
+            completed, rows = progress.completed_table, progress.table_rows
+            env.info(f'📦 {target}: {completed}: {rows} rows')
+        elif progress.total_bytes is None and table and table != progress.table:
+            # Without statistics, a table is done when the next one starts.
+            env.info(f'📦 {target}: {table}: {table_rows} rows')
+        if progress.bytes_written - reported >= step:
+            size = utils.format_size(progress.bytes_written)
+            if progress.total_bytes:
+                size += f' of {utils.format_size(progress.total_bytes)}'
+            message = f'⏳ {target}: {size} written, {progress.rows_written} rows'
+            if progress.eta_seconds is not None:
+                message += f', ~{_format_duration(progress.eta_seconds)} left'
+            env.info(message)
+            reported = progress.bytes_written
+
+        last[progress.target] = (progress.table, progress.table_rows, reported)
+
+    return on_progress
+
+
+def _format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f'{hours}h{minutes:02d}m'
+    if minutes:
+        return f'{minutes}m{seconds:02d}s'
+    return f'{seconds}s'
+
+
+def _add_dump(stashed: pipeline.Stashed, stash: models.Stash, tags: List[str] = None):
     """Adds a new dump (with optional tag) to the stash.
 
     Args:
-        storage_url: URL to the dump file.
+        stashed: The stashed dump file.
         stash: The stash to add the dump to.
         tags: Optional tags.
 
@@ -76,10 +709,31 @@ def _add_dump(storage_url: str, stash: models.Stash, tags: List[str] = None):
         Dump: The newly added dump.
 
     """
-    dump = stash.add_dump(storage_url)
+    dump = stash.add_dump(
+        stashed.storage_url,
+        checksum=stashed.checksum,
+        tables=stashed.tables,
+        sample=stashed.sample,
+    )
     return stash.tag_dump(dump, tags or [])
 
 
+def _add_dumps(
+    stashed: List[Tuple[pipeline.Stashed, List[str]]], stash: models.Stash
+) -> List[models.Dump]:
+    """Adds many new dumps, with their tags, to the stash.
+
+    Args:
+        stashed: The stashed dump files and their tags.
+        stash: The stash to add the dumps to.
+
+    Returns:
+        List[Dump]: The newly added dumps.
+
+    """
+    return [_add_dump(result, stash, tags=tags) for result, tags in stashed]
+
+
 def _safely_update_stash(
     update_fn: Callable, stash: models.Stash, tries: int = 5
 ) -> Any:
@@ -1,129 +1,491 @@
+import asyncio
 import os
+import re
 import subprocess
-import contextlib
 import platform
-from typing import ContextManager, Iterator, List, Optional, BinaryIO, cast
+import tempfile
+from typing import AsyncIterable, AsyncIterator, Callable, Dict, List, Optional, Set
+from typing import Tuple
 
-from voleur import utils
+from voleur import stats
 
 
 DEFAULT_KLEPTO_CONFIG = 'klepto.toml'
 KLEPTO_VERSION = '0.2'
 ERR_SYMBOL = '⨯'
 
+# Size of the chunks read from klepto's stdout.
+CHUNK_SIZE = 1024 * 1024
+
+# Max number of chunks buffered from the klepto shards before they block.
+SHARD_QUEUE_SIZE = 8
+
+# Estimated size of each table of the source database, used for balancing the shards.
+# Klepto names tables without their schema, so same-named tables of different schemas
+# count as one.
+_TABLE_SIZES_SQL = """
+    SELECT c.relname, sum(pg_table_size(c.oid))
+    FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE c.relkind = 'r' AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+    GROUP BY c.relname
+"""
+
+_INSERT_PREFIX = b'INSERT INTO '
+
+# The header of a pg_dump output. Klepto outputs the structure with two pg_dump runs,
+# one before the data and one after (indexes, constraints, triggers...).
+_PG_DUMP_HEADER = b'-- PostgreSQL database dump'
+
+# The table name of a raw klepto `INSERT` line, possibly qualified and quoted.
+_INSERT_TABLE = re.compile(
+    rb'INSERT INTO\s+(?:(?:"[^"]*"|[^\s(".]+)\.)?("[^"]*"|[^\s(".]+)'
+)
+
+# A header line in a TOML file, starting a (sub-)table of the klepto config.
+_TOML_HEADER = re.compile(r'^[ \t]*\[', re.MULTILINE)
+_TOML_TABLES_HEADER = re.compile(r'\s*\[\[\s*Tables\s*\]\]')
+_TOML_NAME = re.compile(r'^[ \t]*Name[ \t]*=[ \t]*"([^"]*)"', re.MULTILINE)
+_TOML_IGNORE_DATA = re.compile(r'^[ \t]*IgnoreData[ \t]*=.*\n?', re.MULTILINE)
+
 
 class DumperError(Exception):
     """Raised on any error encountered while dumping 💩"""
 
 
-def extract_dump(
-    source_uri: str, klepto_config: Optional[str] = None,
-) -> ContextManager[BinaryIO]:
+async def extract_dump(
+    source_uri: str, klepto_config: Optional[str] = None, shards: int = 1,
+) -> AsyncIterator[bytes]:
     """Extracts and anonymizes a dump from the source database.
 
-    Returns a context manager which yields a stream containing SQL statements for
-    recostructing the extracted database structure and rows.
+    An async generator yielding chunks of raw klepto output. The output needs to be
+    passed through `rewrite_dump` to get valid SQL statements.
+
+    With more than one shard, the tables are split into that many groups of about the
+    same estimated size, each extracted by its own klepto process, and the outputs are
+    merged into one dump (see `_merge_shards`).
 
     Args:
         source_uri: Source database URI.
         klepto_config (optional): Path to a klepto config file
+        shards (optional): Number of klepto processes to extract the tables with.
 
-    Returns:
-        ContextManager[BinaryIO]
+    Raises:
+        DumperError: If there's an error in running klepto, in any of the shards.
+
+    Yields:
+        bytes
 
     """
     if not klepto_config:
         klepto_config = DEFAULT_KLEPTO_CONFIG
     _validate_klepto_config(klepto_config)
-    return _klepto_steal(source_uri, config=klepto_config)
 
+    if shards > 1:
+        loop = asyncio.get_event_loop()
+        sizes = await loop.run_in_executor(None, _get_table_sizes, source_uri)
+        groups = partition_tables(sizes, shards)
+        if len(groups) > 1:
+            async for chunk in _extract_sharded(source_uri, klepto_config, groups):
+                yield chunk
+            return
+
+    async for chunk in _klepto_steal(source_uri, config=klepto_config):
+        yield chunk
+
+
+def partition_tables(sizes: Dict[str, int], shards: int) -> List[List[str]]:
+    """Partitions tables into groups of about the same total size, by assigning them
+    largest first to the smallest group. There are fewer groups than shards if there
+    are fewer tables.
+
+    Args:
+        sizes: Mapping of table -> estimated size.
+        shards: Number of groups to partition the tables into.
+
+    Returns:
+        List[List[str]]: The groups of tables, largest first.
+
+    """
+    count = min(shards, len(sizes))
+    loads = [0] * count
+    groups: List[List[str]] = [[] for _ in range(count)]
+    for table in sorted(sizes, key=lambda t: (-sizes[t], t)):
+        index = min(range(count), key=loads.__getitem__)
+        loads[index] += sizes[table]
+        groups[index].append(table)
+    return [groups[i] for i in sorted(range(count), key=lambda i: -loads[i])]
+
+
+async def rewrite_dump(
+    chunks: AsyncIterable[bytes], tables: Optional[stats.TableStatsCollector] = None
+) -> AsyncIterator[bytes]:
+    """Fixes the invalid SQL statements in klepto's output.
+
+    Args:
+        chunks: Chunks of raw klepto output.
+        tables (optional): Collector of the statistics of each table in the dump.
+
+    Yields:
+        bytes: Chunks made of whole, fixed lines.
+
+    """
+    leftover = b''
+
+    async for data in chunks:
+        lines = (leftover + data).split(b'\n')
+        leftover = lines.pop()
+        processed = [_process_stdout_line(line + b'\n') for line in lines]
+        if tables:
+            tables.add_lines(processed)
+        yield b''.join(processed)
+
+    if leftover:
+        processed = [_process_stdout_line(leftover)]
+        if tables:
+            tables.add_lines(processed)
+        yield processed[0]
+
+
+async def _extract_sharded(
+    source_uri: str, klepto_config: str, groups: List[List[str]]
+) -> AsyncIterator[bytes]:
+    """Extracts each group of tables with its own klepto process, with a config in
+    which the data of the rest of the tables is ignored, and merges the outputs.
+
+    Args:
+        source_uri: Source database URI.
+        klepto_config: Path to the klepto config file.
+        groups: The groups of tables to extract.
+
+    Raises:
+        DumperError: If there's an error in running klepto, in any of the shards.
+
+    Yields:
+        bytes
+
+    """
+    with open(klepto_config) as f:
+        config = f.read()
+    all_tables = {table for group in groups for table in group}
+
+    paths = []
+    try:
+        for group in groups:
+            fd, path = tempfile.mkstemp(prefix='voleur-shard-', suffix='.toml')
+            paths.append(path)
+            with os.fdopen(fd, 'w') as f:
+                f.write(make_shard_config(config, all_tables - set(group)))
+
+        outputs = [
+            _klepto_steal(source_uri, config=path, name=f'klepto #{i}')
+            for i, path in enumerate(paths, 1)
+        ]
+        async for chunk in _merge_shards(outputs, groups):
+            yield chunk
+    finally:
+        for path in paths:
+            os.remove(path)
+
+
+async def _merge_shards(
+    outputs: List[AsyncIterator[bytes]], groups: List[List[str]]
+) -> AsyncIterator[bytes]:
+    """Merges the outputs of the klepto shards into one dump, as they're produced.
+
+    Every shard outputs the structure of the whole database before any data. The first
+    shard's output is kept whole, while only the `INSERT` lines of the rest are, from
+    once the first shard is done with the structure. The outputs are merged in chunks
+    of whole lines. The statements the first shard outputs after its data (e.g indexes
+    and foreign keys) are held back until every shard is done with its data. They start
+    at the first shard's first `INSERT`, or at its second pg_dump header if it has no
+    data of its own.
+
+    Each shard only keeps the rows of the tables of its group. The rows of any other
+    table, e.g one created after the tables were partitioned, are kept by the first
+    shard only, so that they're never duplicated.
+
+    The first error in any shard stops the rest and is raised.
 
-@contextlib.contextmanager
-def _klepto_steal(from_uri: str, *, config: str) -> Iterator[BinaryIO]:
+    Args:
+        outputs: The outputs of the shards, the first one's structure being kept.
+        groups: The tables of each shard.
+
+    Raises:
+        DumperError
+
+    Yields:
+        bytes
+
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=SHARD_QUEUE_SIZE)
+    structure_done = asyncio.Event()
+
+    others = {table for group in groups[1:] for table in group}
+    owners: List[Callable[[str], bool]] = [lambda table: table not in others]
+    owners.extend(set(group).__contains__ for group in groups[1:])
+    tasks = [
+        asyncio.ensure_future(
+            _read_shard(output, queue, structure_done, owns, primary=i == 0)
+        )
+        for i, (output, owns) in enumerate(zip(outputs, owners))
+    ]
+
+    try:
+        remaining = len(tasks)
+        while remaining:
+            item = await queue.get()
+            if item is None:
+                remaining -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+        post_data = await tasks[0]
+        if post_data:
+            yield post_data
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def _read_shard(
+    chunks: AsyncIterator[bytes],
+    queue: asyncio.Queue,
+    structure_done: asyncio.Event,
+    owns: Callable[[str], bool],
+    primary: bool,
+) -> bytes:
+    """Reads the output of a klepto shard into the merge queue, in chunks of whole
+    lines, followed by `None` at the end or the error it failed with. Only the `INSERT`
+    lines of the tables the shard owns are kept.
+
+    Args:
+        chunks: The shard's output.
+        queue: The merge queue.
+        structure_done: Set by the primary shard once it's done with the structure.
+        owns: Returns whether the shard owns the rows of a table.
+        primary: Whether it's the primary shard, whose structure is kept.
+
+    Returns:
+        bytes: The lines after the data of the primary shard, which are held back.
+
+    """
+    post_data: List[bytes] = []
+    headers = 0
+    if not primary:
+        await structure_done.wait()
+    try:
+        leftover = b''
+        async for data in chunks:
+            lines = (leftover + data).split(b'\n')
+            leftover = lines.pop()
+            if primary and not structure_done.is_set():
+                index, headers = _find_structure_end(lines, headers)
+                if index is None:
+                    await _put_lines(queue, lines)
+                    continue
+                await _put_lines(queue, lines[:index])
+                lines = lines[index:]
+                structure_done.set()
+            if primary:
+                post_data.extend(
+                    line for line in lines if not line.startswith(_INSERT_PREFIX)
+                )
+            await _put_lines(queue, [line for line in lines if _owns_row(owns, line)])
+        if leftover:
+            if _owns_row(owns, leftover):
+                await _put_lines(queue, [leftover])
+            elif primary and not leftover.startswith(_INSERT_PREFIX):
+                post_data.append(leftover)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        await queue.put(e)
+        return b''
+    finally:
+        if primary:
+            structure_done.set()
+    await queue.put(None)
+    return b''.join(line + b'\n' for line in post_data)
+
+
+def _find_structure_end(lines: List[bytes], headers: int) -> Tuple[Optional[int], int]:
+    """Returns the index of the line the structure ends at, if any, and the number of
+    pg_dump headers seen so far. The structure ends at the first `INSERT`, or at the
+    second pg_dump header, which starts the statements after the data."""
+    for i, line in enumerate(lines):
+        if line.startswith(_INSERT_PREFIX):
+            return i, headers
+        if line.rstrip() == _PG_DUMP_HEADER:
+            headers += 1
+            if headers > 1:
+                return i, headers
+    return None, headers
+
+
+async def _put_lines(queue: asyncio.Queue, lines: List[bytes]):
+    if lines:
+        await queue.put(b''.join(line + b'\n' for line in lines))
+
+
+def _owns_row(owns: Callable[[str], bool], line: bytes) -> bool:
+    """Returns True if the line is an `INSERT` into a table the shard owns."""
+    if not line.startswith(_INSERT_PREFIX):
+        return False
+    match = _INSERT_TABLE.match(line)
+    if not match:
+        return True
+    name = match.group(1).decode('utf-8')
+    if name.startswith('"'):
+        name = name[1:-1].replace('""', '"')
+    return owns(name)
+
+
+def make_shard_config(config: str, ignored: Set[str]) -> str:
+    """Makes the klepto config of a shard from the full config, by ignoring the data of
+    the tables extracted by the other shards. The rest of the config (e.g anonymisation
+    rules and filters) is kept as is.
+
+    Args:
+        config: The full klepto config (TOML).
+        ignored: Tables whose data is ignored.
+
+    Returns:
+        str
+
+    """
+    blocks = []
+    missing = set(ignored)
+    starts = [m.start() for m in _TOML_HEADER.finditer(config)]
+    for start, end in zip([0] + starts, starts + [len(config)]):
+        block = config[start:end]
+        name = _TOML_NAME.search(block)
+        if _TOML_TABLES_HEADER.match(block) and name and name.group(1) in ignored:
+            header, _, rest = _TOML_IGNORE_DATA.sub('', block).partition('\n')
+            block = f'{header}\n  IgnoreData = true\n{rest}'
+            missing.discard(name.group(1))
+        blocks.append(block)
+
+    for table in sorted(missing):
+        blocks.append(f'\n[[Tables]]\n  Name = "{table}"\n  IgnoreData = true\n')
+    return ''.join(blocks)
+
+
+def _get_table_sizes(source_uri: str) -> Dict[str, int]:
+    """Returns the estimated size of each table of the source database.
+
+    Raises:
+        DumperError
+
+    """
+    # Imported on first use, like the rest of the backend and driver imports, to keep
+    # the CLI startup fast.
+    import psycopg2
+
+    try:
+        conn = psycopg2.connect(source_uri)
+    except psycopg2.Error as e:
+        raise DumperError(str(e).strip())
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(_TABLE_SIZES_SQL)
+            # Summed sizes are numeric, i.e `Decimal`.
+            return {table: int(size) for table, size in cursor.fetchall()}
+    except psycopg2.Error as e:
+        raise DumperError(str(e).strip())
+    finally:
+        conn.close()
+
+
+async def _klepto_steal(
+    from_uri: str, *, config: str, name: str = 'klepto'
+) -> AsyncIterator[bytes]:
     """Runs klepto and streams its output.
 
+    Stdout and stderr are consumed concurrently. Stderr is checked for klepto error
+    output, in which case klepto is terminated.
+
     Args:
         from_uri: Source database URI.
         config: Path to klepto config file.
+        name (optional): Name prefixing klepto's stderr output.
 
     Raises:
         DumperError: If there's an error in running the klepto command.
 
     Yields:
-        BinaryIO: A stream to read the output from klepto.
+        bytes: Chunks of klepto output.
 
     """
     try:
         args = _get_popen_args(from_uri, config)
-        proc = subprocess.Popen(
-            args,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            shell=False,
-            text=False,
+        proc = await asyncio.create_subprocess_exec(
+            *args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
         )
     except FileNotFoundError as e:
         raise DumperError(e)
+    # Both are pipes, as requested above.
+    assert proc.stdout is not None and proc.stderr is not None
 
-    stdout = proc.stdout
-    stderr = proc.stderr
+    errors: List[str] = []
+    stderr_task = asyncio.ensure_future(_consume_stderr(proc, errors, name))
 
     try:
-        iterator = _consume_output(stdout, stderr)
-        stream = utils.iterator_to_stream(iterator)
-        yield cast(BinaryIO, stream)
+        async for chunk in _consume_stdout(proc.stdout):
+            yield chunk
+        await stderr_task
+        await proc.wait()
     finally:
-        stdout.close()
-        stderr.close()
+        stderr_task.cancel()
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
 
+    # After everything has been tidied up, raise the error if any.
+    if errors:
+        raise DumperError(errors[0])
 
-def _consume_output(stdout, stderr) -> Iterator[bytes]:
-    """Consumes output from stdin and stderr. Checks stderr for klepto error output
-    and stdin for invalid SQL statements to fix.
 
-    Args:
-        stdout
-        stderr
+async def _consume_stderr(
+    proc: asyncio.subprocess.Process, errors: List[str], name: str = 'klepto'
+):
+    """Consumes klepto's stderr. On error output, the error is recorded and klepto is
+    terminated, which eventually closes its stdout.
 
-    Raises:
-        DumperError: If error output is encountered.
-
-    Returns:
-        Iterator[bytes]: Yields fixed bytestrings.
+    Args:
+        proc: The klepto process.
+        errors: List to append error messages to.
+        name (optional): Name prefixing the output.
 
     """
-    err_msg = None
+    assert proc.stderr is not None
+    async for line_bytes in proc.stderr:
+        line_string = line_bytes.strip().decode('utf-8')
 
-    # Read output in two threads to avoid deadlocks.
-    stdout_reader = utils.FileReaderThread(stdout)
-    stdout_reader.start()
-    stderr_reader = utils.FileReaderThread(stderr)
-    stderr_reader.start()
+        # Print stderr output since it contains informational messages.
+        print(f'{name}:', line_string)
 
-    while not (stdout_reader.eof() and stderr_reader.eof()):
-        for line_bytes in stderr_reader.iter_lines():
-            line_string = line_bytes.strip().decode('utf-8')
+        if ERR_SYMBOL in line_string[:15] and not errors:
+            errors.append(line_string)
+            proc.terminate()
 
-            # Print stderr output since it contains informational messages.
-            print('klepto:', line_string)
 
-            if ERR_SYMBOL in line_string[:15]:
-                # On error, stop readers, set err flag. Stopping the readers will
-                # eventually exit this loop.
-                stdout_reader.stop()
-                stderr_reader.stop()
-                err_msg = line_string
+async def _consume_stdout(stdout: asyncio.StreamReader) -> AsyncIterator[bytes]:
+    """Consumes klepto's stdout in chunks.
 
-        for line_bytes in stdout_reader.iter_lines():
-            yield _process_stdout_line(line_bytes)
+    Args:
+        stdout
 
-    # Be nice and join the threads.
-    stdout_reader.join()
-    stderr_reader.join()
+    Yields:
+        bytes
 
-    # After everything has been tidied up, raise the error if any.
-    if err_msg:
-        raise DumperError(err_msg)
+    """
+    while True:
+        data = await stdout.read(CHUNK_SIZE)
+        if not data:
+            break
+        yield data
 
 
 def _process_stdout_line(line: bytes) -> bytes:
@@ -0,0 +1,167 @@
+import glob
+import json
+import os
+import tempfile
+from typing import Iterable, List, Optional, Tuple
+
+from voleur import models
+from voleur import repo
+
+
+# Default directory of the local dump store, where dumps are kept uncompressed so that
+# they can be restored straight from disk.
+DEFAULT_DIR = os.path.join(repo.CACHE_DIR, 'dumps')
+
+# Suffix of the dump files in the store. A dump being downloaded is written to a
+# temporary file named after it, e.g `<dump_id>.dump.<random>`.
+DUMP_SUFFIX = '.dump'
+
+# Suffix of the marker written next to a dump once it's downloaded and verified against
+# its checksum, e.g `<dump_id>.verified`. It records that checksum and the size of the
+# dump file, as the checksum is of the compressed dump and can't be checked again.
+VERIFIED_SUFFIX = '.verified'
+
+
+def get_path(directory: str, dump_id: str) -> str:
+    """Returns the path of a dump in the local store.
+
+    Args:
+        directory: The store directory.
+        dump_id: The dump id.
+
+    Returns:
+        str
+
+    """
+    return os.path.join(directory, dump_id + DUMP_SUFFIX)
+
+
+def find(
+    directory: str, dump_id: str, checksum: Optional[models.Checksum] = None
+) -> Optional[str]:
+    """Returns the path of a dump in the local store, if it's there and was verified:
+    it has a marker recording the dump's checksum, and the size the file had then.
+
+    Args:
+        directory: The store directory.
+        dump_id: The dump id.
+        checksum (optional): The dump's checksum, `None` if it has none.
+
+    Returns:
+        Optional[str]
+
+    """
+    path = get_path(directory, dump_id)
+    try:
+        size = os.path.getsize(path)
+        with open(_get_marker_path(directory, dump_id)) as f:
+            marker = json.load(f)
+        verified = marker['size'] == size and marker['sha256'] == (
+            checksum.sha256 if checksum else None
+        )
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    return path if verified else None
+
+
+def mark_verified(
+    directory: str, dump_id: str, checksum: Optional[models.Checksum] = None
+):
+    """Marks a dump in the store as verified against its checksum, e.g once fully
+    downloaded. The marker is written atomically.
+
+    Args:
+        directory: The store directory.
+        dump_id: The dump id.
+        checksum (optional): The checksum the dump was verified against, `None` if it
+            has none.
+
+    """
+    marker = {
+        'sha256': checksum.sha256 if checksum else None,
+        'size': os.path.getsize(get_path(directory, dump_id)),
+    }
+    # Named like a partial download, so that `clean` removes it if left behind.
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=dump_id + DUMP_SUFFIX + '.')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(marker, f)
+    os.replace(tmp_path, _get_marker_path(directory, dump_id))
+
+
+def touch(path: str):
+    """Marks a dump in the store as just used, so that it's evicted last."""
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def get_dumps(directory: str) -> List[Tuple[str, int, float]]:
+    """Returns the dumps in the store, least recently used first.
+
+    Args:
+        directory: The store directory.
+
+    Returns:
+        List[Tuple[str, int, float]]: The id, size and last use time of each dump.
+
+    """
+    dumps = []
+    for path in glob.glob(os.path.join(glob.escape(directory), '*' + DUMP_SUFFIX)):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        dump_id = os.path.basename(path)[: -len(DUMP_SUFFIX)]
+        dumps.append((dump_id, stat.st_size, stat.st_mtime))
+    return sorted(dumps, key=lambda dump: dump[2])
+
+
+def evict(
+    directory: str, max_size: int, keep: Iterable[str] = (), reserve: int = 0
+) -> List[str]:
+    """Evicts the least recently used dumps from the store until there's room for
+    `reserve` more bytes within `max_size`. The dumps to keep are never evicted, so the
+    store may stay over the limit.
+
+    Args:
+        directory: The store directory.
+        max_size: Max total size of the dumps in the store.
+        keep (optional): Ids of the dumps to keep.
+        reserve (optional): Number of bytes to make room for.
+
+    Returns:
+        List[str]: Ids of the evicted dumps.
+
+    """
+    dumps = get_dumps(directory)
+    used = sum(size for _, size, _ in dumps)
+    keep = set(keep)
+
+    evicted = []
+    for dump_id, size, _ in dumps:
+        if used + reserve <= max_size:
+            break
+        if dump_id in keep:
+            continue
+        for path in (_get_marker_path(directory, dump_id), get_path(directory, dump_id)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        used -= size
+        evicted.append(dump_id)
+    return evicted
+
+
+def clean(directory: str):
+    """Removes the partial dumps (and markers) left behind by interrupted downloads."""
+    for path in glob.glob(os.path.join(glob.escape(directory), f'*{DUMP_SUFFIX}.*')):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _get_marker_path(directory: str, dump_id: str) -> str:
+    return os.path.join(directory, dump_id + VERIFIED_SUFFIX)
@@ -0,0 +1,364 @@
+import asyncio
+import dataclasses
+import mmap
+import os
+import time
+from concurrent import futures
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from voleur import metrics as metrics_
+from voleur import sql
+from voleur import writer
+
+
+# Max size of a piece of a table's rows. A table is written in pieces, split at
+# statement boundaries, so that a big table is written by many workers at once.
+PIECE_SIZE = 64 * 1024 * 1024
+
+
+# Offsets of the session pieces of a dump, in dump order.
+_Session = Tuple[Tuple[int, int], ...]
+
+
+@dataclasses.dataclass
+class Piece:
+    # Offsets of the piece's statements in the dump file.
+    start: int
+    end: int
+
+    # The table the statements insert into, `None` for any other statements.
+    table: Optional[str] = None
+
+    # Whether the statements change session settings, e.g `SET search_path`.
+    session: bool = False
+
+    @property
+    def size(self) -> int:
+        return self.end - self.start
+
+
+async def restore_file(
+    path: str,
+    targets: List[str],
+    on_progress: Optional[Callable[[writer.Progress], None]] = None,
+    metrics: Optional[metrics_.Metrics] = None,
+    workers: int = 1,
+) -> Dict[str, Optional[writer.WriterError]]:
+    """Restores an uncompressed dump from a local file to the targets, with a pool of
+    worker processes.
+
+    The file is memory-mapped, and split into pieces of statements by scanning the
+    mapping. Each worker process maps the file too, sharing the OS page cache, and
+    writes the pieces it's handed over its own connection per target. The statements of
+    a piece are only copied out of the mapping while they're parsed.
+
+    The pieces of rows between two other statements (e.g `CREATE TABLE` and `CREATE
+    INDEX`) are written in parallel, largest first. The other statements run in dump
+    order, once everything before them is written. Statements changing session
+    settings are run over every connection, before it writes anything after them. A
+    target stops at its first error, which does not affect the rest; the error is
+    returned instead of raised, any other exception of a worker (e.g a crashed worker
+    process) being turned into a `WriterError`.
+
+    Args:
+        path: Path to the dump file.
+        targets: Target database URIs.
+        on_progress (optional): Called with a target's `Progress` after each piece is
+            written to it.
+        metrics (optional): Metrics to record the `index` stage and a `write` stage per
+            target into.
+        workers (optional): Number of worker processes.
+
+    Returns:
+        Dict[str, Optional[WriterError]]: Mapping of target -> error, `None` on success.
+
+    """
+    metrics = metrics or metrics_.Metrics('restore')
+    loop = asyncio.get_event_loop()
+
+    stage = metrics.stage('index')
+    stage.start()
+    pieces = await loop.run_in_executor(None, index_file, path)
+    stage.bytes_in = stage.bytes_out = sum(piece.size for piece in pieces)
+    stage.finish()
+
+    restores = [
+        _Restore(
+            target,
+            pieces,
+            on_progress=on_progress,
+            stage=metrics.stage('write' if len(targets) == 1 else f'write #{i}'),
+        )
+        for i, target in enumerate(targets, 1)
+    ]
+
+    slots = asyncio.Semaphore(workers)
+    with futures.ProcessPoolExecutor(
+        workers, initializer=_init_worker, initargs=(path,)
+    ) as pool:
+
+        async def write(restore: _Restore, piece: Piece, session: _Session):
+            async with slots:
+                if restore.failed:
+                    return
+                try:
+                    rows = await loop.run_in_executor(
+                        pool,
+                        _write_piece,
+                        restore.target,
+                        piece.start,
+                        piece.end,
+                        session,
+                    )
+                except writer.WriterError as e:
+                    restore.error = restore.error or e
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    # e.g a statement which isn't valid UTF-8, or a crashed worker
+                    # (`BrokenProcessPool`): the target's error, not the restore's.
+                    message = str(e) or type(e).__name__
+                    restore.error = restore.error or writer.WriterError(message)
+                else:
+                    restore.report(piece, rows)
+
+        # The session pieces run so far, replayed by each worker over its connections.
+        session: _Session = ()
+        for restore in restores:
+            restore.start()
+        for phase in _iter_phases(pieces):
+            if phase[0].session:
+                session += ((phase[0].start, phase[0].end),)
+            phase = sorted(phase, key=lambda piece: piece.size, reverse=True)
+            await asyncio.gather(
+                *(
+                    write(restore, piece, session)
+                    for piece in phase
+                    for restore in restores
+                )
+            )
+        for restore in restores:
+            restore.finish()
+
+    return {restore.target: restore.error for restore in restores}
+
+
+def index_file(path: str, piece_size: int = PIECE_SIZE) -> List[Piece]:
+    """Splits a dump file into pieces, by scanning a memory map of it.
+
+    Args:
+        path: Path to the dump file.
+        piece_size (optional): Max size of a piece of a table's rows.
+
+    Returns:
+        List[Piece]
+
+    """
+    if not os.path.getsize(path):
+        return []
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            return index_dump(buf, piece_size)
+
+
+def index_dump(buf: sql.Buffer, piece_size: int = PIECE_SIZE) -> List[Piece]:
+    """Splits a dump into pieces: runs of `INSERT` statements into the same table, up
+    to `piece_size` each, runs of statements changing session settings, and runs of any
+    other statements. The dump is scanned in place, without copying the rows.
+
+    Args:
+        buf: The dump.
+        piece_size (optional): Max size of a piece of a table's rows.
+
+    Returns:
+        List[Piece]
+
+    """
+    pieces: List[Piece] = []
+
+    def add(start: int, end: int):
+        table_bytes = sql.get_insert_table(buf, start)
+        table = table_bytes.decode('utf-8', 'replace') if table_bytes else None
+        session = not table and sql.is_session_statement(bytes(buf[start:end]))
+        last = pieces[-1] if pieces else None
+        if (
+            last
+            and last.table == table
+            and last.session == session
+            and (not table or last.size < piece_size)
+        ):
+            last.end = end
+        else:
+            pieces.append(Piece(start, end, table, session))
+
+    scanner = sql.Scanner()
+    start = 0
+    for end in scanner.scan(buf, 0):
+        add(start, end)
+        start = end
+    if buf[start:].strip():
+        add(start, len(buf))
+    return pieces
+
+
+class _Restore:
+    """The state of the restore of a local dump file to a target."""
+
+    def __init__(
+        self,
+        target: str,
+        pieces: List[Piece],
+        on_progress: Optional[Callable[[writer.Progress], None]] = None,
+        stage: Optional[metrics_.StageMetrics] = None,
+    ):
+        self.target = target
+        self.error: Optional[writer.WriterError] = None
+        self._on_progress = on_progress
+        self._stage = stage or metrics_.StageMetrics(name='write')
+        self._started_at = time.monotonic()
+
+        # Number of pieces of each table left to write, for telling when it's done.
+        self._pieces: Dict[str, int] = {}
+        total = 0
+        for piece in pieces:
+            if piece.table:
+                self._pieces[piece.table] = self._pieces.get(piece.table, 0) + 1
+                total += piece.size
+        self._table_rows: Dict[str, int] = {}
+        self._progress = writer.Progress(target=target, total_bytes=total)
+
+    @property
+    def failed(self) -> bool:
+        return self.error is not None
+
+    def start(self):
+        self._started_at = time.monotonic()
+        self._stage.start()
+
+    def finish(self):
+        self._stage.finish()
+
+    def report(self, piece: Piece, rows: int):
+        stage = self._stage
+        stage.bytes_in += piece.size
+        stage.bytes_out += piece.size
+
+        progress = self._progress
+        progress.bytes_written += piece.size
+        progress.rows_written += rows
+        progress.completed_table = None
+        if piece.table:
+            stage.add_rows(piece.table, rows)
+            table_rows = self._table_rows.get(piece.table, 0) + rows
+            self._table_rows[piece.table] = table_rows
+            progress.table, progress.table_rows = piece.table, table_rows
+            self._pieces[piece.table] -= 1
+            if not self._pieces[piece.table]:
+                progress.completed_table = piece.table
+            progress.eta_seconds = self._get_eta()
+        if self._on_progress:
+            self._on_progress(progress)
+
+    def _get_eta(self) -> Optional[float]:
+        """Estimates the seconds until the rest of the rows are written, at the rate
+        they have been written so far."""
+        progress = self._progress
+        elapsed = time.monotonic() - self._started_at
+        if not progress.total_bytes or not elapsed:
+            return None
+        rate = progress.bytes_written / elapsed
+        return max(progress.total_bytes - progress.bytes_written, 0) / rate
+
+
+def _iter_phases(pieces: List[Piece]) -> Iterator[List[Piece]]:
+    """Yields the pieces in phases which are written one after the other: each run of
+    pieces of rows, which are written in parallel, and each other piece on its own."""
+    phase: List[Piece] = []
+    for piece in pieces:
+        if piece.table:
+            phase.append(piece)
+            continue
+        if phase:
+            yield phase
+            phase = []
+        yield [piece]
+    if phase:
+        yield phase
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Worker processes
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+# The dump file mapped into the worker process, its connection to each target and the
+# number of session pieces run over each connection.
+_worker_buf: Optional[mmap.mmap] = None
+_worker_conns: Dict[str, Any] = {}
+_worker_sessions: Dict[str, int] = {}
+
+
+def _init_worker(path: str):
+    global _worker_buf
+    with open(path, 'rb') as f:
+        _worker_buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _write_piece(target: str, start: int, end: int, session: _Session = ()) -> int:
+    """Writes a piece of the dump to a target, from a worker process. The session
+    pieces the connection to the target hasn't run yet are run first.
+
+    Raises:
+        WriterError
+
+    Returns:
+        int: Number of rows written.
+
+    """
+    cursor = _get_connection(target, session).cursor()
+    if (start, end) in session:
+        # A session piece, which was just run along with the ones before it.
+        return 0
+    rows = 0
+    for batch in writer.batch_statements(_iter_statements(start, end)):
+        writer.execute(cursor, batch)
+        rows += batch.rows
+    return rows
+
+
+def _get_connection(target: str, session: _Session = ()) -> Any:
+    """Returns the worker's connection to a target, connecting on first use, once it
+    has run the given session pieces. Session settings only apply to the connection
+    they're run over, so every connection runs them."""
+    # Imported on first use, like the rest of the backend and driver imports, to keep
+    # the CLI startup fast.
+    import psycopg2
+
+    conn = _worker_conns.get(target)
+    if conn is None:
+        try:
+            conn = psycopg2.connect(target)
+        except psycopg2.Error as e:
+            raise writer.WriterError(str(e).strip())
+        conn.autocommit = True
+        _worker_conns[target] = conn
+
+    done = _worker_sessions.get(target, 0)
+    if done < len(session):
+        cursor = conn.cursor()
+        for start, end in session[done:]:
+            for batch in writer.batch_statements(_iter_statements(start, end)):
+                writer.execute(cursor, batch)
+        _worker_sessions[target] = len(session)
+    return conn
+
+
+def _iter_statements(start: int, end: int) -> Iterator[bytes]:
+    """Yields the statements between two offsets of the mapped dump file."""
+    buf: Any = _worker_buf
+    scanner = sql.Scanner()
+    for stop in scanner.scan(buf, start, end):
+        yield buf[start:stop]
+        start = stop
+    tail = buf[start:end]
+    if tail.strip():
+        yield tail
@@ -0,0 +1,245 @@
+import asyncio
+import dataclasses
+import json
+import sys
+import time
+from typing import Dict, List, Optional, TextIO
+
+from voleur import utils
+
+
+# Seconds between live progress reports.
+REPORT_INTERVAL = 10.0
+
+# Output paths with this extension are written in the Prometheus textfile format,
+# anything else as JSON.
+PROMETHEUS_EXTENSION = '.prom'
+
+
+@dataclasses.dataclass
+class StageMetrics:
+    # The stage name, e.g `extract`.
+    name: str
+
+    # Bytes consumed from the upstream stage.
+    bytes_in: int = 0
+
+    # Bytes produced for the downstream stage (or written out, for the last stage).
+    bytes_out: int = 0
+
+    # Lines produced, for stages handling SQL text.
+    lines: int = 0
+
+    # Mapping of table -> rows, for stages which know about rows.
+    rows: Dict[str, int] = dataclasses.field(default_factory=dict)
+
+    # Time spent waiting for input from the upstream stage.
+    blocked_input_seconds: float = 0.0
+
+    # Time spent waiting for the downstream stage to accept output (backpressure).
+    blocked_output_seconds: float = 0.0
+
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+
+    def start(self):
+        self.started_at = time.monotonic()
+
+    def finish(self):
+        self.finished_at = time.monotonic()
+
+    def add_rows(self, table: str, rows: int):
+        self.rows[table] = self.rows.get(table, 0) + rows
+
+    @property
+    def elapsed_seconds(self) -> float:
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def busy_seconds(self) -> float:
+        """Time spent working, i.e not blocked on either side. Stages share the event
+        loop, so this includes time spent waiting for the loop."""
+        blocked = self.blocked_input_seconds + self.blocked_output_seconds
+        return max(0.0, self.elapsed_seconds - blocked)
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'lines': self.lines,
+            'rows': dict(self.rows),
+            'elapsed_seconds': round(self.elapsed_seconds, 3),
+            'busy_seconds': round(self.busy_seconds, 3),
+            'blocked_input_seconds': round(self.blocked_input_seconds, 3),
+            'blocked_output_seconds': round(self.blocked_output_seconds, 3),
+        }
+
+
+@dataclasses.dataclass
+class QueueMetrics:
+    # The queue name, e.g `extract->rewrite`.
+    name: str
+
+    # Max number of items the queue holds.
+    maxsize: int
+
+    # Current and max observed number of items in the queue.
+    depth: int = 0
+    max_depth: int = 0
+
+    def set_depth(self, depth: int):
+        self.depth = depth
+        self.max_depth = max(self.max_depth, depth)
+
+    def to_dict(self) -> dict:
+        return {'name': self.name, 'maxsize': self.maxsize, 'max_depth': self.max_depth}
+
+
+class Metrics:
+    """Collects the metrics of the stages and queues of a pipeline run."""
+
+    def __init__(self, command: str):
+        self.command = command
+        self.stages: Dict[str, StageMetrics] = {}
+        self.queues: List[QueueMetrics] = []
+        self._started_at = time.monotonic()
+        self._finished_at: Optional[float] = None
+
+    def stage(self, name: str) -> StageMetrics:
+        """Returns the metrics of a stage, creating them if needed."""
+        if name not in self.stages:
+            self.stages[name] = StageMetrics(name=name)
+        return self.stages[name]
+
+    def queue(self, name: str, maxsize: int) -> QueueMetrics:
+        """Creates the metrics of a queue."""
+        queue = QueueMetrics(name=name, maxsize=maxsize)
+        self.queues.append(queue)
+        return queue
+
+    def finish(self):
+        self._finished_at = time.monotonic()
+        for stage in self.stages.values():
+            if stage.started_at is not None and stage.finished_at is None:
+                stage.finish()
+
+    @property
+    def elapsed_seconds(self) -> float:
+        return (self._finished_at or time.monotonic()) - self._started_at
+
+    def get_bottleneck(self) -> Optional[StageMetrics]:
+        """Returns the stage which spent the most time working."""
+        stages = [stage for stage in self.stages.values() if stage.started_at]
+        return max(stages, key=lambda stage: stage.busy_seconds, default=None)
+
+    def summary(self) -> str:
+        """Returns a one-line summary of the progress of each stage."""
+        parts = []
+        for stage in self.stages.values():
+            size = utils.format_size(stage.bytes_out or stage.bytes_in)
+            part = f'{stage.name} {size}'
+            if stage.lines:
+                part += f' {stage.lines} lines'
+            if stage.rows:
+                part += f' {sum(stage.rows.values())} rows'
+            parts.append(part)
+        if self.queues:
+            queues = ' '.join(f'{q.depth}/{q.maxsize}' for q in self.queues)
+            parts.append(f'queues {queues}')
+        return ' | '.join(parts)
+
+    async def report(self, out: TextIO = sys.stderr, interval: float = REPORT_INTERVAL):
+        """Prints the summary periodically, until cancelled."""
+        while True:
+            await asyncio.sleep(interval)
+            print(f'📊 {int(self.elapsed_seconds)}s: {self.summary()}', file=out)
+
+    def to_dict(self) -> dict:
+        return {
+            'command': self.command,
+            'elapsed_seconds': round(self.elapsed_seconds, 3),
+            'stages': [stage.to_dict() for stage in self.stages.values()],
+            'queues': [queue.to_dict() for queue in self.queues],
+        }
+
+    def to_prometheus(self) -> str:
+        """Returns the metrics in the Prometheus textfile format."""
+        lines = []
+
+        def metric(name: str, kind: str, description: str, samples: list):
+            lines.append(f'# HELP voleur_{name} {description}')
+            lines.append(f'# TYPE voleur_{name} {kind}')
+            for labels, value in samples:
+                labels = dict(command=self.command, **labels)
+                rendered = ','.join(
+                    f'{key}="{_escape_label(label)}"' for key, label in labels.items()
+                )
+                lines.append(f'voleur_{name}{{{rendered}}} {value}')
+
+        stages = list(self.stages.values())
+        metric(
+            'run_duration_seconds',
+            'gauge',
+            'Duration of the run.',
+            [({}, round(self.elapsed_seconds, 3))],
+        )
+        for field, description in (
+            ('bytes_in', 'Bytes consumed by a pipeline stage.'),
+            ('bytes_out', 'Bytes produced by a pipeline stage.'),
+            ('lines', 'Lines produced by a pipeline stage.'),
+        ):
+            samples = [({'stage': s.name}, getattr(s, field)) for s in stages]
+            metric(f'stage_{field}_total', 'counter', description, samples)
+        metric(
+            'stage_rows_total',
+            'counter',
+            'Rows handled by a pipeline stage per table.',
+            [
+                ({'stage': s.name, 'table': table}, rows)
+                for s in stages
+                for table, rows in s.rows.items()
+            ],
+        )
+        metric(
+            'stage_busy_seconds_total',
+            'counter',
+            'Time a pipeline stage spent working.',
+            [({'stage': s.name}, round(s.busy_seconds, 3)) for s in stages],
+        )
+        metric(
+            'stage_blocked_seconds_total',
+            'counter',
+            'Time a pipeline stage spent blocked on its input or output.',
+            [
+                ({'stage': s.name, 'side': side}, round(seconds, 3))
+                for s in stages
+                for side, seconds in (
+                    ('input', s.blocked_input_seconds),
+                    ('output', s.blocked_output_seconds),
+                )
+            ],
+        )
+        metric(
+            'queue_max_depth',
+            'gauge',
+            'Max observed number of items in a queue between stages.',
+            [({'queue': q.name}, q.max_depth) for q in self.queues],
+        )
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: str):
+        """Writes the metrics to a file, as a Prometheus textfile if the path ends in
+        `.prom`, otherwise as JSON."""
+        if path.endswith(PROMETHEUS_EXTENSION):
+            content = self.to_prometheus()
+        else:
+            content = json.dumps(self.to_dict(), indent=2)
+        with open(path, 'w') as f:
+            f.write(content)
+
+
+def _escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -4,6 +4,36 @@ from datetime import datetime
 from typing import Iterable, List, Optional
 
 
+@dataclasses.dataclass
+class Checksum:
+    # Size of the dump file in bytes.
+    size: int
+
+    # SHA-256 of the whole dump file, hex-encoded.
+    sha256: str
+
+    # Size of the chunks the dump file is checksummed in.
+    chunk_size: int
+
+    # SHA-256 of each chunk of the dump file, hex-encoded.
+    chunk_sha256: List[str] = dataclasses.field(default_factory=list)
+
+
+@dataclasses.dataclass
+class TableStats:
+    # The table name, as written in the dump, e.g `public."users"`.
+    table: str
+
+    # Size of the table's rows in the (uncompressed) dump, in bytes.
+    size: int = 0
+
+    # Number of rows in the table.
+    rows: int = 0
+
+    # Estimated size of the table's rows in the compressed dump file, in bytes.
+    compressed_size: int = 0
+
+
 @dataclasses.dataclass
 class Dump:
     # A unique dump id.
@@ -15,6 +45,23 @@ class Dump:
     # URL to the dump file.
     storage_url: str
 
+    # Checksum of the dump file. Missing for dumps stashed by older versions.
+    checksum: Optional[Checksum] = None
+
+    # Number of rows in the dump, if known.
+    rows: Optional[int] = None
+
+    # Statistics of each table in the dump, in dump order. Empty if not known.
+    tables: List[TableStats] = dataclasses.field(default_factory=list)
+
+    # The row sample of a subset dump, e.g `1%,users=10%`. `None` for a full dump.
+    sample: Optional[str] = None
+
+    @property
+    def size(self) -> Optional[int]:
+        """Size of the dump file in bytes, if known."""
+        return self.checksum.size if self.checksum else None
+
 
 @dataclasses.dataclass
 class Stash:
@@ -41,11 +88,20 @@ class Stash:
         hits = [d for d in self.dumps if d.dump_id == dump_id]
         return hits[0] if hits else None
 
-    def add_dump(self, storage_url: str) -> Dump:
+    def add_dump(
+        self,
+        storage_url: str,
+        checksum: Optional[Checksum] = None,
+        tables: Optional[List[TableStats]] = None,
+        sample: Optional[str] = None,
+    ) -> Dump:
         """Adds a new dump.
 
         Args:
             storage_url: URL to dump file.
+            checksum (optional): Checksum of the dump file.
+            tables (optional): Statistics of each table in the dump.
+            sample (optional): The row sample, for a subset dump.
 
         Returns:
             Dump
@@ -55,6 +111,10 @@ class Stash:
             dump_id=uuid.uuid4().hex[:8],
             timestamp=datetime.utcnow().isoformat(),
             storage_url=storage_url,
+            checksum=checksum,
+            rows=sum(t.rows for t in tables) if tables is not None else None,
+            tables=tables or [],
+            sample=sample,
         )
         self.dumps.append(dump)
         return dump
@@ -0,0 +1,639 @@
+import asyncio
+import dataclasses
+import os
+import tempfile
+import time
+import zlib
+from concurrent import futures
+from typing import Any, AsyncIterable, AsyncIterator, Awaitable, Callable, Dict, List
+from typing import Optional
+
+from voleur import checksums
+from voleur import dumper
+from voleur import metrics as metrics_
+from voleur import models
+from voleur import spool as spool_
+from voleur import stats
+from voleur import storage
+from voleur import subset
+from voleur import utils
+from voleur import writer
+
+
+# Max number of chunks buffered between two stages before the upstream stage blocks.
+QUEUE_SIZE = 8
+
+# Max number of threads for running blocking work (S3 calls, compression, database
+# writes) off the event loop.
+MAX_WORKERS = 32
+
+# zlib compression level for dumps. Favours speed over ratio, since compression is on
+# the critical path of the stash pipeline.
+COMPRESSION_LEVEL = 3
+
+# Size of the chunks handed from the compression stage to the upload stage.
+_COMPRESSED_CHUNK_SIZE = 1024 * 1024
+
+# Max number of times an interrupted upload is resumed from the spooled dump, and the
+# delay before the first retry, doubled on every retry.
+UPLOAD_RETRIES = 5
+UPLOAD_RETRY_DELAY = 5.0
+
+# `wbits` value selecting the gzip container for zlib.
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+@dataclasses.dataclass
+class Stashed:
+    # Storage URL of the dump.
+    storage_url: str
+
+    # Checksum of the stored dump file, computed as it was uploaded.
+    checksum: models.Checksum
+
+    # Statistics of each table in the dump.
+    tables: List[models.TableStats] = dataclasses.field(default_factory=list)
+
+    # The row sample, for a subset dump.
+    sample: Optional[str] = None
+
+    @property
+    def rows(self) -> int:
+        return sum(table.rows for table in self.tables)
+
+
+class Channel:
+    """A bounded queue connecting two pipeline stages. The upstream stage blocks when
+    the channel is full, which propagates backpressure up the pipeline.
+
+    When given stage metrics, the channel records the bytes (and lines, for text)
+    passing through it and the time each side spends blocked on it.
+
+    """
+
+    _EOF = None
+
+    def __init__(
+        self,
+        maxsize: int = QUEUE_SIZE,
+        producer: Optional[metrics_.StageMetrics] = None,
+        consumer: Optional[metrics_.StageMetrics] = None,
+        queue: Optional[metrics_.QueueMetrics] = None,
+        text: bool = False,
+    ):
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self._producer = producer
+        self._consumer = consumer
+        self._queue_metrics = queue
+        self._text = text
+
+    async def put(self, item: Any):
+        started = time.monotonic()
+        await self._queue.put(item)
+
+        producer = self._producer
+        if producer:
+            producer.blocked_output_seconds += time.monotonic() - started
+            producer.bytes_out += len(item)
+            if self._text:
+                producer.lines += item.count(b'\n')
+        self._update_depth()
+
+    async def close(self):
+        """Signals the downstream stage that there are no more items."""
+        await self._queue.put(self._EOF)
+
+    def __aiter__(self) -> AsyncIterator[Any]:
+        return self._iter()
+
+    async def _iter(self) -> AsyncIterator[Any]:
+        consumer = self._consumer
+        while True:
+            started = time.monotonic()
+            item = await self._queue.get()
+            self._update_depth()
+            if item is self._EOF:
+                return
+            if consumer:
+                consumer.blocked_input_seconds += time.monotonic() - started
+                consumer.bytes_in += len(item)
+            yield item
+
+    def _update_depth(self):
+        if self._queue_metrics:
+            self._queue_metrics.set_depth(self._queue.qsize())
+
+
+def connect(
+    metrics: metrics_.Metrics, producer: str, consumer: str, text: bool = False
+) -> Channel:
+    """Returns a channel between two stages which records their metrics.
+
+    Args:
+        metrics: The metrics of the pipeline run.
+        producer: Name of the upstream stage.
+        consumer: Name of the downstream stage.
+        text (optional): Whether SQL text passes through, to count lines.
+
+    Returns:
+        Channel
+
+    """
+    return Channel(
+        producer=metrics.stage(producer),
+        consumer=metrics.stage(consumer),
+        queue=metrics.queue(f'{producer}->{consumer}', QUEUE_SIZE),
+        text=text,
+    )
+
+
+def run(main: Awaitable, report: Optional[metrics_.Metrics] = None) -> Any:
+    """Runs a pipeline to completion in a new event loop.
+
+    Args:
+        main: The pipeline coroutine, e.g `stash(...)`.
+        report (optional): Metrics of the run to report periodically while it runs.
+
+    Returns:
+        Any: The pipeline result.
+
+    """
+    return asyncio.run(_run_with_executor(main, report))
+
+
+async def run_stages(*stages: Awaitable) -> List[Any]:
+    """Runs pipeline stages concurrently. If any stage fails, or the pipeline is
+    cancelled, the rest of the stages are cancelled.
+
+    Args:
+        stages: The stage coroutines.
+
+    Raises:
+        Exception: The error of the first failed stage, in stage order.
+
+    Returns:
+        List[Any]: The result of each stage.
+
+    """
+    tasks = [asyncio.ensure_future(stage) for stage in stages]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    for task in tasks:
+        if not task.cancelled() and task.exception():
+            raise task.exception()  # type: ignore
+    return [task.result() for task in tasks]
+
+
+async def stash(
+    source: str,
+    path: str,
+    klepto_config: Optional[str] = None,
+    backend: str = 's3',
+    metrics: Optional[metrics_.Metrics] = None,
+    spool: Optional[spool_.Spool] = None,
+    shards: int = 1,
+    sample: Optional[subset.Sample] = None,
+) -> Stashed:
+    """The stash pipeline: extracts a dump from the source database, rewrites and
+    compresses it and uploads it to storage, with all stages running concurrently.
+
+    With a spool, the compressed dump is also written to local disk. If the upload
+    fails, the extraction carries on and the upload is resumed from the spool.
+
+    The dump file is checksummed, and statistics of each table are collected, as it's
+    uploaded.
+
+    With a sample, only the sampled rows, and the rows they reference, are kept (see
+    `subset.subset_dump`).
+
+    Args:
+        source: Source database URI.
+        path: The storage path to upload the dump to.
+        klepto_config (optional): Path to a klepto config file.
+        backend (optional): The storage backend, defaults to S3.
+        metrics (optional): Metrics to record the run into.
+        spool (optional): The spool to write the dump to.
+        shards (optional): Number of klepto processes to extract the dump with.
+        sample (optional): The row sample, for a subset dump.
+
+    Raises:
+        dumper.DumperError
+        storage.StorageError
+
+    Returns:
+        Stashed
+
+    """
+    metrics = metrics or metrics_.Metrics('stash')
+    digest = checksums.Digest()
+    extracted = connect(metrics, 'extract', 'rewrite', text=True)
+    rewritten = connect(metrics, 'rewrite', 'subset' if sample else 'compress', text=True)
+    tables = stats.TableStatsCollector(metrics.stage('subset' if sample else 'rewrite'))
+
+    stages = [
+        timed(
+            metrics.stage('extract'),
+            feed(
+                dumper.extract_dump(source, klepto_config=klepto_config, shards=shards),
+                extracted,
+            ),
+        ),
+        timed(
+            metrics.stage('rewrite'),
+            feed(dumper.rewrite_dump(extracted, None if sample else tables), rewritten),
+        ),
+    ]
+
+    dump = rewritten
+    if sample:
+        dump = connect(metrics, 'subset', 'compress', text=True)
+        stages.append(
+            timed(
+                metrics.stage('subset'),
+                feed(subset.subset_dump(rewritten, sample, tables), dump),
+            )
+        )
+
+    compressed = connect(metrics, 'compress', 'spool' if spool else 'upload')
+    stages.append(
+        timed(metrics.stage('compress'), compress(dump, compressed, digest, tables))
+    )
+    if spool:
+        spooled = connect(metrics, 'spool', 'upload')
+        stages += [
+            timed(
+                metrics.stage('spool'),
+                write_spool(compressed, spooled, spool, digest, tables),
+            ),
+            timed(metrics.stage('upload'), _upload_spooling(backend, spooled, spool)),
+        ]
+    else:
+        stages.append(
+            timed(
+                metrics.stage('upload'), storage.store_chunks(backend, path, compressed)
+            )
+        )
+
+    try:
+        *_, storage_url = await run_stages(*stages)
+    finally:
+        metrics.finish()
+    return Stashed(
+        storage_url,
+        checksum=digest.result(),
+        tables=tables.get_tables(),
+        sample=sample.spec if sample else None,
+    )
+
+
+async def upload_spool(
+    spool: spool_.Spool, backend: str = 's3', retries: int = UPLOAD_RETRIES
+) -> Stashed:
+    """Uploads a complete spooled dump, resuming its interrupted upload if any. Failed
+    uploads are resumed up to `retries` times, with exponential backoff. The spooled
+    dump is verified against its checksum as it's read.
+
+    Args:
+        spool: The spooled dump.
+        backend (optional): The storage backend, defaults to S3.
+        retries (optional): Max number of times to resume a failed upload.
+
+    Raises:
+        checksums.ChecksumError
+        storage.StorageError
+
+    Returns:
+        Stashed
+
+    """
+    checksum = spool.checksum
+    if not spool.complete or checksum is None:
+        # A complete spool always has a checksum, unless its checkpoint is damaged.
+        raise checksums.ChecksumError(
+            f'Spooled dump is incomplete or has no checksum: {spool.dump_path}'
+        )
+
+    spooled_url = storage.make_storage_url('file', spool.dump_path)
+    attempt = 0
+    while True:
+        try:
+            storage_url = await storage.store_chunks(
+                backend,
+                spool.path,
+                checksums.verify(storage.iter_storage_url(spooled_url), checksum),
+                upload_id=spool.upload_id,
+                on_upload=spool.set_upload_id,
+            )
+            return Stashed(
+                storage_url,
+                checksum=checksum,
+                tables=spool.tables,
+                sample=spool.sample,
+            )
+        except (checksums.ChecksumError, asyncio.CancelledError):
+            raise
+        except Exception:
+            attempt += 1
+            if attempt > retries:
+                raise
+            await asyncio.sleep(UPLOAD_RETRY_DELAY * 2 ** (attempt - 1))
+
+
+async def restore(
+    storage_url: str,
+    targets: List[str],
+    on_progress: Optional[Callable[[writer.Progress], None]] = None,
+    metrics: Optional[metrics_.Metrics] = None,
+    checksum: Optional[models.Checksum] = None,
+    workers: int = 1,
+    tables: Optional[List[models.TableStats]] = None,
+) -> Dict[str, Optional[writer.WriterError]]:
+    """The restore pipeline: downloads a dump, decompresses it if needed and writes it
+    to the targets, with all stages running concurrently. The dump file is verified
+    against its checksum, if given, as it's downloaded.
+
+    Each target is written over `workers` connections, with the tables scheduled
+    largest first from the dump's table statistics, if given.
+
+    Args:
+        storage_url: Storage URL of the dump.
+        targets: Target database URIs.
+        on_progress (optional): Called with a target's `Progress` after each batch is
+            written to it.
+        metrics (optional): Metrics to record the run into.
+        checksum (optional): Checksum of the dump file.
+        workers (optional): Number of connections to write each target over.
+        tables (optional): Statistics of the tables of the dump.
+
+    Raises:
+        checksums.ChecksumError
+
+    Returns:
+        Dict[str, Optional[WriterError]]: Mapping of target -> error, `None` on success.
+
+    """
+    metrics = metrics or metrics_.Metrics('restore')
+    compressed = storage_url.endswith(utils.COMPRESSED_SUFFIX)
+
+    downloaded = connect(
+        metrics, 'download', 'decompress' if compressed else 'parse', text=not compressed
+    )
+    stages = [
+        timed(
+            metrics.stage('download'),
+            feed(
+                checksums.verify(storage.iter_storage_url(storage_url), checksum),
+                downloaded,
+            ),
+        )
+    ]
+
+    source = downloaded
+    if compressed:
+        source = connect(metrics, 'decompress', 'parse', text=True)
+        stages.append(timed(metrics.stage('decompress'), decompress(downloaded, source)))
+
+    try:
+        *_, errors = await run_stages(
+            *stages,
+            writer.write_dump_many(
+                targets,
+                source,
+                on_progress=on_progress,
+                metrics=metrics,
+                workers=workers,
+                tables=tables,
+            ),
+        )
+    finally:
+        metrics.finish()
+    return errors
+
+
+async def download(
+    storage_url: str,
+    path: str,
+    checksum: Optional[models.Checksum] = None,
+    max_rate: Optional[int] = None,
+    metrics: Optional[metrics_.Metrics] = None,
+) -> int:
+    """The download pipeline: downloads a dump, decompresses it if needed and writes it
+    to a local file, with all stages running concurrently. The dump file is verified
+    against its checksum, if given, as it's downloaded.
+
+    The file is written under a temporary name and moved into place once complete, so
+    that a partial dump is never found at `path`.
+
+    Args:
+        storage_url: Storage URL of the dump.
+        path: Path of the local file to write.
+        checksum (optional): Checksum of the dump file.
+        max_rate (optional): Max download rate, in bytes per second.
+        metrics (optional): Metrics to record the run into.
+
+    Raises:
+        checksums.ChecksumError
+        storage.StorageError
+
+    Returns:
+        int: Size of the local file.
+
+    """
+    metrics = metrics or metrics_.Metrics('download')
+    compressed = storage_url.endswith(utils.COMPRESSED_SUFFIX)
+
+    chunks = storage.iter_storage_url(storage_url)
+    if max_rate:
+        chunks = throttle(chunks, max_rate)
+    downloaded = connect(metrics, 'download', 'decompress' if compressed else 'write')
+    stages = [
+        timed(
+            metrics.stage('download'),
+            feed(checksums.verify(chunks, checksum), downloaded),
+        )
+    ]
+
+    source = downloaded
+    if compressed:
+        source = connect(metrics, 'decompress', 'write')
+        stages.append(timed(metrics.stage('decompress'), decompress(downloaded, source)))
+
+    try:
+        *_, size = await run_stages(
+            *stages, timed(metrics.stage('write'), write_file(source, path))
+        )
+    finally:
+        metrics.finish()
+    return size
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Stages
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+async def feed(source: AsyncIterable[bytes], channel: Channel):
+    """Feeds the items of an async iterable into a channel."""
+    async for item in source:
+        await channel.put(item)
+    await channel.close()
+
+
+async def compress(
+    source: AsyncIterable[bytes],
+    channel: Channel,
+    digest: Optional[checksums.Digest] = None,
+    tables: Optional[stats.TableStatsCollector] = None,
+):
+    """Gzip-compresses a stream of chunks, checksumming the compressed output into the
+    digest and recording its size per table into the collector, if given. Compression
+    and hashing run in a worker thread, since zlib and hashlib release the GIL."""
+    loop = asyncio.get_event_loop()
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, _GZIP_WBITS)
+
+    async def put(data: bytes):
+        if digest:
+            await loop.run_in_executor(None, digest.update, data)
+        await channel.put(data)
+
+    buffer = bytearray()
+    async for chunk in source:
+        data = await loop.run_in_executor(None, compressor.compress, chunk)
+        if tables:
+            tables.add_compressed(len(data))
+        buffer += data
+        if len(buffer) >= _COMPRESSED_CHUNK_SIZE:
+            await put(bytes(buffer))
+            buffer.clear()
+
+    data = compressor.flush()
+    if tables:
+        tables.add_compressed_tail(len(data))
+    buffer += data
+    if buffer:
+        await put(bytes(buffer))
+    await channel.close()
+
+
+async def decompress(source: AsyncIterable[bytes], channel: Channel):
+    """Decompresses a stream of gzip-compressed chunks, in a worker thread."""
+    loop = asyncio.get_event_loop()
+    decompressor = zlib.decompressobj(_GZIP_WBITS)
+
+    async for chunk in source:
+        data = await loop.run_in_executor(None, decompressor.decompress, chunk)
+        if data:
+            await channel.put(data)
+
+    data = decompressor.flush()
+    if data:
+        await channel.put(data)
+    await channel.close()
+
+
+async def write_spool(
+    source: AsyncIterable[bytes],
+    channel: Channel,
+    spool: spool_.Spool,
+    digest: checksums.Digest,
+    tables: stats.TableStatsCollector,
+):
+    """Writes a stream of chunks to the spool, passing them on downstream. The spool is
+    marked complete, with the checksum and table statistics of the dump, once all of it
+    is safely on disk."""
+    loop = asyncio.get_event_loop()
+    with open(spool.dump_path, 'wb') as f:
+        async for chunk in source:
+            await loop.run_in_executor(None, f.write, chunk)
+            await channel.put(chunk)
+        await loop.run_in_executor(None, f.flush)
+        await loop.run_in_executor(None, os.fsync, f.fileno())
+    spool.mark_complete(digest.result(), tables.get_tables())
+    await channel.close()
+
+
+async def write_file(source: AsyncIterable[bytes], path: str) -> int:
+    """Writes a stream of chunks to a file, atomically: the chunks are written to a
+    temporary file next to it, which replaces the file once all of it is on disk.
+
+    Returns:
+        int: Number of bytes written.
+
+    """
+    loop = asyncio.get_event_loop()
+    directory, filename = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory or '.', prefix=filename + '.')
+    size = 0
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            async for chunk in source:
+                await loop.run_in_executor(None, f.write, chunk)
+                size += len(chunk)
+            await loop.run_in_executor(None, f.flush)
+            await loop.run_in_executor(None, os.fsync, f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    return size
+
+
+async def throttle(source: AsyncIterable[bytes], max_rate: int) -> AsyncIterator[bytes]:
+    """Passes chunks on at no more than `max_rate` bytes per second on average, by
+    sleeping whenever the stream gets ahead of the rate."""
+    started = time.monotonic()
+    total = 0
+    async for chunk in source:
+        total += len(chunk)
+        ahead = total / max_rate - (time.monotonic() - started)
+        if ahead > 0:
+            await asyncio.sleep(ahead)
+        yield chunk
+
+
+async def _upload_spooling(backend: str, chunks: Channel, spool: spool_.Spool) -> str:
+    """Uploads a dump as it's spooled. If the upload fails, waits for the rest of the
+    dump to be spooled and resumes the upload from the spool."""
+    try:
+        return await storage.store_chunks(
+            backend, spool.path, chunks, on_upload=spool.set_upload_id
+        )
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        # Keep consuming, so that the extraction carries on into the spool.
+        async for _ in chunks:
+            pass
+    stashed = await upload_spool(spool, backend)
+    return stashed.storage_url
+
+
+async def timed(stage: metrics_.StageMetrics, main: Awaitable) -> Any:
+    """Records the start and end of a stage."""
+    stage.start()
+    try:
+        return await main
+    finally:
+        stage.finish()
+
+
+async def _run_with_executor(
+    main: Awaitable, report: Optional[metrics_.Metrics] = None
+) -> Any:
+    loop = asyncio.get_event_loop()
+    loop.set_default_executor(futures.ThreadPoolExecutor(max_workers=MAX_WORKERS))
+
+    reporter = asyncio.ensure_future(report.report()) if report else None
+    try:
+        return await main
+    finally:
+        if reporter:
+            reporter.cancel()
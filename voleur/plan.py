@@ -0,0 +1,141 @@
+import dataclasses
+import json
+import os
+from typing import List, Optional
+
+from voleur import subset
+from voleur import utils
+
+
+# Max number of sources stashed at once, unless the plan says otherwise.
+DEFAULT_CONCURRENCY = 2
+
+
+class PlanError(Exception):
+    """Raised when a stash plan cannot be read or is invalid."""
+
+
+@dataclasses.dataclass
+class PlanEntry:
+    # Source database URI. Environment variables (e.g `$MASTER_URI`) are expanded, so
+    # that the plan doesn't need to hold passwords.
+    source: str
+
+    # Name of the entry in the output, defaults to the redacted source URI.
+    name: str = ''
+
+    # Path to the klepto config file.
+    config: Optional[str] = None
+
+    # Tags to apply to the dump.
+    tags: List[str] = dataclasses.field(default_factory=list)
+
+    # Entries with a higher priority are started first.
+    priority: int = 0
+
+    # Number of klepto processes to extract the source with.
+    shards: int = 1
+
+    # The row sample, for a subset dump, e.g `["1%", "countries=100%"]`.
+    sample: List[str] = dataclasses.field(default_factory=list)
+
+
+@dataclasses.dataclass
+class Plan:
+    # The sources to stash, highest priority first.
+    entries: List[PlanEntry]
+
+    # Max number of sources stashed at once.
+    concurrency: int = DEFAULT_CONCURRENCY
+
+
+def load(path: str) -> Plan:
+    """Loads a stash plan from a JSON file, e.g:
+
+        {
+            "concurrency": 2,
+            "stashes": [
+                {
+                    "name": "master",
+                    "source": "$MASTER_URI",
+                    "config": "master.toml",
+                    "tags": ["master/latest"],
+                    "priority": 10
+                }
+            ]
+        }
+
+    Args:
+        path: Path to the plan file.
+
+    Raises:
+        PlanError
+
+    Returns:
+        Plan
+
+    """
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        raise PlanError(f'Cannot read plan {path}: {e}')
+
+    if not isinstance(data, dict) or not isinstance(data.get('stashes'), list):
+        raise PlanError('A plan needs a list of `stashes`')
+
+    entries = []
+    for i, item in enumerate(data['stashes'], 1):
+        try:
+            entry = PlanEntry(**item)
+        except TypeError as e:
+            raise PlanError(f'Invalid stash #{i}: {e}')
+        if isinstance(entry.sample, str):
+            entry.sample = [entry.sample]
+        error = _check_entry(entry)
+        if error:
+            raise PlanError(f'Invalid stash #{i}: {error}')
+        entry.source = os.path.expandvars(entry.source)
+        entry.name = entry.name or utils.redact_uri(entry.source)
+        try:
+            subset.parse_sample(entry.sample)
+        except ValueError as e:
+            raise PlanError(f'Invalid stash #{i}: {e}')
+        entries.append(entry)
+
+    concurrency = data.get('concurrency', DEFAULT_CONCURRENCY)
+    if not _is_int(concurrency) or concurrency < 1:
+        raise PlanError('`concurrency` must be at least 1')
+
+    # Sorting is stable, so entries of the same priority keep the plan's order.
+    entries.sort(key=lambda entry: -entry.priority)
+    return Plan(entries=entries, concurrency=concurrency)
+
+
+def _check_entry(entry: PlanEntry) -> Optional[str]:
+    """Returns what's wrong with the fields of an entry, if anything. The dataclass
+    doesn't check the types of the JSON values it's made from."""
+    if not isinstance(entry.source, str):
+        return '`source` must be a string'
+    if not isinstance(entry.name, str):
+        return '`name` must be a string'
+    if entry.config is not None and not isinstance(entry.config, str):
+        return '`config` must be a string'
+    if not _is_str_list(entry.tags):
+        return '`tags` must be a list of strings'
+    if not _is_int(entry.priority):
+        return '`priority` must be an integer'
+    if not _is_int(entry.shards) or entry.shards < 1:
+        return '`shards` must be an integer, at least 1'
+    if not _is_str_list(entry.sample):
+        return '`sample` must be a string or a list of strings'
+    return None
+
+
+def _is_int(value) -> bool:
+    # Booleans are integers in Python, not in JSON.
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _is_str_list(value) -> bool:
+    return isinstance(value, list) and all(isinstance(item, str) for item in value)
@@ -0,0 +1,267 @@
+import contextlib
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import tracemalloc
+from typing import Iterator, List, Optional, Tuple
+
+from voleur import cli
+from voleur import utils
+
+
+# Number of entries in the profile summaries printed at exit.
+TOP_N = 15
+
+# Seconds between memory samples. The snapshot of the largest sample is the
+# one written out, as memory is mostly freed by the time a streaming run ends.
+MEMORY_SAMPLE_INTERVAL = 1.0
+
+# Max number of frames stored per traced allocation.
+MEMORY_TRACEBACK_FRAMES = 10
+
+# Functions on the hot path of the pipelines, as (module, function). They are reported
+# on their own in the CPU summary, if they were called at all.
+HOT_SPOTS = (
+    ('dumper', '_process_stdout_line'),
+    ('dumper', 'rewrite_dump'),
+    ('sql', 'scan'),
+    ('sql', 'parse_insert'),
+    ('sql', 'to_copy_row'),
+    ('writer', 'add'),
+    ('writer', 'execute'),
+)
+
+_PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+@contextlib.contextmanager
+def profile(
+    env: cli.Env, cpu_path: Optional[str] = None, mem_path: Optional[str] = None
+) -> Iterator[None]:
+    """Profiles the wrapped code, writes the results to files and prints a summary of
+    the top hot spots at exit. A no-op if no path is given.
+
+    Args:
+        env: CLI environment.
+        cpu_path (optional): Path to write the CPU profile to, in `pstats` format.
+        mem_path (optional): Path to write the memory snapshot to, in `tracemalloc`
+            format. See `MemoryProfiler` for when it's taken.
+
+    """
+    cpu = CPUProfiler() if cpu_path else None
+    mem = MemoryProfiler() if mem_path else None
+
+    if mem:
+        mem.start()
+    if cpu:
+        cpu.start()
+    try:
+        yield
+    finally:
+        # Stop both before processing the results, so that neither profiles the
+        # other's processing.
+        if cpu:
+            cpu.stop()
+        if mem:
+            mem.stop()
+
+        if cpu and cpu_path:
+            stats = cpu.get_stats()
+            stats.dump_stats(cpu_path)
+            env.info(f'🔥 CPU profile written to {cpu_path}')
+            _print_lines(format_cpu_summary(stats))
+        if mem and mem_path:
+            snapshot, peak = mem.get_snapshot()
+            snapshot.dump(mem_path)
+            env.info(f'🔥 Memory snapshot written to {mem_path}')
+            _print_lines(format_memory_summary(snapshot, peak))
+
+
+class CPUProfiler:
+    """Profiles the calling thread and every thread started while running, e.g the
+    worker threads the pipelines run blocking work in. Each thread gets its own
+    `cProfile` profiler and the results are merged on stop.
+
+    """
+
+    def __init__(self):
+        self._main = cProfile.Profile()
+        self._threads: List[cProfile.Profile] = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        threading.setprofile(self._profile_thread)
+        self._main.enable()
+
+    def stop(self):
+        self._main.disable()
+        threading.setprofile(None)
+
+    def get_stats(self) -> pstats.Stats:
+        """Returns the merged stats of all threads."""
+        stats = pstats.Stats(self._main)
+        with self._lock:
+            for profiler in self._threads:
+                stats.add(profiler)
+        return stats
+
+    def _profile_thread(self, frame, event, arg):
+        """Installed as the profile function of new threads: swaps itself for a
+        profiler on the first event in the thread."""
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Only one profiler can be active at a time on Python 3.12+, where the
+            # main profiler already covers every thread.
+            sys.setprofile(None)
+            return
+        with self._lock:
+            self._threads.append(profiler)
+
+
+class MemoryProfiler:
+    """Traces allocations in all threads with `tracemalloc`, sampling the traced memory
+    in a background thread and keeping a snapshot of the largest sample.
+
+    Taking a snapshot is too slow to do on every allocation, so the snapshot is of the
+    largest traced memory seen at a sample (or at stop), which may be below the true
+    peak reached between two samples. The true peak is reported alongside it.
+
+    """
+
+    def __init__(self, interval: float = MEMORY_SAMPLE_INTERVAL):
+        self._interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._snapshot: Optional[tracemalloc.Snapshot] = None
+        self._snapshot_size = -1
+        self._peak = 0
+
+    def start(self):
+        tracemalloc.start(MEMORY_TRACEBACK_FRAMES)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        self._take_snapshot()
+        _, self._peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    def get_snapshot(self) -> Tuple[tracemalloc.Snapshot, int]:
+        """Returns the snapshot of the largest sample and the peak traced memory."""
+        return self._snapshot, self._peak  # type: ignore
+
+    def _sample(self):
+        while not self._stopped.wait(self._interval):
+            self._take_snapshot()
+
+    def _take_snapshot(self):
+        size, _ = tracemalloc.get_traced_memory()
+        if size > self._snapshot_size:
+            self._snapshot = tracemalloc.take_snapshot().filter_traces(
+                [
+                    tracemalloc.Filter(False, tracemalloc.__file__),
+                    tracemalloc.Filter(False, '<frozen importlib._bootstrap*>'),
+                ]
+            )
+            self._snapshot_size = size
+
+
+def format_cpu_summary(stats: pstats.Stats, top: int = TOP_N) -> List[str]:
+    """Formats the functions with the most time spent in them, marking voleur's own
+    functions with `*`, followed by the known hot spots.
+
+    Args:
+        stats: The CPU profile stats.
+        top (optional): Number of functions to list.
+
+    Returns:
+        List[str]: The summary lines.
+
+    """
+    entries = stats.stats  # type: ignore
+    total = stats.total_tt or 1.0  # type: ignore
+
+    lines = [f'  {"tottime":>9} {"cumtime":>9} {"calls":>9}  function']
+    ranked = sorted(entries.items(), key=lambda item: item[1][2], reverse=True)
+    for func, (_, calls, tottime, cumtime, _) in ranked[:top]:
+        mark = '*' if _get_module(func) else ' '
+        lines.append(
+            f'{mark} {tottime:>9.3f} {cumtime:>9.3f} {calls:>9}  {_format_func(func)}'
+        )
+
+    hot_spots = [
+        (func, calls, tottime)
+        for func, (_, calls, tottime, _, _) in entries.items()
+        if (_get_module(func), func[2]) in HOT_SPOTS
+    ]
+    if hot_spots:
+        lines.append('Hot spots:')
+    for func, calls, tottime in sorted(hot_spots, key=lambda h: h[2], reverse=True):
+        share = tottime / total * 100
+        lines.append(
+            f'  {_format_func(func)}: {tottime:.3f}s ({share:.1f}%), {calls} calls'
+        )
+    return lines
+
+
+def format_memory_summary(
+    snapshot: tracemalloc.Snapshot, peak: int, top: int = TOP_N
+) -> List[str]:
+    """Formats the source lines holding the most memory in a snapshot.
+
+    Args:
+        snapshot: The memory snapshot.
+        peak: Peak traced memory, in bytes.
+        top (optional): Number of source lines to list.
+
+    Returns:
+        List[str]: The summary lines.
+
+    """
+    statistics = snapshot.statistics('lineno')
+    size = sum(stat.size for stat in statistics)
+
+    lines = [f'  peak: {utils.format_size(peak)}, at snapshot: {utils.format_size(size)}']
+    for stat in statistics[:top]:
+        frame = stat.traceback[0]
+        mark = '*' if frame.filename.startswith(_PACKAGE_DIR) else ' '
+        location = f'{_shorten(frame.filename)}:{frame.lineno}'
+        lines.append(
+            f'{mark} {utils.format_size(stat.size):>10} {stat.count:>9}  {location}'
+        )
+    return lines
+
+
+def _get_module(func: tuple) -> Optional[str]:
+    """Returns the voleur module name of a profiled function, `None` if it's not
+    voleur's."""
+    filename = func[0]
+    if not filename.startswith(_PACKAGE_DIR):
+        return None
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+def _format_func(func: tuple) -> str:
+    filename, lineno, name = func
+    if filename == '~':
+        return name
+    return f'{_shorten(filename)}:{lineno}({name})'
+
+
+def _shorten(filename: str) -> str:
+    """Shortens a path to the part after `site-packages` or the voleur package."""
+    for root in (os.path.dirname(_PACKAGE_DIR), 'site-packages' + os.sep):
+        index = filename.find(root)
+        if index != -1:
+            return filename[index + len(root) :].lstrip(os.sep)
+    return filename
+
+
+def _print_lines(lines: List[str]):
+    for line in lines:
+        print(line)
@@ -1,37 +1,68 @@
+import dataclasses
+import hashlib
 import json
+import os
+import tempfile
+import time
+from typing import Optional
 
 from voleur import models
 from voleur import storage
 
 
+# Directory for the local cache of stash metadata.
+CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'voleur'
+)
+
+
 class VersionConflict(Exception):
     """Raised when an out-of-date stash is saved."""
 
 
 class StashRepo:
-    """Repo for loading/saving stashes."""
+    """Repo for loading/saving stashes.
+
+    Loaded metadata is cached locally along with its ETag, so that re-loading an
+    unchanged stash is a conditional request, or no request at all if the cached copy
+    is recent enough for the caller.
+
+    """
 
     _METADATA_FILENAME = '_metadata.json'
 
     @classmethod
-    def load(cls, bucket: str) -> models.Stash:
+    def load(cls, bucket: str, max_age: Optional[float] = None) -> models.Stash:
         """Load the stash in the given bucket.
 
         Args:
             bucket: The stash bucket.
+            max_age (optional): Max age in seconds of a cached copy of the stash to
+                return without checking S3. By default S3 is always checked.
 
         Returns:
             Stash
 
         """
+        cached = _read_cache(bucket)
+        if cached and max_age is not None and time.time() - cached['time'] <= max_age:
+            return unmarshal_stash(cached['stash'])
+
         try:
             metadata_path = cls._get_metadata_path(bucket)
-            content = storage.read('s3', metadata_path)
-            stash = unmarshal_stash(json.loads(content))
+            etag = cached['etag'] if cached else None
+            content, etag = storage.read_if_modified('s3', metadata_path, etag)
         except storage.NotFoundError:
-            stash = models.Stash(bucket=bucket)
+            return models.Stash(bucket=bucket)
 
-        return stash
+        if content is None:
+            # Not modified, which only happens given the ETag of a cached copy.
+            assert cached is not None
+            data = cached['stash']
+        else:
+            data = json.loads(content)
+        _write_cache(bucket, {'etag': etag, 'time': time.time(), 'stash': data})
+        return unmarshal_stash(data)
 
     @classmethod
     def save(cls, stash: models.Stash) -> models.Stash:
@@ -47,6 +78,7 @@ class StashRepo:
         content = json.dumps(marshal_stash(stash))
         metadata_path = cls._get_metadata_path(stash.bucket)
         storage.store('s3', metadata_path, content)
+        _clear_cache(stash.bucket)
         return stash
 
     @classmethod
@@ -54,6 +86,55 @@ class StashRepo:
         return f'{bucket}/{cls._METADATA_FILENAME}'
 
 
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Metadata cache
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+def _get_cache_path(bucket: str) -> str:
+    return os.path.join(CACHE_DIR, bucket, StashRepo._METADATA_FILENAME)
+
+
+def _read_cache(bucket: str) -> Optional[dict]:
+    """Returns the cached metadata of a bucket, `None` if missing, unreadable or
+    corrupt. The cache is best-effort: any error just means going to S3."""
+    try:
+        with open(_get_cache_path(bucket)) as f:
+            cached = json.load(f)
+        if cached.get('sha256') != _get_cache_checksum(cached['stash']):
+            return None
+        return cached
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def _write_cache(bucket: str, cached: dict):
+    """Writes the cached metadata of a bucket atomically, so that concurrent runs never
+    read a partial file."""
+    path = _get_cache_path(bucket)
+    cached = dict(cached, sha256=_get_cache_checksum(cached['stash']))
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(cached, f)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+
+def _get_cache_checksum(data: dict) -> str:
+    content = json.dumps(data, sort_keys=True).encode('utf-8')
+    return hashlib.sha256(content).hexdigest()
+
+
+def _clear_cache(bucket: str):
+    try:
+        os.remove(_get_cache_path(bucket))
+    except OSError:
+        pass
+
+
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 # Object (un)marshalling
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -101,6 +182,10 @@ def marshal_dump(d: models.Dump) -> dict:
         'dump_id': d.dump_id,
         'storage_url': d.storage_url,
         'timestamp': d.timestamp,
+        'checksum': dataclasses.asdict(d.checksum) if d.checksum else None,
+        'rows': d.rows,
+        'tables': [dataclasses.asdict(t) for t in d.tables],
+        'sample': d.sample,
     }
 
 
@@ -114,4 +199,8 @@ def unmarshal_dump(d: dict) -> models.Dump:
         models.Dump
 
     """
+    checksum = d.pop('checksum', None)
+    if checksum:
+        d['checksum'] = models.Checksum(**checksum)
+    d['tables'] = [models.TableStats(**t) for t in d.get('tables', [])]
     return models.Dump(**d)
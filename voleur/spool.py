@@ -0,0 +1,210 @@
+import dataclasses
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import tempfile
+from typing import Dict, List, Optional
+
+from voleur import models, storage
+
+
+# Suffix of the checkpoint file saved next to a spooled dump.
+CHECKPOINT_SUFFIX = '.checkpoint.json'
+
+# Suffix of the lock file next to a spooled dump. The stash using the spool holds a lock
+# on it for as long as it runs, so that other stashes leave the spool alone.
+LOCK_SUFFIX = '.lock'
+
+# Descriptors of the lock files of the spools in use by this process, by path.
+_locks: Dict[str, int] = {}
+
+
+@dataclasses.dataclass
+class Spool:
+    """A dump spooled to local disk while it's uploaded, with a checkpoint of the
+    upload. If the upload is interrupted, it can be resumed from the spooled dump
+    instead of extracting it again.
+
+    """
+
+    # Directory holding the spooled dump and its checkpoint.
+    directory: str
+
+    # The storage path the dump is uploaded to, e.g `<bucket>/<filename>`.
+    path: str
+
+    # Fingerprint of the source database and klepto config the dump is extracted with.
+    source_key: str
+
+    # Id of the multipart upload of the dump, once started.
+    upload_id: Optional[str] = None
+
+    # Whether the whole dump is spooled, i.e it can be uploaded without extracting it.
+    complete: bool = False
+
+    # Checksum of the spooled dump, once complete.
+    checksum: Optional[models.Checksum] = None
+
+    # Statistics of each table in the spooled dump, once complete.
+    tables: List[models.TableStats] = dataclasses.field(default_factory=list)
+
+    # The row sample, for a subset dump.
+    sample: Optional[str] = None
+
+    @property
+    def bucket(self) -> str:
+        return self.path.split('/', maxsplit=1)[0]
+
+    @property
+    def dump_path(self) -> str:
+        return os.path.join(self.directory, os.path.basename(self.path))
+
+    @property
+    def checkpoint_path(self) -> str:
+        return self.dump_path + CHECKPOINT_SUFFIX
+
+    @property
+    def lock_path(self) -> str:
+        return self.dump_path + LOCK_SUFFIX
+
+    def lock(self) -> bool:
+        """Locks the spool for use by this process. The lock is released on `remove`,
+        or when the process exits.
+
+        Returns:
+            bool: False if the spool is in use by another stash.
+
+        """
+        if self.lock_path in _locks:
+            return False
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        _locks[self.lock_path] = fd
+        return True
+
+    def unlock(self):
+        fd = _locks.pop(self.lock_path, None)
+        if fd is not None:
+            os.close(fd)
+
+    def set_upload_id(self, upload_id: str):
+        self.upload_id = upload_id
+        self.save()
+
+    def mark_complete(self, checksum: models.Checksum, tables: List[models.TableStats]):
+        self.complete = True
+        self.checksum = checksum
+        self.tables = tables
+        self.save()
+
+    def save(self):
+        """Saves the checkpoint atomically, so that it's never found half-written."""
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(dataclasses.asdict(self), f)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def remove(self):
+        """Removes the spooled dump, its checkpoint and its lock."""
+        for path in (self.dump_path, self.checkpoint_path, self.lock_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.unlock()
+
+
+def get_source_key(
+    source: str, klepto_config: Optional[str] = None, sample: Optional[str] = None
+) -> str:
+    """Returns a fingerprint of a dump's source, for matching a spooled dump to a later
+    stash of the same source without storing the source URI (and its password).
+
+    Args:
+        source: Source database URI.
+        klepto_config (optional): Path to the klepto config file.
+        sample (optional): The row sample, for a subset dump.
+
+    Returns:
+        str
+
+    """
+    key = f'{source}\n{klepto_config or ""}'
+    if sample:
+        key += f'\n{sample}'
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+
+
+def create(
+    directory: str, path: str, source_key: str, sample: Optional[str] = None
+) -> Spool:
+    """Creates a spool for a new dump.
+
+    Args:
+        directory: The spool directory.
+        path: The storage path the dump is uploaded to.
+        source_key: Fingerprint of the dump's source.
+        sample (optional): The row sample, for a subset dump.
+
+    Returns:
+        Spool
+
+    """
+    os.makedirs(directory, exist_ok=True)
+    spool = Spool(directory=directory, path=path, source_key=source_key, sample=sample)
+    # Locked before the checkpoint exists, so that it's never found unlocked.
+    spool.lock()
+    spool.save()
+    return spool
+
+
+def find(
+    directory: str, bucket: str, source_key: str, backend: str = 's3'
+) -> Optional[Spool]:
+    """Finds a complete spooled dump of the source for the bucket, left behind by an
+    interrupted stash, and locks it. Incomplete spools of the source are removed and
+    their uploads aborted, as an extraction cannot be resumed. Spools in use by another
+    stash which is still running are skipped.
+
+    Args:
+        directory: The spool directory.
+        bucket: The stash bucket.
+        source_key: Fingerprint of the dump's source.
+        backend (optional): The storage backend the spools are uploaded to.
+
+    Returns:
+        Optional[Spool]
+
+    """
+    found = None
+    pattern = os.path.join(glob.escape(directory), '*' + CHECKPOINT_SUFFIX)
+    for checkpoint_path in sorted(glob.glob(pattern)):
+        try:
+            with open(checkpoint_path) as f:
+                data = json.load(f)
+            if data.get('checksum'):
+                data['checksum'] = models.Checksum(**data['checksum'])
+            data['tables'] = [models.TableStats(**t) for t in data.get('tables', [])]
+            spool = Spool(**data)
+        except (OSError, ValueError, TypeError):
+            continue
+
+        if spool.bucket != bucket or spool.source_key != source_key:
+            continue
+        if not spool.lock():
+            continue
+        if spool.complete and os.path.exists(spool.dump_path) and not found:
+            found = spool
+        elif not spool.complete:
+            if spool.upload_id:
+                storage.abort_upload(backend, spool.path, spool.upload_id)
+            spool.remove()
+        else:
+            spool.unlock()
+    return found
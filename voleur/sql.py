@@ -0,0 +1,336 @@
+import mmap
+import re
+from typing import Iterator, List, NamedTuple, Optional, Union
+
+
+# Characters which may change the scanner state when outside of quotes/comments.
+_SPECIAL = re.compile(rb'[;\'"$\-/]')
+
+# A dollar-quote tag, e.g `$$` or `$body$`.
+_DOLLAR_TAG = re.compile(rb'\$(?:[A-Za-z_][A-Za-z0-9_]*)?\$')
+
+# Prefix of an `INSERT` statement as output by klepto (and rewritten by the dumper).
+_INSERT = re.compile(
+    rb'\s*INSERT INTO\s+(?P<table>[^\s(]+)\s*\((?P<columns>[^)]*)\)\s*VALUES\s*\(',
+    re.IGNORECASE,
+)
+
+# A statement changing a setting of the session (rather than of the transaction), e.g
+# `SET search_path = public` or `SELECT pg_catalog.set_config('search_path', '', false)`
+# as output by pg_dump.
+_SESSION = re.compile(
+    rb'(?:SET\s+(?!LOCAL\b)|RESET\s|SELECT\s+(?:pg_catalog\s*\.\s*)?set_config\s*\()',
+    re.IGNORECASE,
+)
+
+# A bare (unquoted) value: a numeric constant or NULL. Anything else, e.g `DEFAULT` or
+# `true`, may not mean the same as a literal in a COPY, so such statements aren't parsed.
+_BARE_VALUE = re.compile(
+    rb'(?:[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?|NULL)(?![\w.])', re.IGNORECASE
+)
+
+_NULL = b'NULL'
+_QUOTE = b"'"
+_LINE_COMMENT = b'--'
+_BLOCK_COMMENT = b'/*'
+
+# Escapes for the COPY text format.
+_COPY_ESCAPES = re.compile(rb'[\\\t\n\r]')
+_COPY_ESCAPE_MAP = {b'\\': b'\\\\', b'\t': b'\\t', b'\n': b'\\n', b'\r': b'\\r'}
+_COPY_NULL = b'\\N'
+
+# Buffers the scanner can work on.
+Buffer = Union[bytes, bytearray, mmap.mmap]
+
+
+class Insert(NamedTuple):
+    # The (possibly qualified and quoted) table name, as it appears in the statement.
+    table: bytes
+
+    # The column list, as it appears in the statement.
+    columns: bytes
+
+    # The values of the inserted row, unquoted. `None` stands for `NULL`.
+    values: List[Optional[bytes]]
+
+
+class Scanner:
+    """Finds the boundaries of SQL statements in a buffer, taking quoted strings,
+    quoted identifiers, dollar-quoted strings and comments into account.
+
+    The scanner is incremental: it can be handed a buffer which ends in the middle of a
+    statement and resumed once more data has been appended. It works on any object
+    supporting the buffer protocol and `find` (bytes, bytearray, mmap), so statements
+    are found without copying.
+
+    Strings are assumed to follow `standard_conforming_strings`, i.e backslashes are
+    not escape characters.
+
+    """
+
+    def __init__(self):
+        self._state: Optional[bytes] = None
+        self.pos = 0
+
+    def scan(self, buf: Buffer, pos: int, end: Optional[int] = None) -> Iterator[int]:
+        """Yields the offsets just past the end (`;`) of each statement found in the
+        buffer, starting at `pos`. Once exhausted, `self.pos` holds the offset to
+        resume scanning from once more data is available.
+
+        Args:
+            buf: The buffer to scan.
+            pos: The offset to start scanning from.
+            end (optional): The offset to stop scanning at, defaults to the end of the
+                buffer.
+
+        Yields:
+            int
+
+        """
+        end = len(buf) if end is None else end
+        state = self._state
+
+        while pos < end:
+            if state is None:
+                match = _SPECIAL.search(buf, pos, end)
+                if not match:
+                    pos = end
+                    break
+                i = match.start()
+                char = buf[i : i + 1]
+                if char == b';':
+                    pos = i + 1
+                    yield pos
+                elif char in (_QUOTE, b'"'):
+                    state, pos = bytes(char), i + 1
+                elif char in (b'-', b'/'):
+                    if i + 1 >= end:
+                        # Need more data to tell if this starts a comment.
+                        pos = i
+                        break
+                    pair = buf[i : i + 2]
+                    if pair in (_LINE_COMMENT, _BLOCK_COMMENT):
+                        state, pos = bytes(pair), i + 2
+                    else:
+                        pos = i + 1
+                else:
+                    tag = _DOLLAR_TAG.match(buf, i, end)
+                    if tag:
+                        state, pos = tag.group(0), tag.end()
+                    elif end - i < 64 and b'$' not in buf[i + 1 : end]:
+                        # Might be a tag which is cut off, wait for more data.
+                        pos = i
+                        break
+                    else:
+                        pos = i + 1
+            elif state == _LINE_COMMENT:
+                i = buf.find(b'\n', pos, end)
+                if i < 0:
+                    pos = end
+                    break
+                state, pos = None, i + 1
+            elif state == _BLOCK_COMMENT:
+                i = buf.find(b'*/', pos, end)
+                if i < 0:
+                    pos = max(pos, end - 1)
+                    break
+                state, pos = None, i + 2
+            elif state in (_QUOTE, b'"'):
+                i = buf.find(state, pos, end)
+                if i < 0:
+                    pos = end
+                    break
+                if i + 1 >= end:
+                    # Need more data to tell if this is an escaped (doubled) quote.
+                    pos = i
+                    break
+                if buf[i + 1 : i + 2] == state:
+                    pos = i + 2
+                else:
+                    state, pos = None, i + 1
+            else:
+                i = buf.find(state, pos, end)
+                if i < 0:
+                    pos = max(pos, end - len(state) + 1)
+                    break
+                pos = i + len(state)
+                state = None
+
+        self._state = state
+        self.pos = pos
+
+
+class StatementSplitter:
+    """Splits a stream of SQL fed in arbitrary chunks into complete statements."""
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._scanner = Scanner()
+        self._pos = 0
+
+    def feed(self, data: bytes) -> List[bytes]:
+        """Feeds a chunk of SQL and returns the statements completed by it.
+
+        Args:
+            data: A chunk of SQL.
+
+        Returns:
+            List[bytes]: Complete statements, including their trailing `;`.
+
+        """
+        buf = self._buffer
+        buf += data
+
+        start = 0
+        statements = []
+        for end in self._scanner.scan(buf, self._pos):
+            statements.append(bytes(buf[start:end]))
+            start = end
+
+        del buf[:start]
+        self._pos = self._scanner.pos - start
+        return statements
+
+    def close(self) -> Optional[bytes]:
+        """Returns any trailing statement which wasn't terminated by `;`.
+
+        Returns:
+            Optional[bytes]
+
+        """
+        rest = bytes(self._buffer).strip()
+        self._buffer = bytearray()
+        self._pos = 0
+        return rest or None
+
+
+def parse_insert(statement: bytes) -> Optional[Insert]:
+    """Parses a single-row `INSERT` statement whose values are all string literals,
+    numeric constants or `NULL`, which is the form of the statements klepto outputs.
+
+    Args:
+        statement: The statement to parse.
+
+    Returns:
+        Optional[Insert]: `None` if the statement is not of that form.
+
+    """
+    match = _INSERT.match(statement)
+    if not match:
+        return None
+
+    values: List[Optional[bytes]] = []
+    pos = match.end()
+    end = len(statement)
+
+    while pos < end:
+        if statement[pos : pos + 1] == _QUOTE:
+            # A string literal, with quotes escaped by doubling.
+            start = pos + 1
+            while True:
+                i = statement.find(_QUOTE, pos + 1)
+                if i < 0:
+                    return None
+                if statement[i + 1 : i + 2] == _QUOTE:
+                    pos = i + 1
+                    continue
+                break
+            values.append(statement[start:i].replace(b"''", _QUOTE))
+            pos = i + 1
+        else:
+            bare = _BARE_VALUE.match(statement, pos)
+            if not bare:
+                return None
+            token = bare.group(0)
+            values.append(None if token.upper() == _NULL else token)
+            pos = bare.end()
+
+        while statement[pos : pos + 1].isspace():
+            pos += 1
+        char = statement[pos : pos + 1]
+        pos += 1
+        if char == b')':
+            break
+        if char != b',':
+            return None
+        while statement[pos : pos + 1].isspace():
+            pos += 1
+    else:
+        return None
+
+    # Anything but the terminator after the values (e.g a second row, `RETURNING` or
+    # `ON CONFLICT`) means this isn't a plain single-row insert.
+    if statement[pos:].strip() not in (b'', b';'):
+        return None
+
+    return Insert(match.group('table'), match.group('columns').strip(), values)
+
+
+def get_insert_table(statement: Buffer, pos: int = 0) -> Optional[bytes]:
+    """Returns the table an `INSERT` statement inserts into, without parsing the
+    values.
+
+    Args:
+        statement: The statement, or a buffer holding it.
+        pos (optional): The offset of the statement in the buffer.
+
+    Returns:
+        Optional[bytes]: `None` if the statement is not an `INSERT`.
+
+    """
+    match = _INSERT.match(statement, pos)
+    return match.group('table') if match else None
+
+
+def is_session_statement(statement: bytes) -> bool:
+    """Returns True if the statement changes a setting of the database session, e.g
+    `SET client_encoding = 'UTF8'`. Such settings apply to the connection they're run
+    on only.
+
+    Args:
+        statement: The statement, possibly preceded by comments.
+
+    Returns:
+        bool
+
+    """
+    return bool(_SESSION.match(statement, _skip_comments(statement)))
+
+
+def to_copy_row(values: List[Optional[bytes]]) -> bytes:
+    """Encodes row values as a line in PostgreSQL's COPY text format.
+
+    Args:
+        values: The row values. `None` stands for `NULL`.
+
+    Returns:
+        bytes
+
+    """
+    fields = [
+        _COPY_NULL if value is None else _escape_copy_value(value) for value in values
+    ]
+    return b'\t'.join(fields) + b'\n'
+
+
+def _escape_copy_value(value: bytes) -> bytes:
+    if not _COPY_ESCAPES.search(value):
+        return value
+    return _COPY_ESCAPES.sub(lambda m: _COPY_ESCAPE_MAP[m.group(0)], value)
+
+
+def _skip_comments(statement: bytes) -> int:
+    """Returns the offset of the first token of a statement, past any leading
+    whitespace and comments."""
+    pos = 0
+    while True:
+        while statement[pos : pos + 1].isspace():
+            pos += 1
+        if statement.startswith(_LINE_COMMENT, pos):
+            end = statement.find(b'\n', pos)
+            pos = len(statement) if end < 0 else end + 1
+        elif statement.startswith(_BLOCK_COMMENT, pos):
+            end = statement.find(b'*/', pos + 2)
+            pos = len(statement) if end < 0 else end + 2
+        else:
+            return pos
@@ -0,0 +1,105 @@
+import collections
+from typing import Deque, Dict, List, Optional, Tuple
+
+from voleur import metrics
+from voleur import models
+
+
+# Prefix of the INSERT statements, followed by the table name.
+_INSERT_PREFIX = b'INSERT INTO '
+
+
+class TableStatsCollector:
+    """Collects the statistics of each table of a dump as it streams through the stash
+    pipeline: the size and rows of each table from the rewritten lines, and the
+    compressed size from the output of the compression of those lines.
+
+    The compression stage consumes the rewritten chunks in order, one compressed
+    output per chunk. The tables of each chunk are queued until its compressed output
+    is known. Compression is buffered, so a chunk's output may be empty and a later one
+    covers it too: each output is split between the tables of the chunks since the
+    previous one, by their share of those chunks. This is an estimate, which evens out
+    over big tables.
+
+    """
+
+    def __init__(self, stage: Optional[metrics.StageMetrics] = None):
+        self._stage = stage
+        self._tables: Dict[str, models.TableStats] = {}
+        self._chunks: Deque[List[Tuple[Optional[str], int]]] = collections.deque()
+        self._pending: List[Tuple[Optional[str], int]] = []
+
+    def add_lines(self, lines: List[bytes]):
+        """Adds the lines of a rewritten chunk.
+
+        Args:
+            lines: The lines of the chunk.
+
+        """
+        segments: List[Tuple[Optional[str], int]] = []
+        rows: Dict[str, int] = {}
+        for line in lines:
+            table = _get_table(line)
+            if table is not None:
+                stats = self._tables.get(table)
+                if stats is None:
+                    stats = self._tables[table] = models.TableStats(table=table)
+                stats.size += len(line)
+                stats.rows += 1
+                rows[table] = rows.get(table, 0) + 1
+
+            if segments and segments[-1][0] == table:
+                segments[-1] = (table, segments[-1][1] + len(line))
+            else:
+                segments.append((table, len(line)))
+        self._chunks.append(segments)
+
+        if self._stage:
+            for table, count in rows.items():
+                self._stage.add_rows(table, count)
+
+    def add_compressed(self, size: int):
+        """Adds the size of the compressed output of the next chunk.
+
+        Args:
+            size: Size of the compressed output.
+
+        """
+        self._pending.extend(self._chunks.popleft() if self._chunks else [])
+        if size:
+            self._split(size)
+
+    def add_compressed_tail(self, size: int):
+        """Adds the size of the output flushed at the end of the compression. It holds
+        whatever the compressor buffered, which isn't known, so it's split between all
+        the tables by their size.
+
+        Args:
+            size: Size of the compressed output.
+
+        """
+        self._pending = [(table, stats.size) for table, stats in self._tables.items()]
+        if self._pending:
+            self._split(size)
+
+    def _split(self, size: int):
+        """Splits compressed output between the pending tables, by their share of the
+        pending lines."""
+        total = sum(length for _, length in self._pending)
+        for table, length in self._pending:
+            if table is not None:
+                self._tables[table].compressed_size += size * length // total
+        self._pending.clear()
+
+    def get_tables(self) -> List[models.TableStats]:
+        """Returns the statistics of each table, in dump order."""
+        return list(self._tables.values())
+
+
+def _get_table(line: bytes) -> Optional[str]:
+    """Returns the table a line inserts into, `None` if it's not an `INSERT`."""
+    if not line.startswith(_INSERT_PREFIX):
+        return None
+    end = line.find(b' ', len(_INSERT_PREFIX))
+    # The writer names tables the same way, for matching the statistics to its batches.
+    return line[len(_INSERT_PREFIX) : end].decode('utf-8', 'replace')
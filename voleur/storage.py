@@ -1,10 +1,11 @@
 import abc
+import asyncio
 import io
 import contextlib
-from typing import Iterator, ContextManager, BinaryIO, cast
-
-import boto3
-from botocore import exceptions as botocore_exc
+import functools
+import os
+from typing import AsyncIterable, AsyncIterator
+from typing import Callable, Dict, Optional, Tuple, cast
 
 from voleur import utils
 
@@ -49,13 +50,23 @@ def store(backend: str, path: str, content: str) -> str:
     return make_storage_url(backend, path)
 
 
-def store_stream(backend: str, path: str, stream: BinaryIO) -> str:
-    """Stores the contents of the stream at the given path.
+async def store_chunks(
+    backend: str,
+    path: str,
+    chunks: AsyncIterable[bytes],
+    upload_id: Optional[str] = None,
+    on_upload: Optional[Callable[[str], None]] = None,
+) -> str:
+    """Stores a stream of chunks at the given path, uploading as the chunks arrive.
 
     Args:
         backend: The storage backend to use.
         path: The storage path.
-        stream: Bytes stream to read the content from.
+        chunks: Async iterable of the content chunks.
+        upload_id (optional): Id of an interrupted upload of the same content to
+            resume. Parts already uploaded are skipped.
+        on_upload (optional): Called with the id of the upload once started. Makes the
+            upload resumable: it's kept on errors, rather than aborted.
 
     Raises:
         StorageBackendNotSupported
@@ -64,10 +75,29 @@ def store_stream(backend: str, path: str, stream: BinaryIO) -> str:
         str: Storage URL.
 
     """
-    path = get_backend(backend).store_stream(path, stream)
+    path = await get_backend(backend).store_chunks(
+        path, chunks, upload_id=upload_id, on_upload=on_upload
+    )
     return make_storage_url(backend, path)
 
 
+def abort_upload(backend: str, path: str, upload_id: str):
+    """Aborts an interrupted upload to the given path, discarding the parts uploaded so
+    far. A no-op if the upload no longer exists.
+
+    Args:
+        backend: The storage backend to use.
+        path: The storage path.
+        upload_id: Id of the upload, as given to the `on_upload` callback of
+            `store_chunks`.
+
+    Raises:
+        StorageBackendNotSupported
+
+    """
+    get_backend(backend).abort_upload(path, upload_id)
+
+
 def read(backend: str, path: str) -> str:
     """Reads the contents at the given path.
 
@@ -78,6 +108,7 @@ def read(backend: str, path: str) -> str:
     Raises:
         NotFoundError
         StorageBackendNotSupported
+        StorageError
 
     Returns:
         str: The contents.
@@ -86,21 +117,26 @@ def read(backend: str, path: str) -> str:
     return get_backend(backend).read(path)
 
 
-def stream(backend: str, path: str) -> ContextManager[BinaryIO]:
-    """Context-manager for streaming the contents at the given path.
+def read_if_modified(
+    backend: str, path: str, etag: Optional[str] = None
+) -> Tuple[Optional[str], str]:
+    """Reads the contents at the given path, unless they still match the given ETag.
 
     Args:
         backend: The storage backend to use.
         path: The storage path.
+        etag (optional): ETag of a previous read of the contents.
 
     Raises:
+        NotFoundError
         StorageBackendNotSupported
+        StorageError
 
-    Yields:
-        BinaryIO: Bytes stream to read from.
+    Returns:
+        Tuple[Optional[str], str]: The contents, `None` if not modified, and their ETag.
 
     """
-    return get_backend(backend).stream(path)
+    return get_backend(backend).read_if_modified(path, etag)
 
 
 def read_storage_url(storage_url: str) -> str:
@@ -118,23 +154,25 @@ def read_storage_url(storage_url: str) -> str:
     return read(backend, path)
 
 
-def stream_storage_url(storage_url: str) -> ContextManager[BinaryIO]:
-    """Streams the contents at a storage URL.
+async def iter_storage_url(storage_url: str) -> AsyncIterator[bytes]:
+    """Streams the contents at a storage URL as chunks, without blocking the event
+    loop.
 
     Args:
-        backend: The storage backend to use.
-        path: The storage path.
+        storage_url: The storage URL.
 
     Raises:
         InvalidStorageURL
         StorageBackendNotSupported
+        StorageError
 
     Yields:
-        IO[bytes]: Bytes stream to read from.
+        bytes
 
     """
     backend, path = parse_storage_url(storage_url)
-    return stream(backend, path)
+    async for chunk in get_backend(backend).iter_chunks(path):
+        yield chunk
 
 
 def parse_storage_url(storage_url: str) -> tuple:
@@ -194,18 +232,38 @@ class StorageBackend(abc.ABC):
         """
 
     @abc.abstractmethod
-    def store_stream(self, path: str, stream: BinaryIO) -> str:
-        """Stores the contents of the stream at the given path.
+    async def store_chunks(
+        self,
+        path: str,
+        chunks: AsyncIterable[bytes],
+        upload_id: Optional[str] = None,
+        on_upload: Optional[Callable[[str], None]] = None,
+    ) -> str:
+        """Stores a stream of chunks at the given path.
 
         Args:
             path: The storage path.
-            stream: Bytes stream to read the content from.
+            chunks: Async iterable of the content chunks.
+            upload_id (optional): Id of an interrupted upload to resume, for backends
+                supporting resumable uploads.
+            on_upload (optional): Called with the id of a resumable upload once
+                started.
 
         Returns:
             str: The file path.
 
         """
 
+    @abc.abstractmethod
+    def abort_upload(self, path: str, upload_id: str):
+        """Aborts an interrupted upload to the given path, if it still exists.
+
+        Args:
+            path: The storage path.
+            upload_id: Id of the upload.
+
+        """
+
     @abc.abstractmethod
     def read(self, path: str) -> str:
         """Reads the contents at the given path.
@@ -222,9 +280,27 @@ class StorageBackend(abc.ABC):
         """
 
     @abc.abstractmethod
-    @contextlib.contextmanager
-    def stream(self, path: str) -> Iterator[BinaryIO]:
-        """Context-manager for streaming the contents at the given path.
+    def read_if_modified(
+        self, path: str, etag: Optional[str] = None
+    ) -> Tuple[Optional[str], str]:
+        """Reads the contents at the given path, unless they still match the ETag.
+
+        Args:
+            path: The storage path.
+            etag (optional): ETag of a previous read of the contents.
+
+        Raises:
+            NotFoundError
+
+        Returns:
+            Tuple[Optional[str], str]: The contents, `None` if not modified, and their
+                ETag.
+
+        """
+
+    @abc.abstractmethod
+    def iter_chunks(self, path: str) -> AsyncIterator[bytes]:
+        """Async generator streaming the contents at the given path as chunks.
 
         Args:
             path: The storage path.
@@ -233,7 +309,7 @@ class StorageBackend(abc.ABC):
             NotFoundError
 
         Yields:
-            BinaryIO: Bytes stream to read from.
+            bytes
 
         """
 
@@ -248,11 +324,17 @@ def is_backend_supported(name: str) -> bool:
         bool
 
     """
-    return name == 's3'
+    return name in ('s3', 'file')
+
+
+# Backend instances by name. They're shared by all the storage calls of a process, e.g
+# the concurrent stashes of `stash-many`, so that they share the S3 client and its
+# connection pool.
+_backends: Dict[str, 'StorageBackend'] = {}
 
 
 def get_backend(name: str) -> StorageBackend:
-    """Returns a backend instance from its name.
+    """Returns the backend instance for its name.
 
     Args:
         name: The backend name.
@@ -263,7 +345,10 @@ def get_backend(name: str) -> StorageBackend:
     """
     if not is_backend_supported(name):
         raise StorageBackendNotSupported(name)
-    return S3()
+    backend = _backends.get(name)
+    if backend is None:
+        backend = _backends[name] = S3() if name == 's3' else LocalFS()
+    return backend
 
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -275,10 +360,33 @@ class S3(StorageBackend):
     """Storage backend using S3."""
 
     _ENCODING = 'utf-8'
+    _CHUNK_SIZE = 1024 * 1024
+
+    # Size of the parts of multipart uploads, and the max number of parts uploaded
+    # concurrently. Bounds the upload buffers to `_PART_SIZE * _MAX_PARTS_IN_FLIGHT`.
+    _PART_SIZE = 16 * 1024 * 1024
+    _MAX_PARTS_IN_FLIGHT = 4
+
+    # Max number of times a download is resumed after the connection drops, and the
+    # delay before the first retry, doubled on every retry.
+    _MAX_RESUMES = 5
+    _RESUME_DELAY = 1.0
+
+    # Max number of connections kept open to S3. Matches the number of worker threads
+    # the pipelines make S3 calls from.
+    _MAX_POOL_CONNECTIONS = 32
+
     name: str = 's3'
 
     def __init__(self):
-        self._client = boto3.client('s3')
+        # Imported here as boto3 takes a good part of a second to import, which would
+        # slow down commands that never touch S3.
+        import boto3
+        from botocore import config
+
+        self._client = boto3.client(
+            's3', config=config.Config(max_pool_connections=self._MAX_POOL_CONNECTIONS)
+        )
 
     def store(self, path: str, text: str) -> str:
         bucket, key = self._parse_path(path)
@@ -286,12 +394,103 @@ class S3(StorageBackend):
         self._client.put_object(Body=body, Bucket=bucket, Key=key)
         return path
 
-    def store_stream(self, path: str, stream: BinaryIO) -> str:
+    async def store_chunks(
+        self,
+        path: str,
+        chunks: AsyncIterable[bytes],
+        upload_id: Optional[str] = None,
+        on_upload: Optional[Callable[[str], None]] = None,
+    ) -> str:
         bucket, key = self._parse_path(path)
-        self._client.upload_fileobj(stream, bucket, key)
+
+        # Parts of the resumed upload which are already uploaded. Parts are of fixed
+        # size, so the same content always splits into the same parts.
+        done: Dict[int, dict] = {}
+        if upload_id:
+            done = await self._call(self._list_parts, bucket, key, upload_id)
+        if upload_id is None or done is None:
+            create = self._client.create_multipart_upload
+            resp = await self._call(create, Bucket=bucket, Key=key)
+            upload_id, done = resp['UploadId'], {}
+            if on_upload:
+                on_upload(upload_id)
+
+        upload = functools.partial(self._call, Bucket=bucket, Key=key, UploadId=upload_id)
+        slots = asyncio.Semaphore(self._MAX_PARTS_IN_FLIGHT)
+        tasks: list = []
+
+        async def upload_part(number: int, data: bytes) -> dict:
+            try:
+                part = done.get(number)
+                if not part or part['Size'] != len(data):
+                    part = await upload(
+                        self._client.upload_part, PartNumber=number, Body=data
+                    )
+                return {'PartNumber': number, 'ETag': part['ETag']}
+            finally:
+                slots.release()
+
+        try:
+            async for data in utils.rechunk(chunks, self._PART_SIZE):
+                await slots.acquire()
+                # Fail fast if an earlier part failed.
+                for task in tasks:
+                    if task.done() and task.exception():
+                        raise cast(BaseException, task.exception())
+                tasks.append(asyncio.ensure_future(upload_part(len(tasks) + 1, data)))
+            if not tasks:
+                await slots.acquire()
+                tasks.append(asyncio.ensure_future(upload_part(1, b'')))
+            parts = await asyncio.gather(*tasks)
+            await upload(
+                self._client.complete_multipart_upload, MultipartUpload={'Parts': parts}
+            )
+        except BaseException as e:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # Keep a resumable upload around on errors, e.g a dropped connection, to
+            # resume it later. It's only aborted if cancelled, e.g when the extraction
+            # it uploads fails. `CancelledError` is an `Exception` before Python 3.8.
+            cancelled = isinstance(e, asyncio.CancelledError)
+            if not on_upload or cancelled or not isinstance(e, Exception):
+                await upload(self._client.abort_multipart_upload)
+            raise
+
         return path
 
+    def _list_parts(self, bucket: str, key: str, upload_id: str) -> Optional[dict]:
+        """Returns a mapping of part number -> part of a multipart upload, `None` if the
+        upload no longer exists, e.g expired or aborted."""
+        from botocore import exceptions as botocore_exc
+
+        paginator = self._client.get_paginator('list_parts')
+        try:
+            return {
+                part['PartNumber']: part
+                for page in paginator.paginate(Bucket=bucket, Key=key, UploadId=upload_id)
+                for part in page.get('Parts', [])
+            }
+        except botocore_exc.ClientError as e:
+            if e.response['Error']['Code'] == 'NoSuchUpload':
+                return None
+            raise StorageError(f'Cannot list the parts of {key}: {e}') from e
+
+    def abort_upload(self, path: str, upload_id: str):
+        from botocore import exceptions as botocore_exc
+
+        bucket, key = self._parse_path(path)
+        try:
+            self._client.abort_multipart_upload(
+                Bucket=bucket, Key=key, UploadId=upload_id
+            )
+        except botocore_exc.ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchUpload':
+                raise StorageError(f'Cannot abort the upload of {path}: {e}') from e
+
     def read(self, path: str) -> str:
+        from botocore import exceptions as botocore_exc
+
         bucket, key = self._parse_path(path)
         fileobj = io.BytesIO()
 
@@ -301,25 +500,180 @@ class S3(StorageBackend):
             error_code = e.response['Error']['Code']
             if error_code == '404':
                 raise NotFoundError(path)
-            raise
+            raise StorageError(f'Cannot read {path}: {e}') from e
+        except _get_stream_errors() as e:
+            raise StorageError(f'Cannot read {path}: {e}') from e
 
         fileobj.seek(0)
         return fileobj.read().decode(self._ENCODING)
 
-    @contextlib.contextmanager
-    def stream(self, path: str) -> Iterator[BinaryIO]:
-        reader = None
+    def read_if_modified(
+        self, path: str, etag: Optional[str] = None
+    ) -> Tuple[Optional[str], str]:
+        from botocore import exceptions as botocore_exc
 
         bucket, key = self._parse_path(path)
-        resp = self._client.get_object(Bucket=bucket, Key=key)
+        kwargs = {'IfNoneMatch': etag} if etag else {}
 
         try:
-            reader = utils.iterator_to_stream(resp['Body'].iter_lines())
-            yield cast(BinaryIO, reader)
-        finally:
-            if reader:
-                reader.close()
+            resp = self._client.get_object(Bucket=bucket, Key=key, **kwargs)
+        except botocore_exc.ClientError as e:
+            error_code = e.response['Error']['Code']
+            if error_code == '304':
+                return None, cast(str, etag)
+            if error_code in ('404', 'NoSuchKey'):
+                raise NotFoundError(path)
+            raise StorageError(f'Cannot read {path}: {e}') from e
+        except _get_stream_errors() as e:
+            raise StorageError(f'Cannot read {path}: {e}') from e
+
+        try:
+            with contextlib.closing(resp['Body']) as body:
+                return body.read().decode(self._ENCODING), resp['ETag']
+        except _get_stream_errors() as e:
+            raise StorageError(f'Cannot read {path}: {e}') from e
+
+    async def iter_chunks(self, path: str) -> AsyncIterator[bytes]:
+        """Streams the object, resuming with a ranged GET from the last byte received
+        if the connection drops mid-stream. The object must not change in between.
+
+        Raises:
+            StorageError: If S3 answers with an error, e.g access denied, or the
+                connection keeps dropping.
+
+        """
+        from botocore import exceptions as botocore_exc
+
+        errors = _get_stream_errors()
+        bucket, key = self._parse_path(path)
+
+        offset, size, etag = 0, None, None
+        retries = 0
+        while size is None or offset < size:
+            kwargs: Dict[str, str] = {}
+            if etag:
+                kwargs = {'Range': f'bytes={offset}-', 'IfMatch': etag}
+
+            body, error = None, None
+            try:
+                resp = await self._call(
+                    self._client.get_object, Bucket=bucket, Key=key, **kwargs
+                )
+                body = resp['Body']
+                if size is None:
+                    size, etag = resp['ContentLength'], resp['ETag']
+
+                while offset < size:
+                    chunk = await self._call(body.read, self._CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    offset += len(chunk)
+                    yield chunk
+            except botocore_exc.ClientError as e:
+                raise StorageError(f'Cannot read {path}: {e}') from e
+            except errors as e:
+                error = e
+            finally:
+                if body:
+                    body.close()
+
+            if size is not None and offset >= size:
+                break
+            retries += 1
+            if retries > self._MAX_RESUMES:
+                message = f'Connection lost at byte {offset}: {path}'
+                if error:
+                    raise StorageError(f'{message}: {error}') from error
+                raise StorageError(message)
+            await asyncio.sleep(self._RESUME_DELAY * 2 ** (retries - 1))
+
+    async def _call(self, fn, *args, **kwargs):
+        """Runs a blocking client call in a worker thread."""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, functools.partial(fn, *args, **kwargs))
 
     def _parse_path(self, path: str) -> tuple:
         bucket, key = path.split('/', maxsplit=1)
         return bucket, key
+
+
+def _get_stream_errors() -> tuple:
+    """Returns the errors raised when a connection to S3 drops. Imported on first use,
+    like boto3."""
+    import urllib3
+    from botocore import exceptions as botocore_exc
+
+    return (botocore_exc.BotoCoreError, urllib3.exceptions.HTTPError, ConnectionError)
+
+
+class LocalFS(StorageBackend):
+    """Storage backend using the local filesystem. Paths are filesystem paths.
+
+    Useful as a stand-in for S3, e.g for benchmarking, or with shared (NFS) volumes.
+
+    """
+
+    _ENCODING = 'utf-8'
+    _CHUNK_SIZE = 1024 * 1024
+    name: str = 'file'
+
+    def store(self, path: str, text: str) -> str:
+        self._makedirs(path)
+        with open(path, 'w', encoding=self._ENCODING) as f:
+            f.write(text)
+        return path
+
+    async def store_chunks(
+        self,
+        path: str,
+        chunks: AsyncIterable[bytes],
+        upload_id: Optional[str] = None,
+        on_upload: Optional[Callable[[str], None]] = None,
+    ) -> str:
+        loop = asyncio.get_event_loop()
+        self._makedirs(path)
+        with open(path, 'wb') as f:
+            async for chunk in chunks:
+                await loop.run_in_executor(None, f.write, chunk)
+        return path
+
+    def abort_upload(self, path: str, upload_id: str):
+        # Files are written in one go, there are no uploads to resume.
+        pass
+
+    def read(self, path: str) -> str:
+        try:
+            with open(path, encoding=self._ENCODING) as f:
+                return f.read()
+        except FileNotFoundError:
+            raise NotFoundError(path)
+
+    def read_if_modified(
+        self, path: str, etag: Optional[str] = None
+    ) -> Tuple[Optional[str], str]:
+        try:
+            with open(path, encoding=self._ENCODING) as f:
+                # The file's modification time and size stand in for an ETag.
+                stat = os.fstat(f.fileno())
+                current = f'{stat.st_mtime_ns}-{stat.st_size}'
+                if current == etag:
+                    return None, current
+                return f.read(), current
+        except FileNotFoundError:
+            raise NotFoundError(path)
+
+    async def iter_chunks(self, path: str) -> AsyncIterator[bytes]:
+        loop = asyncio.get_event_loop()
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            raise NotFoundError(path)
+        with f:
+            while True:
+                chunk = await loop.run_in_executor(None, f.read, self._CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+    def _makedirs(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
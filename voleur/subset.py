@@ -0,0 +1,482 @@
+import asyncio
+import dataclasses
+import os
+import re
+import tempfile
+import zlib
+from typing import AsyncIterable, AsyncIterator, Dict, Iterator, List, Optional, Set
+from typing import Tuple
+
+from voleur import sql
+from voleur import stats
+
+
+# Size of the chunks of the subset handed downstream.
+CHUNK_SIZE = 1024 * 1024
+
+# Prefix of the INSERT lines of a rewritten dump.
+_INSERT_PREFIX = b'INSERT INTO '
+
+# Rows are sampled by a CRC-32 of the row, which is in `[0, 2 ** 32)`.
+_HASH_RANGE = 2 ** 32
+
+# The table a `CREATE TABLE` or `ALTER TABLE` statement is about.
+_TABLE_STATEMENT = re.compile(
+    rb'^\s*(?:CREATE|ALTER)\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+|ONLY\s+)?'
+    rb'(?P<table>[^\s(]+)',
+    re.IGNORECASE | re.MULTILINE,
+)
+
+# A part of a possibly qualified identifier: a quoted or plain name.
+_IDENTIFIER_PART = re.compile(rb'"(?:[^"]|"")*"|[^."]+')
+
+# A name which needs no quoting.
+_PLAIN_NAME = re.compile(r'[a-z_][a-z0-9_$]*\Z')
+
+# The schema of the tables a dump names without one.
+_DEFAULT_SCHEMA = 'public'
+
+# A table constraint of a foreign key, as output by pg_dump, e.g
+# `FOREIGN KEY (user_id) REFERENCES public.users(id)`.
+_FOREIGN_KEY = re.compile(
+    rb'FOREIGN\s+KEY\s*\((?P<columns>[^)]*)\)\s*'
+    rb'REFERENCES\s+(?P<table>[^\s(]+)\s*\((?P<referenced>[^)]*)\)',
+    re.IGNORECASE,
+)
+
+
+@dataclasses.dataclass
+class TableSample:
+    # Share of the table's rows to sample, from 0 to 1.
+    fraction: float = 1.0
+
+    # Max number of the table's rows to sample, if any.
+    limit: Optional[int] = None
+
+    @property
+    def whole(self) -> bool:
+        return self.fraction >= 1 and self.limit is None
+
+
+@dataclasses.dataclass
+class Sample:
+    # The sample as given, e.g `1%,users=10%`, which is recorded with the dump.
+    spec: str
+
+    # The sample of the tables without one of their own.
+    default: TableSample = dataclasses.field(default_factory=TableSample)
+
+    # Mapping of table name, qualified or not (e.g `audit.users` or `users`) -> sample.
+    tables: Dict[str, TableSample] = dataclasses.field(default_factory=dict)
+
+    def get(self, table: str) -> TableSample:
+        """Returns the sample of a table, given its qualified name (e.g `public.users`),
+        as given for the table itself, or for its name in any schema, or the default."""
+        sample = self.tables.get(table)
+        if sample is None:
+            name = _IDENTIFIER_PART.findall(table.encode('utf-8'))[-1]
+            sample = self.tables.get(name.decode('utf-8'), self.default)
+        return sample
+
+
+@dataclasses.dataclass(frozen=True)
+class ForeignKey:
+    # The referencing table, by qualified name (e.g `public.users`), and columns.
+    table: str
+    columns: Tuple[str, ...]
+
+    # The referenced table and columns.
+    referenced_table: str
+    referenced_columns: Tuple[str, ...]
+
+
+def parse_sample(specs: List[str]) -> Sample:
+    """Parses the sample of a subset dump. Each spec is either a share of the rows,
+    e.g `1%`, or a max number of rows, e.g `1000`, for all the tables or, prefixed with
+    `<table>=`, for a single one. A table given without its schema, e.g `users`, is any
+    table of that name, whatever its schema, unless one is given with it, e.g
+    `audit.users`. Specs can also be given comma-separated. Tables with no spec of their
+    own, and no spec for all the tables, are kept whole.
+
+    Args:
+        specs: The specs, e.g `['1%', 'users=10%', 'countries=100%']`.
+
+    Raises:
+        ValueError: If a spec cannot be parsed.
+
+    Returns:
+        Sample
+
+    """
+    specs = [spec.strip() for spec in ','.join(specs).split(',') if spec.strip()]
+    sample = Sample(spec=','.join(specs))
+    for spec in specs:
+        table, _, value = spec.rpartition('=')
+        if value.endswith('%'):
+            try:
+                fraction = float(value[:-1]) / 100
+            except ValueError:
+                raise ValueError(f'Invalid sample: {spec}')
+            if not 0 <= fraction <= 1:
+                raise ValueError(f'Invalid sample: {spec}')
+            table_sample = TableSample(fraction=fraction)
+        elif value.isdigit():
+            table_sample = TableSample(limit=int(value))
+        else:
+            raise ValueError(f'Invalid sample: {spec}')
+
+        if table:
+            name = _get_table_name(table.encode('utf-8'), schema=None)
+            sample.tables[name] = table_sample
+        else:
+            sample.default = table_sample
+    return sample
+
+
+def parse_foreign_keys(structure: bytes) -> List[ForeignKey]:
+    """Parses the foreign keys declared in the `CREATE TABLE` and `ALTER TABLE`
+    statements of a dump.
+
+    Args:
+        structure: The statements of the dump other than the `INSERT`s.
+
+    Returns:
+        List[ForeignKey]
+
+    """
+    splitter = sql.StatementSplitter()
+    statements = splitter.feed(structure)
+    rest = splitter.close()
+    if rest:
+        statements.append(rest)
+
+    foreign_keys = []
+    for statement in statements:
+        owner = _TABLE_STATEMENT.search(statement)
+        if not owner:
+            continue
+        for match in _FOREIGN_KEY.finditer(statement, owner.end()):
+            columns = _get_names(match.group('columns'))
+            referenced = _get_names(match.group('referenced'))
+            if len(columns) != len(referenced):
+                continue
+            foreign_keys.append(
+                ForeignKey(
+                    table=_get_table_name(owner.group('table')),
+                    columns=columns,
+                    referenced_table=_get_table_name(match.group('table')),
+                    referenced_columns=referenced,
+                )
+            )
+    return foreign_keys
+
+
+async def subset_dump(
+    chunks: AsyncIterable[bytes],
+    sample: Sample,
+    tables: Optional[stats.TableStatsCollector] = None,
+) -> AsyncIterator[bytes]:
+    """Keeps a sample of the rows of a rewritten dump, along with every row they
+    reference through foreign keys, recursively, so that the subset restores without
+    breaking any constraint.
+
+    A row may reference rows earlier in the dump, so the dump is buffered to a
+    temporary file and read in passes. Each pass selects the sampled rows and the rows
+    referenced so far, and records the keys referenced by the selected rows, until no
+    new key is referenced in rows already passed. The subset is then read out in a last
+    pass. Only the referenced keys are held in memory, never the rows.
+
+    The foreign keys are read from the dump's own statements. Rows are sampled by a
+    hash of their contents, so the same rows are picked from one dump to the next.
+
+    Args:
+        chunks: Chunks of the rewritten dump, made of whole lines.
+        sample: The sample of each table.
+        tables (optional): Collector of the statistics of each table in the subset.
+
+    Yields:
+        bytes: Chunks made of whole lines.
+
+    """
+    loop = asyncio.get_event_loop()
+    fd, path = tempfile.mkstemp(prefix='voleur-subset-', suffix='.dump')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            async for chunk in chunks:
+                await loop.run_in_executor(None, f.write, chunk)
+
+        structure = await loop.run_in_executor(None, _read_structure, path)
+        selector = _Selector(sample, parse_foreign_keys(structure))
+        await loop.run_in_executor(None, selector.run, path)
+
+        subset = selector.iter_subset(path)
+        while True:
+            lines = await loop.run_in_executor(None, next, subset, None)
+            if lines is None:
+                break
+            if tables:
+                tables.add_lines(lines)
+            yield b''.join(lines)
+    finally:
+        os.remove(path)
+
+
+class _Selector:
+    """Selects the rows of a dump which are in the subset: the sampled rows and the
+    rows they reference, recursively.
+
+    The keys referenced by the selected rows are recorded per referenced table and
+    columns. Tables kept whole aren't tracked, since all of their rows are selected.
+
+    The first pass reads the whole dump, recording where the rows of the tracked tables
+    are. A key referenced once the rows of its table were passed calls for another pass
+    over that table only. Passes alternate direction, so that a chain of rows
+    referencing earlier rows (e.g a tree of comments) is followed in one pass.
+
+    """
+
+    def __init__(self, sample: Sample, foreign_keys: List[ForeignKey]):
+        self._sample = sample
+
+        # Mapping of table -> the foreign keys it references tracked tables with.
+        self._references: Dict[str, List[ForeignKey]] = {}
+
+        # Mapping of tracked table -> referenced columns -> keys referenced so far.
+        self._keys: Dict[str, Dict[Tuple[str, ...], Set[tuple]]] = {}
+
+        for key in foreign_keys:
+            if sample.get(key.referenced_table).whole:
+                continue
+            self._references.setdefault(key.table, []).append(key)
+            keys = self._keys.setdefault(key.referenced_table, {})
+            keys.setdefault(key.referenced_columns, set())
+
+        # Blocks of consecutive rows of the tracked tables: table, start and end offset.
+        self._blocks: List[Tuple[str, int, int]] = []
+
+        # Mapping of table -> offset of its last sampled row, once its limit is reached.
+        # Rows sampled up to a limit are the first ones in dump order, in every pass.
+        self._cutoffs: Dict[str, int] = {}
+
+        # Caches of the table names, and of the position of each column, by the way
+        # they're written in the `INSERT` statements.
+        self._names: Dict[bytes, str] = {}
+        self._positions: Dict[bytes, Dict[str, int]] = {}
+
+        # State of the current pass: the tables it reads (`None` for all), the tables
+        # passed, the number of rows sampled of each table, and the tables with keys
+        # referenced once passed, which need another pass.
+        self._scanned: Optional[Set[str]] = None
+        self._passed: Set[str] = set()
+        self._counts: Dict[str, int] = {}
+        self._dirty: Set[str] = set()
+
+    def run(self, path: str):
+        """Selects the rows of the subset, in as many passes over the dump as needed.
+
+        Args:
+            path: Path to the dump file.
+
+        """
+        self._start(None)
+        with open(path, 'rb') as f:
+            offset = 0
+            for line in f:
+                table = self._get_table(line)
+                if table in self._keys:
+                    self._add_block(table, offset, offset + len(line))
+                self._select(line, offset, table)
+                offset += len(line)
+
+        reverse = True
+        while self._dirty:
+            self._start(self._dirty)
+            for line, offset in self._iter_blocks(path, reverse):
+                self._select(line, offset, self._get_table(line))
+            reverse = not reverse
+
+    def iter_subset(self, path: str) -> Iterator[List[bytes]]:
+        """Reads out the selected rows, and the rest of the statements, in chunks of
+        lines.
+
+        Args:
+            path: Path to the dump file.
+
+        Yields:
+            List[bytes]
+
+        """
+        self._start(None)
+        lines: List[bytes] = []
+        size = offset = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                if self._select(line, offset, self._get_table(line)):
+                    lines.append(line)
+                    size += len(line)
+                offset += len(line)
+                if size >= CHUNK_SIZE:
+                    yield lines
+                    lines, size = [], 0
+        if lines:
+            yield lines
+
+    def _start(self, tables: Optional[Set[str]]):
+        self._scanned = tables
+        self._passed = set()
+        self._counts.clear()
+        self._dirty = set()
+
+    def _add_block(self, table: str, start: int, end: int):
+        if self._blocks:
+            last_table, last_start, last_end = self._blocks[-1]
+            contiguous = last_table == table and last_end == start
+            if contiguous and start - last_start < CHUNK_SIZE:
+                self._blocks[-1] = (table, last_start, end)
+                return
+        self._blocks.append((table, start, end))
+
+    def _iter_blocks(self, path: str, reverse: bool) -> Iterator[Tuple[bytes, int]]:
+        """Yields the rows of the scanned tables, with their offsets, in either
+        direction."""
+        blocks = [block for block in self._blocks if block[0] in (self._scanned or ())]
+        if reverse:
+            blocks.reverse()
+        with open(path, 'rb') as f:
+            for _, start, end in blocks:
+                f.seek(start)
+                rows = []
+                for line in f.read(end - start).splitlines(keepends=True):
+                    rows.append((line, start))
+                    start += len(line)
+                yield from reversed(rows) if reverse else rows
+
+    def _get_table(self, line: bytes) -> Optional[str]:
+        if not line.startswith(_INSERT_PREFIX):
+            return None
+        table_id = sql.get_insert_table(line)
+        if table_id is None:
+            return None
+        table = self._names.get(table_id)
+        if table is None:
+            table = self._names[table_id] = _get_table_name(table_id)
+        return table
+
+    def _select(self, line: bytes, offset: int, table: Optional[str]) -> bool:
+        """Returns whether a line is in the subset, recording the keys it references
+        if so."""
+        if table is None:
+            return True
+        self._passed.add(table)
+
+        sample = self._sample.get(table)
+        references = self._references.get(table)
+        keys = self._keys.get(table)
+        if sample.whole and not references:
+            return True
+        selected = self._is_sampled(table, sample, line, offset)
+        if not references and not keys:
+            return selected
+
+        insert = sql.parse_insert(line)
+        if insert is None:
+            # Rows klepto wouldn't output can't be followed, so they're kept.
+            return True
+        positions = self._get_positions(insert.columns)
+        values = insert.values
+
+        if not selected and keys:
+            selected = any(
+                _get_key(positions, values, columns) in referenced
+                for columns, referenced in keys.items()
+            )
+        if selected and references:
+            for key in references:
+                value = _get_key(positions, values, key.columns)
+                referenced = self._keys[key.referenced_table][key.referenced_columns]
+                if value is None or value in referenced:
+                    continue
+                referenced.add(value)
+                if not self._will_pass(key.referenced_table):
+                    self._dirty.add(key.referenced_table)
+        return selected
+
+    def _will_pass(self, table: str) -> bool:
+        """Returns whether all the rows of a table are still ahead in this pass."""
+        scanned = self._scanned is None or table in self._scanned
+        return scanned and table not in self._passed
+
+    def _is_sampled(
+        self, table: str, sample: TableSample, line: bytes, offset: int
+    ) -> bool:
+        if sample.fraction < 1 and zlib.crc32(line) >= sample.fraction * _HASH_RANGE:
+            return False
+        if sample.limit is None:
+            return True
+        cutoff = self._cutoffs.get(table)
+        if cutoff is not None:
+            return offset <= cutoff
+
+        # Until the limit is reached in the first pass. If it's never reached, all the
+        # rows are sampled whatever the order of the pass.
+        count = self._counts.get(table, 0)
+        if count >= sample.limit:
+            return False
+        self._counts[table] = count + 1
+        if count + 1 == sample.limit:
+            self._cutoffs[table] = offset
+        return True
+
+    def _get_positions(self, columns: bytes) -> Dict[str, int]:
+        positions = self._positions.get(columns)
+        if positions is None:
+            names = _get_names(columns)
+            positions = self._positions[columns] = {n: i for i, n in enumerate(names)}
+        return positions
+
+
+def _get_key(
+    positions: Dict[str, int], values: List[Optional[bytes]], columns: Tuple[str, ...]
+) -> Optional[tuple]:
+    """Returns the values of the given columns of a row, `None` if any is `NULL` (which
+    references nothing) or missing."""
+    key = []
+    for column in columns:
+        i = positions.get(column)
+        if i is None or i >= len(values) or values[i] is None:
+            return None
+        key.append(values[i])
+    return tuple(key)
+
+
+def _read_structure(path: str) -> bytes:
+    """Returns the lines of a dump other than the `INSERT`s."""
+    with open(path, 'rb') as f:
+        return b''.join(line for line in f if not line.startswith(_INSERT_PREFIX))
+
+
+def _get_table_name(identifier: bytes, schema: Optional[str] = _DEFAULT_SCHEMA) -> str:
+    """Returns the qualified name of a table, written the same way however the
+    identifier is quoted, e.g `public."Users"` for `"public"."Users"` and `public.users`
+    for `Public.Users`, so that same-named tables of different schemas are told apart.
+    An unqualified name is qualified with `schema`, if given."""
+    names = [_get_name(part) for part in _IDENTIFIER_PART.findall(identifier.strip())]
+    if schema and len(names) == 1:
+        names.insert(0, schema)
+    return '.'.join(
+        name if _PLAIN_NAME.match(name) else '"' + name.replace('"', '""') + '"'
+        for name in names
+    )
+
+
+def _get_name(identifier: bytes) -> str:
+    """Returns the name of a possibly quoted identifier, e.g `users` for `"users"`.
+    Unquoted names are folded to lower case, like PostgreSQL does."""
+    name = identifier.strip()
+    if len(name) > 1 and name.startswith(b'"') and name.endswith(b'"'):
+        return name[1:-1].replace(b'""', b'"').decode('utf-8', 'replace')
+    return name.lower().decode('utf-8', 'replace')
+
+
+def _get_names(identifiers: bytes) -> Tuple[str, ...]:
+    return tuple(_get_name(identifier) for identifier in identifiers.split(b','))
@@ -0,0 +1,241 @@
+import hashlib
+from typing import Iterable, List
+from urllib import parse
+
+
+# Prefix of the template databases managed by voleur. Template names are made from this
+# prefix, a hash of the stash bucket and the dump id, e.g `voleur_tpl_9f86d081_1a2b3c4d`,
+# so that the templates of different stashes on the same server never clash.
+TEMPLATE_PREFIX = 'voleur_tpl_'
+
+# Suffix of a template which is still being restored into.
+_STAGING_SUFFIX = '_staging'
+
+# Database to connect to for server-level operations.
+_MAINTENANCE_DB = 'postgres'
+
+
+class TemplateError(Exception):
+    """Raised on any error encountered while managing template databases."""
+
+
+def get_template_name(bucket: str, dump_id: str) -> str:
+    """Returns the name of the template database for a dump.
+
+    Args:
+        bucket: The stash bucket.
+        dump_id: The dump id.
+
+    Returns:
+        str
+
+    """
+    return f'{_get_stash_prefix(bucket)}{dump_id}'
+
+
+def get_server_uri(target: str) -> str:
+    """Returns the URI of the maintenance database on the target's server. It's used
+    for running `CREATE DATABASE`/`DROP DATABASE` which cannot run in the database
+    they act on.
+
+    Args:
+        target: Target database URI.
+
+    Returns:
+        str
+
+    """
+    return _replace_database(target, _MAINTENANCE_DB)
+
+
+def get_template_uri(target: str, bucket: str, dump_id: str) -> str:
+    """Returns the URI for connecting to the (staging) template of a dump on the
+    target's server. Used for restoring the dump into the template.
+
+    Args:
+        target: Target database URI.
+        bucket: The stash bucket.
+        dump_id: The dump id.
+
+    Returns:
+        str
+
+    """
+    return _replace_database(target, get_template_name(bucket, dump_id) + _STAGING_SUFFIX)
+
+
+def template_exists(server_uri: str, bucket: str, dump_id: str) -> bool:
+    """Returns True if a ready template for the dump exists on the server.
+
+    Args:
+        server_uri: Maintenance database URI.
+        bucket: The stash bucket.
+        dump_id: The dump id.
+
+    Returns:
+        bool
+
+    """
+    name = get_template_name(bucket, dump_id)
+    sql = f'SELECT 1 FROM pg_database WHERE datname = {_quote_literal(name)}'
+    return bool(_execute(server_uri, sql))
+
+
+def begin_template(server_uri: str, bucket: str, dump_id: str):
+    """Creates an empty staging database for restoring the dump into. Any leftover
+    staging database from a previously failed attempt is dropped first.
+
+    Args:
+        server_uri: Maintenance database URI.
+        bucket: The stash bucket.
+        dump_id: The dump id.
+
+    Raises:
+        TemplateError
+
+    """
+    staging = _quote_ident(get_template_name(bucket, dump_id) + _STAGING_SUFFIX)
+    _execute(server_uri, f'DROP DATABASE IF EXISTS {staging}')
+    _execute(server_uri, f'CREATE DATABASE {staging}')
+
+
+def commit_template(server_uri: str, bucket: str, dump_id: str):
+    """Turns a fully restored staging database into the dump's template. Renaming
+    last guarantees that a template that exists is always complete.
+
+    Args:
+        server_uri: Maintenance database URI.
+        bucket: The stash bucket.
+        dump_id: The dump id.
+
+    Raises:
+        TemplateError
+
+    """
+    name = get_template_name(bucket, dump_id)
+    staging = _quote_ident(name + _STAGING_SUFFIX)
+    _execute(server_uri, f'ALTER DATABASE {staging} RENAME TO {_quote_ident(name)}')
+    _execute(server_uri, f'ALTER DATABASE {_quote_ident(name)} IS_TEMPLATE true')
+
+
+def abort_template(server_uri: str, bucket: str, dump_id: str):
+    """Drops the staging database of a failed template restore.
+
+    Args:
+        server_uri: Maintenance database URI.
+        bucket: The stash bucket.
+        dump_id: The dump id.
+
+    Raises:
+        TemplateError
+
+    """
+    staging = _quote_ident(get_template_name(bucket, dump_id) + _STAGING_SUFFIX)
+    _execute(server_uri, f'DROP DATABASE IF EXISTS {staging}')
+
+
+def clone_template(target: str, bucket: str, dump_id: str):
+    """Creates the target database as a copy of the dump's template. The target
+    database must not exist.
+
+    Args:
+        target: Target database URI.
+        bucket: The stash bucket.
+        dump_id: The dump id.
+
+    Raises:
+        TemplateError
+
+    """
+    database = _quote_ident(_get_database(target))
+    template = _quote_ident(get_template_name(bucket, dump_id))
+    _execute(get_server_uri(target), f'CREATE DATABASE {database} TEMPLATE {template}')
+
+
+def evict_templates(server_uri: str, bucket: str, keep: Iterable[str]) -> List[str]:
+    """Drops the templates of the stash on the server whose dump id is not in `keep`.
+    Templates of other stashes are left alone.
+
+    Args:
+        server_uri: Maintenance database URI.
+        bucket: The stash bucket.
+        keep: Dump ids whose templates should be kept.
+
+    Raises:
+        TemplateError
+
+    Returns:
+        List[str]: The dump ids of the evicted templates.
+
+    """
+    prefix = _get_stash_prefix(bucket)
+    keep_names = {get_template_name(bucket, dump_id) for dump_id in keep}
+    pattern = _quote_literal(_escape_like(prefix) + '%')
+    rows = _execute(
+        server_uri,
+        f'SELECT datname FROM pg_database WHERE datname LIKE {pattern} '
+        f'AND datistemplate',
+    )
+
+    evicted = []
+    for (name,) in rows:
+        if name in keep_names:
+            continue
+        _execute(server_uri, f'ALTER DATABASE {_quote_ident(name)} IS_TEMPLATE false')
+        _execute(server_uri, f'DROP DATABASE {_quote_ident(name)}')
+        evicted.append(name[len(prefix) :])
+    return evicted
+
+
+def _get_stash_prefix(bucket: str) -> str:
+    # Hashed, as bucket names can be as long as a database name (63 characters).
+    key = hashlib.sha1(bucket.encode()).hexdigest()[:8]
+    return f'{TEMPLATE_PREFIX}{key}_'
+
+
+def _get_database(uri: str) -> str:
+    return parse.unquote(parse.urlsplit(uri).path.lstrip('/'))
+
+
+def _replace_database(uri: str, database: str) -> str:
+    parts = parse.urlsplit(uri)
+    return parse.urlunsplit(parts._replace(path='/' + parse.quote(database)))
+
+
+def _escape_like(value: str) -> str:
+    # Backslash is the default escape character of LIKE patterns.
+    return value.replace('\\', '\\\\').replace('_', '\\_').replace('%', '\\%')
+
+
+def _quote_ident(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _quote_literal(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _execute(uri: str, sql: str) -> List[tuple]:
+    """Runs a single SQL command outside of a transaction and returns its rows.
+
+    Raises:
+        TemplateError: If the command fails.
+
+    """
+    # Imported on first use to keep the CLI startup fast.
+    import psycopg2
+
+    try:
+        conn = psycopg2.connect(uri)
+    except psycopg2.Error as e:
+        raise TemplateError(str(e).strip())
+
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute(sql)
+            return cursor.fetchall() if cursor.description else []
+    except psycopg2.Error as e:
+        raise TemplateError(str(e).strip())
+    finally:
+        conn.close()
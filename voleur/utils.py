@@ -1,104 +1,101 @@
+import math
 import uuid
-import io
 from datetime import datetime
-from typing import Iterable, Iterator
-import queue
-import threading
+from urllib import parse
+from typing import AsyncIterable, AsyncIterator
+
+
+# Suffix of gzip-compressed dump files.
+COMPRESSED_SUFFIX = '.gz'
 
 
 def generate_dump_filename() -> str:
-    """Generates a unique dump filename.
+    """Generates a unique (compressed) dump filename.
 
     Returns:
         str: The filename.
 
     """
     timestamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
-    return f'{uuid.uuid4().hex}_{timestamp}.dump'
+    return f'{uuid.uuid4().hex}_{timestamp}.dump{COMPRESSED_SUFFIX}'
 
 
-class _IteratorStream(io.RawIOBase):
-    """Helper class that implements the stream interface ontop of an iterator that
-    yields bytestrings.
+def redact_uri(uri: str) -> str:
+    """Masks the password of a database URI, so it can be safely printed.
 
-    """
+    Args:
+        uri: Database URI.
 
-    def __init__(self, iterator: Iterator[bytes]):
-        self._leftover = b''
-        self._iterator = iterator
+    Returns:
+        str
 
-    def readable(self):
-        return True
+    """
+    parts = parse.urlsplit(uri)
+    if not parts.password:
+        return uri
+    netloc = parts.netloc.replace(f':{parts.password}@', ':***@', 1)
+    return parse.urlunsplit(parts._replace(netloc=netloc))
 
-    def readinto(self, b) -> int:
-        """Read bytes into a pre-allocated, writable bytes-like object b, and return the
-        number of bytes read. For example, b might be a bytearray.
 
-        Returns:
-            int: bytes read
+def format_size(num_bytes: float) -> str:
+    """Formats a number of bytes in a human readable form.
 
-        """
-        bytes_to_read = len(b)
+    Args:
+        num_bytes: The number of bytes.
 
-        try:
-            chunk = self._leftover or next(self._iterator)
-        except StopIteration:
-            # We've exhausted the iterator and we don't have any leftovers so we
-            # indicate EOF.
-            return 0
+    Returns:
+        str
 
-        output, self._leftover = chunk[:bytes_to_read], chunk[bytes_to_read:]
-        b[: len(output)] = output
-        return len(output)
+    """
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(num_bytes) < 1024:
+            return f'{num_bytes:.1f} {unit}'
+        num_bytes /= 1024
+    return f'{num_bytes:.1f} TB'
 
 
-def iterator_to_stream(iterator: Iterator) -> io.BufferedReader:
-    """Constructs a `BufferedReader` from an iterator that yields byte strings.
+def parse_size(text: str) -> int:
+    """Parses a human readable number of bytes, e.g `512K`, `10MB` or `2G`.
 
     Args:
-        iterator: The iterator to wrap.
+        text: The size, with an optional `K`, `M`, `G` or `T` unit.
+
+    Raises:
+        ValueError: If the size cannot be parsed.
 
     Returns:
-        io.BufferedReader
+        int
 
     """
-    stream = _IteratorStream(iterator)
-    return io.BufferedReader(stream)
+    number = text.strip().upper().rstrip('B')
+    multiplier = 1
+    for exponent, unit in enumerate('KMGT', 1):
+        if number.endswith(unit):
+            number, multiplier = number[:-1], 1024 ** exponent
+            break
+    size = float(number) * multiplier
+    if not math.isfinite(size) or size < 0:
+        raise ValueError(f'Invalid size: {text}')
+    return int(size)
+
+
+async def rechunk(chunks: AsyncIterable[bytes], size: int) -> AsyncIterator[bytes]:
+    """Regroups a stream of chunks into chunks of exactly the given size. Only the last
+    chunk may be smaller.
 
+    Args:
+        chunks: The chunks to regroup.
+        size: The chunk size.
 
-class FileReaderThread(threading.Thread):
-    """Helper thread for reading file output given one of its open streams. Reading
-    in threads avoids the possibility of a deadlock when reading both stdin and stdout.
+    Yields:
+        bytes
 
     """
-
-    def __init__(self, fd):
-        self._fd = fd
-        self._queue = queue.Queue()
-        self._stop_event = threading.Event()
-        super().__init__()
-
-    def run(self):
-        """Run the thread. Read the file line by line."""
-        while not self.is_stopped():
-            for line in self._fd:
-                self._queue.put(line)
-            else:
-                self.stop()
-
-    def stop(self):
-        """Stop the thread."""
-        self._stop_event.set()
-
-    def is_stopped(self) -> bool:
-        """Return True if the thread is stopped."""
-        return self._stop_event.is_set()
-
-    def eof(self):
-        """EOF if the thread is dead and there are no more lines in the queue."""
-        return not self.is_alive() and self._queue.empty()
-
-    def iter_lines(self) -> Iterable[bytes]:
-        """Yields lines from the stream."""
-        while not self._queue.empty():
-            yield self._queue.get()
+    buffer = bytearray()
+    async for chunk in chunks:
+        buffer += chunk
+        while len(buffer) >= size:
+            yield bytes(buffer[:size])
+            del buffer[:size]
+    if buffer:
+        yield bytes(buffer)
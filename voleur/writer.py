@@ -1,34 +1,550 @@
-import subprocess
-from typing import BinaryIO
+import asyncio
+import dataclasses
+import io
+import itertools
+import time
+from typing import AsyncIterable, AsyncIterator, Callable, Dict, Iterable, Iterator
+from typing import List, Optional
+
+from voleur import metrics as metrics_
+from voleur import models
+from voleur import sql
+
+
+# Size of the chunks sent to the database during a COPY.
+CHUNK_SIZE = 1024 * 1024
+
+# Max size of the data sent to the database in a single COPY or batch of statements.
+BATCH_SIZE = 8 * 1024 * 1024
+
+# Max number of batches buffered per target before the reader blocks. Bounds memory use
+# to roughly `BATCH_SIZE * QUEUE_SIZE` per target.
+QUEUE_SIZE = 4
 
 
 class WriterError(Exception):
     """Raised on any error encountered while writing to a target."""
 
 
-def write_dump(target: str, stream: BinaryIO):
-    """Writes a dump (as a byte stream) to the target database.
+@dataclasses.dataclass
+class Progress:
+    # The target database URI.
+    target: str
+
+    # Dump bytes written to the target so far.
+    bytes_written: int = 0
+
+    # Rows written to the target so far.
+    rows_written: int = 0
+
+    # The table last written to, if any.
+    table: Optional[str] = None
+
+    # Rows written to that table so far.
+    table_rows: int = 0
+
+    # The table whose last rows were just written, if known from the dump's statistics.
+    completed_table: Optional[str] = None
+
+    # Size of the rows of the dump, if known from the dump's statistics.
+    total_bytes: Optional[int] = None
+
+    # Estimated seconds until all the rows are written, if known.
+    eta_seconds: Optional[float] = None
+
+
+async def write_dump_many(
+    targets: List[str],
+    chunks: AsyncIterable[bytes],
+    on_progress: Optional[Callable[[Progress], None]] = None,
+    metrics: Optional[metrics_.Metrics] = None,
+    workers: int = 1,
+    tables: Optional[List[models.TableStats]] = None,
+) -> Dict[str, Optional[WriterError]]:
+    """Writes a dump (as a stream of chunks) to many target databases in parallel.
+
+    The dump is parsed only once. Runs of `INSERT` statements into the same table are
+    turned into COPY batches, which are multiplexed to the database connections of each
+    target. A target stops at its first error, which does not affect the rest; the
+    error is returned instead of raised.
+
+    With many workers, the tables are written over that many connections per target.
+    Given the dump's table statistics, the tables are assigned to the workers largest
+    first, which balances their load, and the time remaining is estimated.
+
+    Args:
+        targets: Target database URIs.
+        chunks: Async iterable of dump chunks.
+        on_progress (optional): Called with a target's `Progress` after each batch is
+            written to it.
+        metrics (optional): Metrics to record the `parse` stage and a `write` stage per
+            target and worker into.
+        workers (optional): Number of connections to write each target over.
+        tables (optional): Statistics of the tables of the dump.
+
+    Returns:
+        Dict[str, Optional[WriterError]]: Mapping of target -> error, `None` on success.
+
+    """
+    metrics = metrics or metrics_.Metrics('restore')
+    parse = metrics.stage('parse')
+
+    writers = []
+    for i, target in enumerate(targets, 1):
+        name = 'write' if len(targets) == 1 else f'write #{i}'
+        writers.append(
+            _Writer(
+                target,
+                on_progress=on_progress,
+                metrics=metrics,
+                name=name,
+                workers=workers,
+                tables=tables,
+            )
+        )
+    tasks = [asyncio.ensure_future(writer.run()) for writer in writers]
+
+    # Read through a single iterator, so that once every target failed the rest of
+    # the dump can be consumed (and thrown away) without parsing it. Otherwise the
+    # stages feeding it would be left blocked on a full channel.
+    reader = chunks.__aiter__()
+
+    parse.start()
+    try:
+        async for batch in iter_batches(reader):
+            if all(writer.failed for writer in writers):
+                async for _ in reader:
+                    pass
+                break
+            parse.bytes_out += batch.size
+            if batch.table:
+                parse.add_rows(batch.table, batch.rows)
+
+            started = time.monotonic()
+            for writer in writers:
+                await writer.put(batch)
+            parse.blocked_output_seconds += time.monotonic() - started
+        for writer in writers:
+            await writer.finish()
+        parse.finish()
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+    return {writer.target: writer.error for writer in writers}
+
+
+@dataclasses.dataclass
+class Batch:
+    # The statement(s) to execute, or the `COPY ... FROM STDIN` command. Kept as bytes,
+    # as they're in the encoding of the dump, which may not be UTF-8.
+    sql: bytes
+
+    # Rows in COPY text format, for COPY batches.
+    data: Optional[bytes] = None
+
+    # The table written to, for COPY batches.
+    table: Optional[str] = None
+
+    # Number of rows in the batch.
+    rows: int = 0
+
+    # Size of the dump statements the batch was made from.
+    size: int = 0
+
+    # Whether the batch changes session settings, which apply to a single connection.
+    session: bool = False
+
+
+async def iter_batches(
+    chunks: AsyncIterable[bytes], batch_size: int = BATCH_SIZE
+) -> AsyncIterator[Batch]:
+    """Parses a stream of dump chunks and yields it as batches ready to be sent to a
+    database.
 
     Args:
-        target: Target database URI.
-        stream: Byte stream to read from.
+        chunks: Async iterable of dump chunks.
+        batch_size: Max size of each batch.
+
+    Yields:
+        Batch
 
     """
-    process = subprocess.Popen(
-        ['psql', '-f', '-', target],
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        text=False,
-        shell=False,
-    )
+    splitter = sql.StatementSplitter()
+    batcher = _Batcher(batch_size)
+
+    async for chunk in chunks:
+        for statement in splitter.feed(chunk):
+            for batch in batcher.add(statement):
+                yield batch
+
+    tail = splitter.close()
+    for batch in itertools.chain(batcher.add(tail) if tail else [], batcher.flush()):
+        yield batch
+
+
+def batch_statements(
+    statements: Iterable[bytes], batch_size: int = BATCH_SIZE
+) -> Iterator[Batch]:
+    """Groups complete statements into batches ready to be sent to a database, like
+    `iter_batches` does for a stream of chunks.
+
+    Args:
+        statements: The statements.
+        batch_size: Max size of each batch.
+
+    Yields:
+        Batch
+
+    """
+    batcher = _Batcher(batch_size)
+    for statement in statements:
+        yield from batcher.add(statement)
+    yield from batcher.flush()
+
+
+def execute(cursor, batch: Batch):
+    """Executes a batch with a database cursor.
+
+    Args:
+        cursor: A psycopg2 cursor, of a connection in autocommit mode.
+        batch: The batch to execute.
+
+    Raises:
+        WriterError
+
+    """
+    import psycopg2
 
     try:
-        stdin = process.stdin
-        for line in stream:
-            stdin.write(line)
-        _, stderr = process.communicate()
-        if process.returncode > 0:
-            raise WriterError(stderr.strip().decode('utf-8'))
-    finally:
-        stdin.close()
+        if batch.data is None:
+            cursor.execute(batch.sql)
+        else:
+            cursor.copy_expert(batch.sql, io.BytesIO(batch.data), size=CHUNK_SIZE)
+    except psycopg2.Error as e:
+        where = f' (table: {batch.table})' if batch.table else ''
+        raise WriterError(f'{str(e).strip()}{where}')
+
+
+class _Batcher:
+    """Groups statements into batches: consecutive rows inserted into the same table
+    with the same columns are grouped into a COPY, the rest of the statements are
+    concatenated. Statements changing session settings get batches of their own.
+
+    """
+
+    # Key of a batch of session statements.
+    _SESSION = ('session',)
+
+    def __init__(self, batch_size: int):
+        self._batch_size = batch_size
+        self._key: Optional[tuple] = None
+        self._parts: List[bytes] = []
+        self._size = 0
+        self._data_size = 0
+
+    def add(self, statement: bytes) -> Iterator[Batch]:
+        """Adds a statement and yields any batch it completes."""
+        insert = sql.parse_insert(statement)
+        if insert:
+            key: Optional[tuple] = (insert.table, insert.columns)
+        else:
+            key = self._SESSION if sql.is_session_statement(statement) else None
+
+        if key != self._key or self._data_size >= self._batch_size:
+            yield from self.flush()
+            self._key = key
+
+        part = sql.to_copy_row(insert.values) if insert else statement
+        self._parts.append(part)
+        self._size += len(statement)
+        self._data_size += len(part)
+
+    def flush(self) -> Iterator[Batch]:
+        """Yields the pending batch, if any."""
+        if not self._parts:
+            return
+
+        if self._key == self._SESSION:
+            yield Batch(sql=b''.join(self._parts), size=self._size, session=True)
+        elif self._key:
+            table, columns = self._key
+            yield Batch(
+                sql=b'COPY %s (%s) FROM STDIN' % (table, columns),
+                data=b''.join(self._parts),
+                table=table.decode('utf-8', 'replace'),
+                rows=len(self._parts),
+                size=self._size,
+            )
+        else:
+            yield Batch(sql=b''.join(self._parts), size=self._size)
+
+        self._parts = []
+        self._size = 0
+        self._data_size = 0
+
+
+class _Schedule:
+    """Assigns the tables of a dump to the workers writing it to a target. Tables with
+    statistics are assigned up front, largest first to the least loaded worker, so that
+    the workers finish at about the same time. Any other table is assigned to the
+    worker with the least left to write when it's first seen.
+
+    """
+
+    def __init__(self, workers: int, tables: Optional[List[models.TableStats]] = None):
+        self._workers = workers
+        self._sizes = {stats.table: stats.size for stats in tables or []}
+        self._rows = {stats.table: stats.rows for stats in tables or []}
+        self._written: Dict[str, int] = {}
+        self._assigned: Dict[str, int] = {}
+
+        loads = [0] * workers
+        for table in sorted(self._sizes, key=self._sizes.__getitem__, reverse=True):
+            worker = self._assign(table, key=loads.__getitem__)
+            loads[worker] += self._sizes[table]
+
+    @property
+    def total_bytes(self) -> Optional[int]:
+        return sum(self._sizes.values()) if self._sizes else None
+
+    def get_worker(self, table: str) -> int:
+        """Returns the index of the worker a table is written by."""
+        worker = self._assigned.get(table)
+        if worker is None:
+            worker = self._assign(table, key=self.get_remaining)
+        return worker
+
+    def get_rows(self, table: str) -> Optional[int]:
+        """Returns the number of rows of a table, if known."""
+        return self._rows.get(table)
+
+    def get_remaining(self, worker: int) -> int:
+        """Returns the size of the rows a worker has left to write."""
+        return sum(
+            max(self._sizes.get(table, 0) - self._written.get(table, 0), 0)
+            for table, assigned in self._assigned.items()
+            if assigned == worker
+        )
+
+    def add_written(self, table: str, size: int):
+        self._written[table] = self._written.get(table, 0) + size
+
+    def _assign(self, table: str, key: Callable[[int], int]) -> int:
+        worker = min(range(self._workers), key=key)
+        self._assigned[table] = worker
+        return worker
+
+
+class _Worker:
+    """A connection of a writer, with the queue of batches to execute over it."""
+
+    def __init__(
+        self,
+        stage: metrics_.StageMetrics,
+        queue: Optional[metrics_.QueueMetrics] = None,
+    ):
+        self.stage = stage
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self.queue_metrics = queue
+
+        # Size of the rows written and when the first of them was, for estimating
+        # the worker's write rate.
+        self.bytes_written = 0
+        self.started_at: Optional[float] = None
+
+    def get_rate(self) -> Optional[float]:
+        """Returns the bytes of rows written per second, if any were written."""
+        if self.started_at is None:
+            return None
+        elapsed = time.monotonic() - self.started_at
+        return self.bytes_written / elapsed if elapsed > 0 else None
+
+    def update_depth(self):
+        if self.queue_metrics:
+            self.queue_metrics.set_depth(self.queue.qsize())
+
+
+class _Writer:
+    """Executes batches against a database over one or more connections (workers), each
+    with its own bounded queue. The blocking driver calls run in worker threads.
+
+    COPY batches are routed to the worker their table is scheduled on. Any other batch
+    is a barrier: it's executed by the first worker once everything queued before it is
+    written, since it may create or alter the tables written to. Batches changing
+    session settings are executed by every worker, as each has its own session.
+
+    Once the writer fails it keeps draining its queues, so that the producer feeding the
+    rest of the targets never blocks on it.
+
+    """
+
+    _EOF = None
+
+    def __init__(
+        self,
+        target: str,
+        on_progress: Optional[Callable[[Progress], None]] = None,
+        metrics: Optional[metrics_.Metrics] = None,
+        name: str = 'write',
+        workers: int = 1,
+        tables: Optional[List[models.TableStats]] = None,
+    ):
+        self.target = target
+        self.error: Optional[WriterError] = None
+        self._on_progress = on_progress
+        self._schedule = _Schedule(workers, tables)
+        self._progress = Progress(target=target, total_bytes=self._schedule.total_bytes)
+        self._table_rows: Dict[str, int] = {}
+
+        metrics = metrics or metrics_.Metrics('restore')
+        self._workers = []
+        for i in range(1, workers + 1):
+            worker_name = name if workers == 1 else f'{name}/{i}'
+            self._workers.append(
+                _Worker(
+                    metrics.stage(worker_name),
+                    queue=metrics.queue(f'parse->{worker_name}', QUEUE_SIZE),
+                )
+            )
+
+    @property
+    def failed(self) -> bool:
+        return self.error is not None
+
+    async def put(self, batch: Batch):
+        """Queue a batch for writing. Blocks while the queue is full, and on a barrier
+        until the batches queued before it are written."""
+        if self.failed:
+            return
+        if len(self._workers) == 1:
+            await self._put(self._workers[0], batch)
+        elif batch.table:
+            await self._put(self._workers[self._schedule.get_worker(batch.table)], batch)
+        else:
+            await self._join(*self._workers)
+            if not self.failed:
+                workers = self._workers if batch.session else self._workers[:1]
+                for worker in workers:
+                    await self._put(worker, batch)
+                await self._join(*workers)
+
+    async def finish(self):
+        """Signal that there are no more batches to write."""
+        for worker in self._workers:
+            await worker.queue.put(self._EOF)
+
+    async def run(self):
+        """Write batches to the target until EOF."""
+        await asyncio.gather(*(self._run_worker(worker) for worker in self._workers))
+
+    async def _put(self, worker: _Worker, batch: Batch):
+        await worker.queue.put(batch)
+        worker.update_depth()
+
+    async def _join(self, *workers: _Worker):
+        await asyncio.gather(*(worker.queue.join() for worker in workers))
+
+    async def _run_worker(self, worker: _Worker):
+        worker.stage.start()
+        try:
+            await self._write(worker)
+        except WriterError as e:
+            self.error = self.error or e
+            await self._drain(worker)
+        finally:
+            worker.stage.finish()
+
+    async def _write(self, worker: _Worker):
+        # Imported on first use, like the rest of the backend and driver imports, to
+        # keep the CLI startup fast.
+        import psycopg2
+
+        loop = asyncio.get_event_loop()
+        try:
+            conn = await loop.run_in_executor(None, psycopg2.connect, self.target)
+        except psycopg2.Error as e:
+            raise WriterError(str(e).strip())
+
+        try:
+            conn.autocommit = True
+            cursor = conn.cursor()
+            while True:
+                batch = await self._get(worker)
+                if batch is self._EOF:
+                    break
+                try:
+                    # Skip the rest of the batches once another worker failed.
+                    if not self.failed:
+                        if batch.table and worker.started_at is None:
+                            worker.started_at = time.monotonic()
+                        await loop.run_in_executor(None, execute, cursor, batch)
+                        # Session batches run on every worker, but count once.
+                        if not batch.session or worker is self._workers[0]:
+                            self._report(worker, batch)
+                finally:
+                    worker.queue.task_done()
+        except asyncio.CancelledError:
+            # Interrupt the statement still running in the worker thread.
+            conn.cancel()
+            raise
+        finally:
+            conn.close()
+
+    def _report(self, worker: _Worker, batch: Batch):
+        stage = worker.stage
+        stage.bytes_in += batch.size
+        stage.bytes_out += len(batch.data) if batch.data is not None else batch.size
+        if batch.table:
+            stage.add_rows(batch.table, batch.rows)
+
+        progress = self._progress
+        progress.bytes_written += batch.size
+        progress.rows_written += batch.rows
+        progress.completed_table = None
+        if batch.table:
+            worker.bytes_written += batch.size
+            self._schedule.add_written(batch.table, batch.size)
+            table_rows = self._table_rows.get(batch.table, 0) + batch.rows
+            self._table_rows[batch.table] = table_rows
+            progress.table, progress.table_rows = batch.table, table_rows
+            if table_rows == self._schedule.get_rows(batch.table):
+                progress.completed_table = batch.table
+            progress.eta_seconds = self._get_eta()
+        if self._on_progress:
+            self._on_progress(progress)
+
+    def _get_eta(self) -> Optional[float]:
+        """Estimates the seconds until the slowest worker writes the rest of its
+        tables, at the rate it has written so far. Workers which haven't written yet
+        are assumed to write at the average rate."""
+        if self._progress.total_bytes is None:
+            return None
+        rates = [worker.get_rate() for worker in self._workers]
+        known = [rate for rate in rates if rate]
+        if not known:
+            return None
+        average = sum(known) / len(known)
+        return max(
+            self._schedule.get_remaining(i) / (rate or average)
+            for i, rate in enumerate(rates)
+        )
+
+    async def _get(self, worker: _Worker) -> Optional[Batch]:
+        """Returns the next queued batch, `_EOF` at the end."""
+        started = time.monotonic()
+        batch = await worker.queue.get()
+        worker.stage.blocked_input_seconds += time.monotonic() - started
+        worker.update_depth()
+        return batch
+
+    async def _drain(self, worker: _Worker):
+        """Consume and discard queued batches until EOF."""
+        while True:
+            batch = await self._get(worker)
+            worker.queue.task_done()
+            if batch is self._EOF:
+                break